@@ -1,20 +1,59 @@
+import os
+
 from flask import Flask
 from config import Config
 from extensions import db
+from models import User
 from routes.main import main_bp
-
-
-def create_app():
+from services.admission import init_admission
+from services.metrics_cache import init_metrics_cache
+from services.jobs import init_jobs
+from services.instrumentation import init_instrumentation
+from services.previews import init_previews
+from services.quality_maps import init_quality_maps
+from services.threads import init_threads
+from services.warmup import warm_up
+
+
+def create_app(config=None, **overrides):
+    """
+    config — класс настроек или строка импорта ("config.LocalConfig"),
+    по умолчанию — переменная окружения IQA_CONFIG или Config.
+    overrides — отдельные ключи поверх него.
+    """
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config or os.environ.get("IQA_CONFIG") or Config)
+    app.config.update(overrides)
 
+    init_threads(app)
     db.init_app(app)
+    init_admission(app)
+    init_metrics_cache(app)
+    init_jobs(app)
+    init_instrumentation(app)
+    init_previews(app)
+    init_quality_maps(app)
 
     app.register_blueprint(main_bp)
 
+    if app.config.get("CREATE_TABLES"):
+        _create_tables(app)
+
+    if app.config.get("WARM_UP_ON_START"):
+        warm_up(app)
+
     return app
 
 
+def _create_tables(app):
+    """Локальные профили: схема из моделей и пользователь, от имени которого пишут маршруты"""
+    with app.app_context():
+        db.create_all()
+        if db.session.get(User, 1) is None:
+            db.session.add(User(id=1, email=app.config.get("LOCAL_USER_EMAIL", "local@localhost")))
+            db.session.commit()
+
+
 app = create_app()
 
 if __name__ == "__main__":
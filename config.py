@@ -1,5 +1,8 @@
 import os
 
+from sqlalchemy.pool import StaticPool
+
+
 class Config:
     SECRET_KEY = "1234"
 
@@ -11,3 +14,97 @@ class Config:
 
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
+
+    # Размер in-process LRU кэша метрик (записей)
+    METRICS_CACHE_SIZE = 1024
+
+    # Очередь задач обработки (SQLite, без внешнего брокера)
+    JOBS_DB_PATH = os.path.join(BASE_DIR, "instance", "jobs.sqlite3")
+    JOB_WORKERS = 2
+    JOB_START_METHOD = "spawn"
+    # False — воркеры запускаются отдельно: python -m services.jobs
+    JOBS_RUN_IN_APP = True
+    # Аренда running-задачи: диспетчер продлевает её каждые JOB_LEASE_S / 4 с;
+    # задача без продления дольше JOB_LEASE_S (процесс остановлен) снова в очереди
+    JOB_LEASE_S = 60
+    # Сколько диспетчер ждёт фоновой записи результата воркером, прежде чем пометить задачу failed
+    JOB_ENCODE_TIMEOUT_S = 300
+
+    # Бюджет ядер на всё развёртывание (services/threads.py): делится между
+    # веб-воркерами (WEB_CONCURRENCY или WEB_WORKERS) и JOB_WORKERS.
+    # None — все ядра машины
+    CPU_BUDGET = None
+    WEB_WORKERS = 1
+    # Прогрев (services/warmup.py) в create_app — для запуска без fork-сервера;
+    # gunicorn.conf.py прогревает мастер сам
+    WARM_UP_ON_START = False
+
+    # Лимит пиковой памяти на обработку одного изображения; большие кадры
+    # обрабатываются полосами (services/tiling.py). None — без ограничения
+    PROCESSING_MAX_MEMORY_MB = 1024
+
+    # Допуск по заголовку (services/admission.py): больше MAX_IMAGE_PIXELS не
+    # принимается; оценки памяти одновременных декодов загрузок в веб-процессе
+    # и выполняемых задач обработки не превышают бюджетов. None — без лимита
+    MAX_IMAGE_PIXELS = 100_000_000
+    UPLOAD_DECODE_BUDGET_MB = 1024
+    JOBS_MEMORY_BUDGET_MB = 2048
+
+    # Автоподбор (services/auto_tune.py): перебор сетки сил этапов на кадре
+    # анализа до оценки AUTO_TUNE_TARGET_QUALITY или AUTO_TUNE_MAX_CANDIDATES
+    # оценок (None — вся сетка); на полном кадре выполняется только победитель
+    AUTO_TUNE_TARGET_QUALITY = 65.0
+    AUTO_TUNE_MAX_CANDIDATES = None
+
+    # Профиль анализа для интерактивных запросов: "fast" (свёртки OpenCV,
+    # откалиброваны по precise) или "precise". Пакетные аудиты — precise
+    ANALYSIS_PROFILE = "fast"
+
+    # Почти-дубликаты (services/near_duplicates.py): до скольких отличающихся
+    # бит из 64 перцептивного хеша предлагать готовый результат похожего фото
+    NEAR_DUPLICATE_MAX_DISTANCE = 6
+
+    # Оценка видео (services/video_analysis.py): шаг выборки кадров, лимит
+    # времени на клип (дальше — truncated), максимум оценённых кадров и порог
+    # смены сцены для режима "scene"
+    VIDEO_SAMPLE_EVERY = 30
+    VIDEO_TIME_BUDGET_S = 20.0
+    VIDEO_MAX_SAMPLES = 600
+    VIDEO_SCENE_THRESHOLD = 30.0
+
+    # Пирамида превью для страниц (services/previews.py): размеры по большей
+    # стороне, формат "webp" или "jpg" и качество кодирования
+    PREVIEW_SIZES = (256, 1024, 2048)
+    PREVIEW_FORMAT = "webp"
+    PREVIEW_QUALITY = 80
+
+    # Кодирование результатов обработки (services/encoding.py); запрос может
+    # переопределить формат и качество. "same" — формат оригинала
+    OUTPUT_ENCODING = {
+        "format": "same",
+        "png_compression": 1,
+        "jpeg_quality": 92,
+        "jpeg_progressive": False,
+        "webp_quality": 90,
+    }
+
+
+class LocalConfig(Config):
+    """
+    Без PostgreSQL: SQLite-файл в instance/ приложения; таблицы и пользователь
+    по умолчанию создаются при старте. create_app("config.LocalConfig") или IQA_CONFIG
+    """
+    SQLALCHEMY_DATABASE_URI = "sqlite:///local.sqlite3"
+    # Ожидание блокировки записи вместо "database is locked" при параллельных запросах
+    SQLALCHEMY_ENGINE_OPTIONS = {"connect_args": {"timeout": 30}}
+    CREATE_TABLES = True
+    LOCAL_USER_EMAIL = "local@localhost"
+
+
+class MemoryConfig(LocalConfig):
+    """
+    SQLite в памяти процесса: одно соединение на всех (StaticPool), данные
+    живут до выхода. Потоки делят транзакцию — только для последовательных запросов
+    """
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_ENGINE_OPTIONS = {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
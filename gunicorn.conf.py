@@ -0,0 +1,25 @@
+"""
+Запуск под gunicorn: gunicorn -c gunicorn.conf.py app:app
+
+Приложение загружается и прогревается один раз в мастер-процессе
+(services/warmup.py), воркеры получают его копией при fork и сразу готовы
+к запросам: без импорта skimage/scipy и первых вызовов OpenCV в каждом.
+"""
+import os
+
+from config import Config
+
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+# Так же число воркеров читает services/threads.py, деля CPU_BUDGET между процессами
+workers = int(os.environ.get("WEB_CONCURRENCY", Config.WEB_WORKERS))
+preload_app = True
+
+
+def when_ready(server):
+    # Вызывается в мастере после загрузки приложения (preload_app) и до запуска воркеров
+    from app import app
+    from services.warmup import warm_up
+
+    warm_up(app)
+
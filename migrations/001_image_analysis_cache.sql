@@ -0,0 +1,7 @@
+-- Кэш метрик: ключ по содержимому файла и версии анализатора
+ALTER TABLE image_analysis ADD COLUMN color_balance DOUBLE PRECISION;
+ALTER TABLE image_analysis ADD COLUMN overall_quality DOUBLE PRECISION;
+ALTER TABLE image_analysis ADD COLUMN content_digest VARCHAR(64);
+ALTER TABLE image_analysis ADD COLUMN analyzer_version VARCHAR(32);
+
+CREATE INDEX ix_image_analysis_content_digest ON image_analysis (content_digest);
@@ -0,0 +1,17 @@
+-- Content-addressed хранилище файлов с подсчётом ссылок
+CREATE TABLE stored_files (
+    id SERIAL PRIMARY KEY,
+    digest VARCHAR(64) NOT NULL UNIQUE,
+    relpath VARCHAR(255) NOT NULL,
+    size BIGINT,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    derivation_key VARCHAR(64) UNIQUE,
+    created_at TIMESTAMP
+);
+
+ALTER TABLE images ADD COLUMN content_digest VARCHAR(64);
+ALTER TABLE images ADD COLUMN stored_path VARCHAR(255);
+
+CREATE INDEX ix_images_content_digest ON images (content_digest);
+
+-- results.processed_filename для новых строк хранит путь объекта (objects/ab/cd/...)
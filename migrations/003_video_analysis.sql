@@ -0,0 +1,43 @@
+-- Оценка видеоклипов: строка на клип и строка на каждый оценённый кадр
+CREATE TABLE video_analyses (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    original_filename VARCHAR(255) NOT NULL,
+    content_digest VARCHAR(64),
+    analyzer_version VARCHAR(32),
+    sampling VARCHAR(16) NOT NULL,
+    frames_read INTEGER,
+    frames_sampled INTEGER,
+    fps DOUBLE PRECISION,
+    width INTEGER,
+    height INTEGER,
+    duration_s DOUBLE PRECISION,
+    truncated BOOLEAN DEFAULT FALSE,
+    elapsed_s DOUBLE PRECISION,
+    sharpness DOUBLE PRECISION,
+    brightness DOUBLE PRECISION,
+    contrast DOUBLE PRECISION,
+    noise DOUBLE PRECISION,
+    color_balance DOUBLE PRECISION,
+    overall_quality DOUBLE PRECISION,
+    summary JSON,
+    created_at TIMESTAMP
+);
+
+CREATE INDEX ix_video_analyses_content_digest ON video_analyses (content_digest);
+
+CREATE TABLE video_frame_analyses (
+    id SERIAL PRIMARY KEY,
+    video_id INTEGER NOT NULL REFERENCES video_analyses (id) ON DELETE CASCADE,
+    frame_index INTEGER NOT NULL,
+    timestamp_ms DOUBLE PRECISION,
+    reason VARCHAR(16),
+    sharpness DOUBLE PRECISION NOT NULL,
+    brightness DOUBLE PRECISION NOT NULL,
+    contrast DOUBLE PRECISION NOT NULL,
+    noise DOUBLE PRECISION NOT NULL,
+    color_balance DOUBLE PRECISION,
+    overall_quality DOUBLE PRECISION
+);
+
+CREATE INDEX ix_video_frame_analyses_video_id ON video_frame_analyses (video_id);
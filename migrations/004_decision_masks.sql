@@ -0,0 +1,12 @@
+-- Решения по таблицам правил (services/rules.py) в виде битовых масок;
+-- заполняются для старых строк: python -m services.decision_engine redecide
+ALTER TABLE image_analysis ADD COLUMN decision_mask INTEGER;
+ALTER TABLE image_analysis ADD COLUMN auto_mask INTEGER;
+ALTER TABLE image_analysis ADD COLUMN rules_version VARCHAR(16);
+
+ALTER TABLE processing_sessions ADD COLUMN decision_mask INTEGER;
+ALTER TABLE processing_sessions ADD COLUMN auto_mask INTEGER;
+ALTER TABLE processing_sessions ADD COLUMN rules_version VARCHAR(16);
+
+CREATE INDEX ix_image_analysis_rules_version ON image_analysis (rules_version);
+CREATE INDEX ix_processing_sessions_rules_version ON processing_sessions (rules_version);
@@ -0,0 +1,12 @@
+-- Перцептивный хеш загрузок и индексы кусков для поиска почти-дубликатов;
+-- для старых строк: python -m services.near_duplicates backfill
+ALTER TABLE images ADD COLUMN phash BIGINT;
+ALTER TABLE images ADD COLUMN phash_0 INTEGER;
+ALTER TABLE images ADD COLUMN phash_1 INTEGER;
+ALTER TABLE images ADD COLUMN phash_2 INTEGER;
+ALTER TABLE images ADD COLUMN phash_3 INTEGER;
+
+CREATE INDEX ix_images_phash_0 ON images (phash_0);
+CREATE INDEX ix_images_phash_1 ON images (phash_1);
+CREATE INDEX ix_images_phash_2 ON images (phash_2);
+CREATE INDEX ix_images_phash_3 ON images (phash_3);
@@ -0,0 +1,4 @@
+-- Страницы истории обработок: keyset по (created_at, id) внутри изображения
+-- и поиск результата сессии (services/repository.py)
+CREATE INDEX ix_processing_sessions_image_created ON processing_sessions (image_id, created_at, id);
+CREATE INDEX ix_results_session_id ON results (session_id);
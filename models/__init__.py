@@ -2,4 +2,6 @@ from .image import Image
 from .processing_session import ProcessingSession
 from .user import User
 from .result import Result
-from .image_analysis import ImageAnalysis
\ No newline at end of file
+from .image_analysis import ImageAnalysis
+from .stored_file import StoredFile
+from .video_analysis import VideoAnalysis, VideoFrameAnalysis
\ No newline at end of file
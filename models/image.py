@@ -8,6 +8,16 @@ class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
+    # Содержимое в хранилище (stored_files); у старых строк пусто — файл лежит под original_filename
+    content_digest = db.Column(db.String(64), index=True)
+    stored_path = db.Column(db.String(255))
+    # Перцептивный хеш (dHash, 64 бита) и его 16-битные куски для поиска
+    # почти-дубликатов (services/near_duplicates.py)
+    phash = db.Column(db.BigInteger)
+    phash_0 = db.Column(db.Integer, index=True)
+    phash_1 = db.Column(db.Integer, index=True)
+    phash_2 = db.Column(db.Integer, index=True)
+    phash_3 = db.Column(db.Integer, index=True)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
 
     sessions = db.relationship(
@@ -20,3 +30,8 @@ class Image(db.Model):
         lazy=True,
         cascade="all, delete-orphan"
     )
+
+    @property
+    def stored_name(self) -> str:
+        """Путь файла относительно UPLOAD_FOLDER"""
+        return self.stored_path or self.original_filename
@@ -17,5 +17,27 @@ class ImageAnalysis(db.Model):
     brightness = db.Column(db.Float, nullable=False)
     contrast = db.Column(db.Float, nullable=False)
     noise = db.Column(db.Float, nullable=False)
+    color_balance = db.Column(db.Float)
+    overall_quality = db.Column(db.Float)
+
+    # Ключ кэша метрик: sha256 содержимого файла + версия анализатора
+    content_digest = db.Column(db.String(64), index=True)
+    analyzer_version = db.Column(db.String(32))
+
+    # Решения по правилам services/rules.py: бит i — i-е правило таблицы
+    # (decision_mask — рекомендации, auto_mask — этапы авто-режима)
+    decision_mask = db.Column(db.Integer)
+    auto_mask = db.Column(db.Integer)
+    rules_version = db.Column(db.String(16), index=True)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_metrics(self) -> dict:
+        return {
+            "sharpness": self.sharpness,
+            "brightness": self.brightness,
+            "contrast": self.contrast,
+            "noise": self.noise,
+            "color_balance": self.color_balance,
+            "overall_quality": self.overall_quality,
+        }
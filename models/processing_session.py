@@ -4,6 +4,10 @@ from extensions import db
 
 class ProcessingSession(db.Model):
     __tablename__ = "processing_sessions"
+    # История изображения читается по (image_id, created_at, id) — services/repository.py
+    __table_args__ = (
+        db.Index("ix_processing_sessions_image_created", "image_id", "created_at", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     image_id = db.Column(db.Integer, db.ForeignKey("images.id"), nullable=False)
@@ -13,6 +17,12 @@ class ProcessingSession(db.Model):
     blur_score = db.Column(db.Float)
     color_balance_score = db.Column(db.Float)
 
+    # Решения по правилам services/rules.py: бит i — i-е правило таблицы
+    # (decision_mask — рекомендации, auto_mask — этапы авто-режима)
+    decision_mask = db.Column(db.Integer)
+    auto_mask = db.Column(db.Integer)
+    rules_version = db.Column(db.String(16), index=True)
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     result = db.relationship(
@@ -8,7 +8,8 @@ class Result(db.Model):
     session_id = db.Column(
         db.Integer,
         db.ForeignKey("processing_sessions.id"),
-        nullable=False  # ← убираем unique=True
+        nullable=False,  # ← убираем unique=True
+        index=True,
     )
     processed_filename = db.Column(db.String(255), nullable=False)
     quality_score = db.Column(db.Float)
@@ -0,0 +1,22 @@
+from datetime import datetime
+from extensions import db
+
+
+class StoredFile(db.Model):
+    """Объект content-addressed хранилища (services/storage.py)"""
+    __tablename__ = "stored_files"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # sha256 содержимого; путь — objects/ab/cd/<digest><ext> внутри UPLOAD_FOLDER
+    digest = db.Column(db.String(64), unique=True, nullable=False)
+    relpath = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger)
+
+    # Сколько строк images/results ссылается на объект; 0 — можно удалять
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Для результатов обработки: sha256(digest оригинала, план, PIPELINE_VERSION)
+    derivation_key = db.Column(db.String(64), unique=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,71 @@
+from datetime import datetime
+from extensions import db
+
+
+class VideoAnalysis(db.Model):
+    """Оценка клипа или последовательности кадров (services/video_analysis.py)"""
+    __tablename__ = "video_analyses"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    original_filename = db.Column(db.String(255), nullable=False)
+    content_digest = db.Column(db.String(64), index=True)
+    analyzer_version = db.Column(db.String(32))
+
+    # Выборка: режим ("interval", "scene", "budget") и сколько кадров прочитано/оценено
+    sampling = db.Column(db.String(16), nullable=False)
+    frames_read = db.Column(db.Integer)
+    frames_sampled = db.Column(db.Integer)
+    fps = db.Column(db.Float)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    duration_s = db.Column(db.Float)
+    # True — анализ остановлен по лимиту времени или кадров до конца файла
+    truncated = db.Column(db.Boolean, default=False)
+    elapsed_s = db.Column(db.Float)
+
+    # Средние по оценённым кадрам
+    sharpness = db.Column(db.Float)
+    brightness = db.Column(db.Float)
+    contrast = db.Column(db.Float)
+    noise = db.Column(db.Float)
+    color_balance = db.Column(db.Float)
+    overall_quality = db.Column(db.Float)
+
+    # Полные агрегаты: {метрика: {mean, min, max, p10, p50, p90}}
+    summary = db.Column(db.JSON)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    frames = db.relationship(
+        "VideoFrameAnalysis",
+        backref="video",
+        lazy="dynamic",
+        cascade="all, delete-orphan",
+        order_by="VideoFrameAnalysis.frame_index",
+    )
+
+
+class VideoFrameAnalysis(db.Model):
+    __tablename__ = "video_frame_analyses"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    video_id = db.Column(
+        db.Integer,
+        db.ForeignKey("video_analyses.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+
+    frame_index = db.Column(db.Integer, nullable=False)
+    timestamp_ms = db.Column(db.Float)
+    # Почему кадр попал в выборку: interval, scene, budget
+    reason = db.Column(db.String(16))
+
+    sharpness = db.Column(db.Float, nullable=False)
+    brightness = db.Column(db.Float, nullable=False)
+    contrast = db.Column(db.Float, nullable=False)
+    noise = db.Column(db.Float, nullable=False)
+    color_balance = db.Column(db.Float)
+    overall_quality = db.Column(db.Float)
@@ -1,17 +1,44 @@
 import os
-from flask import Blueprint, render_template, request, redirect, url_for, current_app
-from flask import send_file
-from werkzeug.utils import secure_filename
-
-from extensions import db
+import re
+import uuid
+from flask import Blueprint, render_template, request, redirect, url_for, current_app, jsonify, abort
+from flask import send_file, send_from_directory, Response
 
 from models.image import Image
 from models.result import Result
 from models.processing_session import ProcessingSession
-
-from services.image_analysis import analyze_image
-from services.image_processing import process_image
-from services.decision_engine import recommend_actions
+from models.stored_file import StoredFile
+from models.video_analysis import VideoAnalysis
+
+from services.admission import DOWNSAMPLE, plan_admission, read_header
+from services.auto_tune import WORST_CASE_PLAN, search_plan, search_settings
+from services.metrics_cache import file_digest, get_metrics
+from services.decision_engine import recommend_actions, summarize_actions
+from services.jobs import enqueue_processing, get_job, DONE
+from services.image_processing import compile_plan
+from services.encoding import encoding_from_form, encoding_key, output_extension
+from services.instrumentation import registry
+from services.ingest import ingest_upload, wait_for_file
+from services.storage import (
+    add_reference,
+    derivation_key,
+    digest_from_relpath,
+    find_derived,
+    object_path,
+    tmp_dir,
+)
+from services.previews import CACHE_MAX_AGE, ensure_preview, preview_etag, preview_mimetype, preview_sizes
+from services.quality_maps import (
+    MAP_METRICS,
+    OVERLAY_MIMETYPE,
+    ensure_maps_json,
+    ensure_overlay,
+    maps_etag,
+    overlay_etag,
+)
+from services.repository import add_result, add_session, commit, get_result, history_page, session_metrics
+from services.near_duplicates import DEFAULT_MAX_DISTANCE, find_reusable_result, hamming
+from services.video_analysis import SAMPLING_MODES, ingest_video, sampling_from_config
 
 main_bp = Blueprint("main", __name__)
 
@@ -24,48 +51,123 @@ def upload_image():
         if not file or file.filename == "":
             return "Файл не выбран", 400
 
-        filename = secure_filename(file.filename)
+        # Поток читается один раз: метрики по массиву в памяти, файл пишется в фоне
+        try:
+            image, session, metrics = ingest_upload(file, current_app.config["UPLOAD_FOLDER"])
+        except ValueError as exc:
+            return str(exc), 400
+
+        # Сразу страница анализа — без редиректа и повторного чтения с диска
+        return render_template(
+            "analysis.html",
+            image=image,
+            session=session,
+            metrics=metrics,
+            near_duplicate=_near_duplicate(image),
+        )
 
-        upload_dir = current_app.config["UPLOAD_FOLDER"]
-        os.makedirs(upload_dir, exist_ok=True)
+    return render_template("upload.html")
 
-        file_path = os.path.join(upload_dir, filename)
-        file.save(file_path)
-        
-        image = Image(
-            user_id=1,
-            original_filename=filename,
-        )
-        db.session.add(image)
-        db.session.commit()
 
-        return redirect(url_for("main.analyze_image_route", image_id=image.id))
+def _near_duplicate(image):
+    """Готовый результат для почти такой же фотографии: (Result, расстояние) или None"""
+    return find_reusable_result(image, current_app.config.get("NEAR_DUPLICATE_MAX_DISTANCE", DEFAULT_MAX_DISTANCE))
 
-    return render_template("upload.html")
+
+@main_bp.route("/uploads/<path:filename>")
+def uploaded_file(filename):
+    upload_dir = current_app.config["UPLOAD_FOLDER"]
+    path = os.path.join(upload_dir, filename)
+    # Объект хранилища может быть ещё в очереди фоновой записи; ждём только известные
+    # объекты, чтобы запрос несуществующего пути сразу получал 404
+    if not os.path.exists(path) and StoredFile.query.filter_by(relpath=filename).first() is not None:
+        try:
+            wait_for_file(path)
+        except FileNotFoundError:
+            abort(404)
+    return send_from_directory(upload_dir, filename)
+
+
+@main_bp.route("/preview/<digest>/<int:size>")
+def preview(digest, size):
+    if size not in preview_sizes() or not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(404)
+
+    # Превью неизменяемо: совпавший ETag отвечает 304 без обращения к БД и диску
+    etag = preview_etag(digest, size)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    stored = StoredFile.query.filter_by(digest=digest).first_or_404()
+    path = ensure_preview(current_app.config["UPLOAD_FOLDER"], digest, stored.relpath, size)
+
+    response = send_file(path, mimetype=preview_mimetype(), etag=etag, conditional=True, max_age=CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@main_bp.route("/quality-map/<digest>")
+def quality_map(digest):
+    """Карты качества объекта в JSON: сетка оценок 0..100 по окнам кадра анализа"""
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(404)
+
+    # Карты зависят только от содержимого — неизменяемы, как превью и оверлеи
+    etag = maps_etag(digest)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    stored = StoredFile.query.filter_by(digest=digest).first_or_404()
+    path = ensure_maps_json(current_app.config["UPLOAD_FOLDER"], digest, stored.relpath)
+
+    response = send_file(path, mimetype="application/json", etag=etag, conditional=True, max_age=CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@main_bp.route("/quality-map/<digest>/<metric>")
+def quality_map_overlay(digest, metric):
+    if metric not in MAP_METRICS or not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(404)
+
+    # Оверлей неизменяем, как и превью
+    etag = overlay_etag(digest, metric)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    stored = StoredFile.query.filter_by(digest=digest).first_or_404()
+    path = ensure_overlay(current_app.config["UPLOAD_FOLDER"], digest, stored.relpath, metric)
+
+    response = send_file(path, mimetype=OVERLAY_MIMETYPE, etag=etag, conditional=True, max_age=CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @main_bp.route("/analyze/<int:image_id>")
 def analyze_image_route(image_id):
     image = Image.query.get_or_404(image_id)
 
-    image_path = os.path.join(
-        current_app.config["UPLOAD_FOLDER"],
-        image.original_filename
-    )
+    image_path = object_path(current_app.config["UPLOAD_FOLDER"], image.stored_name)
 
-    # Анализируем изображение
-    metrics = analyze_image(image_path)
+    # Анализируем изображение (повторный анализ того же файла берётся из кэша)
+    try:
+        wait_for_file(image_path)
+    except FileNotFoundError:
+        abort(404)
+    metrics = get_metrics(image_path, image.id, digest=image.content_digest, commit=False)
 
-    # Создаём сессию с метриками
-    session = ProcessingSession(
-        image_id=image.id,
-        brightness_score=metrics["brightness"],
-        sharpness_score=metrics["sharpness"],
-        blur_score=metrics["noise"],
-        color_balance_score=metrics["contrast"],
-    )
-    db.session.add(session)
-    db.session.commit()
+    # Создаём сессию с метриками; строка анализа и сессия — одной транзакцией
+    session = add_session(image.id, metrics)
+    commit("analyze")
 
     # Здесь НЕ делаем улучшение и НЕ создаём Result
     # Просто рендерим страницу с метриками
@@ -73,7 +175,8 @@ def analyze_image_route(image_id):
         "analysis.html",   # ← новая страница или та же result.html, но без processed_filename
         image=image,
         session=session,
-        metrics=metrics
+        metrics=metrics,
+        near_duplicate=_near_duplicate(image),
     )
 
 @main_bp.route("/process/<int:session_id>", methods=["POST"])
@@ -82,101 +185,211 @@ def process_image_service(session_id):
     image = old_session.image
 
     upload_dir = current_app.config["UPLOAD_FOLDER"]
-    image_path = os.path.join(upload_dir, image.original_filename)
-
-    # Анализируем заново (на случай, если пользователь изменил что-то)
-    metrics = analyze_image(image_path)
-
-    # Создаём НОВУЮ сессию для этой обработки
-    new_session = ProcessingSession(
-        image_id=image.id,
-        brightness_score=metrics["brightness"],
-        sharpness_score=metrics["sharpness"],
-        blur_score=metrics["noise"],
-        color_balance_score=metrics["contrast"],
-    )
-    db.session.add(new_session)
-    db.session.commit()  # commit, чтобы получить new_session.id
+    image_path = object_path(upload_dir, image.stored_name)
+
+    # Формат и качество результата: конфиг + параметры формы
+    try:
+        encoding = encoding_from_form(request.form, base=current_app.config.get("OUTPUT_ENCODING"))
+    except ValueError as exc:
+        return str(exc), 400
+
+    # Анализируем заново (на случай, если пользователь изменил что-то);
+    # неизменённый оригинал отдаётся из кэша метрик по содержимому
+    try:
+        wait_for_file(image_path)
+    except FileNotFoundError:
+        abort(404)
+    original_digest = image.content_digest or file_digest(image_path)
+    metrics = get_metrics(image_path, image.id, digest=original_digest, commit=False)
+
+    # Создаём НОВУЮ сессию для этой обработки (flush даёт new_session.id)
+    new_session = add_session(image.id, metrics)
 
     actions = {
         "enhance_brightness": "enhance_brightness" in request.form,
         "sharpen": "sharpen" in request.form,
         "denoise": "denoise" in request.form,
         "auto_improve": "auto_improve" in request.form,
+        "auto_tune": "auto_tune" in request.form,
     }
 
-    processed_filename = process_image(
-        image_path=image_path,
-        actions=actions,
-        output_dir=upload_dir,
-        metrics={
-            "brightness": new_session.brightness_score,
-            "sharpness": new_session.sharpness_score,
-            "noise": new_session.blur_score,
-            "contrast": new_session.color_balance_score,
-        }
-    )
+    plan_metrics = session_metrics(new_session)
+    tune = None
+    if actions["auto_tune"]:
+        # План выберет перебор в воркере; результат определяется параметрами перебора
+        tune = search_settings(current_app.config)
+        plan = search_plan(tune)
+    else:
+        plan = compile_plan(actions, plan_metrics)
+
+    # Память плана — по заголовку оригинала, до декода в воркере
+    max_memory_mb = current_app.config.get("PROCESSING_MAX_MEMORY_MB")
+    try:
+        admission = plan_admission(read_header(image_path), WORST_CASE_PLAN if tune else plan, max_memory_mb)
+    except ValueError as exc:
+        return str(exc), 400
+    if admission.mode == DOWNSAMPLE:
+        # Уменьшенный результат — другое производное того же оригинала
+        plan = plan + [("downsample", {"factor": admission.decode_factor})]
+
+    # Такой же план для того же оригинала уже считали — результат берётся из хранилища
+    ext = output_extension(encoding, image.stored_name)
+    key = derivation_key(original_digest, plan, ext, encoding_key(encoding, ext))
+    stored = find_derived(upload_dir, key)
+    if stored is not None:
+        add_reference(stored)
+        verdict, confidence = summarize_actions(actions)
+        result = add_result(new_session.id, stored.relpath, verdict, confidence)
+        commit("process")
+        result_url = url_for("main.show_result", result_id=result.id)
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify(job_id=None, status=DONE, result_id=result.id, result_url=result_url)
+        return redirect(result_url)
+
+    # Воркер сохранит результат для new_session.id — сессия должна быть в БД до постановки
+    commit("process")
+
+    # Сама обработка идёт в пуле воркеров, запрос только ставит задачу в очередь
+    job_id = enqueue_processing(current_app, new_session.id, {
+        "image_path": image_path,
+        "actions": actions,
+        "output_dir": tmp_dir(upload_dir),
+        "output_filename": f"{key}-{uuid.uuid4().hex}{ext}",
+        "derivation_key": key,
+        "encoding": encoding,
+        "metrics": plan_metrics,
+        "max_memory_mb": max_memory_mb,
+        "decode_factor": admission.decode_factor,
+        "memory_bytes": admission.footprint,
+        "tune": tune,
+    })
+    status_url = url_for("main.job_status", job_id=job_id)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job_id=job_id, status_url=status_url), 202
+    return render_template("processing.html", job_id=job_id, status_url=status_url), 202
+
+
+@main_bp.route("/process/<int:session_id>/reuse/<int:result_id>", methods=["POST"])
+def reuse_result(session_id, result_id):
+    """Готовый результат почти такой же фотографии вместо новой обработки"""
+    old_session = ProcessingSession.query.get_or_404(session_id)
+    image = old_session.image
+    source = Result.query.get_or_404(result_id)
+
+    # Повторная проверка: result_id приходит из формы
+    max_distance = current_app.config.get("NEAR_DUPLICATE_MAX_DISTANCE", DEFAULT_MAX_DISTANCE)
+    source_image = source.session.image
+    if image.phash is None or source_image.phash is None or hamming(image.phash, source_image.phash) > max_distance:
+        return "Результат относится к другому изображению", 400
+
+    # Как и обычная обработка — новая сессия с метриками анализа
+    new_session = add_session(image.id, session_metrics(old_session))
+
+    stored = StoredFile.query.filter_by(relpath=source.processed_filename).first()
+    if stored is not None:
+        add_reference(stored)
+    result = add_result(new_session.id, source.processed_filename, source.verdict, source.quality_score)
+    commit("reuse")
+    return redirect(url_for("main.show_result", result_id=result.id))
 
-    # Verdict и confidence
-    summary = []
-    if actions.get("auto_improve"):
-        summary.append("Автоматический адаптивный режим")
-    if actions.get("enhance_brightness"):
-        summary.append("Повышена яркость")
-    if actions.get("sharpen"):
-        summary.append("Улучшена резкость")
-    if actions.get("denoise"):
-        summary.append("Убран шум")
-
-    verdict = " • ".join(summary) if summary else "Ничего не применено"
-    confidence = round(len(summary) / 4, 2)
-
-    result = Result(
-        session_id=new_session.id,  # ← привязываем к новой сессии
-        processed_filename=processed_filename,
-        quality_score=confidence,
-        verdict=verdict
-    )
-    db.session.add(result)
-    db.session.commit()
 
-    return redirect(url_for("main.show_result", result_id=result.id))
+@main_bp.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    job = get_job(current_app, job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(
+        job_id=job["id"],
+        status=job["status"],
+        stage=job["stage"],
+        progress=job["progress"],
+        result_id=job["result_id"],
+        result_url=url_for("main.show_result", result_id=job["result_id"]) if job["status"] == DONE else None,
+        error=job["error"],
+    )
 
 
 @main_bp.route("/image/<int:image_id>/history")
 def image_history(image_id):
     image = Image.query.get_or_404(image_id)
-    sessions = ProcessingSession.query.filter_by(image_id=image_id).order_by(ProcessingSession.created_at.desc()).all()
-    return render_template("history.html", image=image, sessions=sessions)
+    try:
+        sessions, next_cursor = history_page(image_id, cursor=request.args.get("before"))
+    except ValueError:
+        return "Неверный курсор страницы", 400
+    return render_template("history.html", image=image, sessions=sessions, next_cursor=next_cursor)
 
 
 @main_bp.route("/result/<int:result_id>")
 def show_result(result_id):
-    result = Result.query.get_or_404(result_id)
+    result = get_result(result_id)
+    if result is None:
+        abort(404)
     session = result.session
     image = session.image
 
     upload_dir = current_app.config["UPLOAD_FOLDER"]
 
-    original_path = os.path.join(upload_dir, image.original_filename)
-    processed_path = os.path.join(upload_dir, result.processed_filename)
+    original_path = object_path(upload_dir, image.stored_name)
+    processed_path = object_path(upload_dir, result.processed_filename)
 
     # ОРИГИНАЛЬНЫЕ МЕТРИКИ — из ProcessingSession (уже в БД)
-    original_metrics = {
-        "brightness": session.brightness_score,
-        "sharpness": session.sharpness_score,
-        "noise": session.blur_score,
-        "contrast": session.color_balance_score,
-    }
+    original_metrics = session_metrics(session)
+
+    # НОВЫЕ МЕТРИКИ — считаются один раз, повторные просмотры берут их из кэша
+    processed_metrics = get_metrics(processed_path, image.id, digest=digest_from_relpath(result.processed_filename))
 
-    # НОВЫЕ МЕТРИКИ — считаем ЗДЕСЬ
-    processed_metrics = analyze_image(processed_path)
+    # Расширение — от сохранённого результата: формат мог смениться (services/encoding.py)
+    stem = os.path.splitext(image.original_filename)[0]
+    download_name = f"processed_{stem}{os.path.splitext(result.processed_filename)[1]}"
 
     return render_template(
         "result.html",
         image=image,
         result=result,
+        download_name=download_name,
         original_metrics=original_metrics,
         processed_metrics=processed_metrics
     )
 
+
+
+@main_bp.route("/video", methods=["GET", "POST"])
+def upload_video():
+    if request.method == "POST":
+        file = request.files.get("video")
+
+        if not file or file.filename == "":
+            return "Файл не выбран", 400
+
+        mode = request.form.get("mode") or None
+        if mode is not None and mode not in SAMPLING_MODES:
+            return f"Неизвестный режим выборки кадров: {mode}", 400
+
+        # Клип копируется на диск потоком и оценивается в пределах VIDEO_TIME_BUDGET_S
+        try:
+            video = ingest_video(
+                file,
+                current_app.config["UPLOAD_FOLDER"],
+                profile=current_app.config.get("ANALYSIS_PROFILE"),
+                **sampling_from_config(current_app.config, mode),
+            )
+        except ValueError as exc:
+            return str(exc), 400
+
+        return redirect(url_for("main.show_video", video_id=video.id))
+
+    return render_template("video.html", video=None, modes=SAMPLING_MODES)
+
+
+@main_bp.route("/video/<int:video_id>")
+def show_video(video_id):
+    video = VideoAnalysis.query.get_or_404(video_id)
+    return render_template("video.html", video=video, frames=video.frames.all(), modes=SAMPLING_MODES)
+
+
+@main_bp.route("/metrics")
+def metrics_endpoint():
+    # Текстовый формат Prometheus: гистограммы этапов и счётчики этого процесса
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,173 @@
+"""
+Допуск изображений по заголовку — до декодирования пикселей.
+
+read_header берёт из заголовка (PIL, без декода) формат, размеры, число
+каналов и глубину. По ним оценивается пиковая память:
+
+    загрузка   — декод для анализа (JPEG — сразу уменьшенный, см. image_analysis);
+    обработка  — декод оригинала и план: tiling.full_frame_footprint или
+                 tiled_footprint при полосовом режиме.
+
+Решение для обработки (plan_admission):
+
+    full        — план целиком помещается в PROCESSING_MAX_MEMORY_MB;
+    tiled       — помещается полосами (как в process_image);
+    downsample  — JPEG, который не помещается и полосами: декод в 2/4/8 раз меньше;
+    иначе ValueError, как и для изображений больше MAX_IMAGE_PIXELS.
+
+Оценки расходуют бюджет процесса (MemoryBudget): декоды загрузок в веб-процессе
+и задачи обработки в JobRunner ждут, пока сумма оценок выполняемых не позволит
+начать, — несколько больших кадров одновременно не выходят за лимит.
+"""
+import threading
+import warnings
+from collections import namedtuple
+from contextlib import contextmanager
+
+from PIL import Image as PILImage
+
+from services.image_analysis import REDUCED_DECODE, reduced_factor
+from services.tiling import band_rows_for_budget, full_frame_footprint, tiled_footprint
+
+
+ImageHeader = namedtuple("ImageHeader", "format width height channels bit_depth")
+Admission = namedtuple("Admission", "mode footprint decode_factor")
+
+FULL = "full"
+TILED = "tiled"
+DOWNSAMPLE = "downsample"
+
+DEFAULT_MAX_PIXELS = 100_000_000
+
+# Режим PIL -> (каналы, бит на канал) в файле
+_MODE_LAYOUT = {
+    "1": (1, 1), "L": (1, 8), "P": (1, 8), "LA": (2, 8), "PA": (2, 8),
+    "RGB": (3, 8), "YCbCr": (3, 8), "LAB": (3, 8), "HSV": (3, 8),
+    "RGBA": (4, 8), "RGBX": (4, 8), "CMYK": (4, 8),
+    "I;16": (1, 16), "I;16B": (1, 16), "I;16L": (1, 16), "I": (1, 32), "F": (1, 32),
+}
+
+_DOWNSAMPLE_FACTORS = (2, 4, 8)
+
+
+class MemoryBudget:
+    """
+    Сумма оценок памяти выполняемых работ не больше limit байт (None — без лимита).
+    Работа больше всего лимита ждёт, пока не останется одна, — иначе она не начнётся никогда.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.used = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, nbytes: int):
+        with self._changed:
+            while self.limit is not None and self.used and self.used + nbytes > self.limit:
+                self._changed.wait()
+            self.used += nbytes
+
+    def release(self, nbytes: int):
+        with self._changed:
+            self.used -= nbytes
+            self._changed.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+
+_limits = {"max_pixels": DEFAULT_MAX_PIXELS}
+decode_budget = MemoryBudget()
+
+
+def _megabytes(value) -> int:
+    return None if value is None else int(value) << 20
+
+
+def read_header(source) -> ImageHeader:
+    """Путь или файловый объект -> ImageHeader; ValueError, если это не изображение"""
+    try:
+        with warnings.catch_warnings():
+            # Размер проверяет check_pixels по MAX_IMAGE_PIXELS, а не предупреждение PIL
+            warnings.simplefilter("ignore", PILImage.DecompressionBombWarning)
+            with PILImage.open(source) as header:
+                width, height = header.size
+                channels, bit_depth = _MODE_LAYOUT.get(header.mode, (3, 8))
+                return ImageHeader(header.format, width, height, channels, bit_depth)
+    except PILImage.DecompressionBombError as exc:
+        raise ValueError("Изображение слишком большое") from exc
+    except OSError as exc:
+        raise ValueError("Не удалось прочитать заголовок изображения") from exc
+
+
+def check_pixels(header: ImageHeader, max_pixels: int = None):
+    max_pixels = max_pixels if max_pixels is not None else _limits["max_pixels"]
+    if max_pixels is not None and header.width * header.height > max_pixels:
+        raise ValueError(
+            f"Изображение {header.width}x{header.height} больше допустимых {max_pixels / 1e6:.0f} Мп"
+        )
+
+
+def decode_footprint(header: ImageHeader, factor: int = 1) -> int:
+    """
+    Память декода в BGR 8 бит. Кроме JPEG (libjpeg пишет строки сразу в результат),
+    формат с другой раскладкой сначала декодируется целиком в своей глубине
+    """
+    frame = -(-header.width // factor) * -(-header.height // factor) * 3
+    if header.format == "JPEG" or (header.channels, header.bit_depth) == (3, 8):
+        return frame
+    return frame + header.width * header.height * header.channels * max(1, header.bit_depth // 8)
+
+
+def upload_footprint(header: ImageHeader) -> int:
+    """Декод загрузки для анализа (с уменьшенным декодом JPEG, если он включён)"""
+    factor = 1
+    if REDUCED_DECODE and header.format == "JPEG":
+        factor = reduced_factor(max(header.width, header.height))
+    return decode_footprint(header, factor)
+
+
+def _fit(header: ImageHeader, plan: list, limit: int, factor: int = 1):
+    """(режим, оценка) плана на декоде с уменьшением factor либо None"""
+    shape = (-(-header.height // factor), -(-header.width // factor))
+    decode = decode_footprint(header, factor)
+    full = max(decode, full_frame_footprint(shape, plan))
+    if limit is None or full <= limit:
+        return FULL, full
+    try:
+        band_rows = band_rows_for_budget(shape, plan, limit)
+    except ValueError:
+        return None
+    tiled = max(decode, tiled_footprint(shape, plan, band_rows))
+    return (TILED, tiled) if tiled <= limit else None
+
+
+def plan_admission(header: ImageHeader, plan: list, max_memory_mb: int = None) -> Admission:
+    """Как обработать оригинал с этим заголовком в лимите памяти; ValueError, если никак"""
+    check_pixels(header)
+    limit = _megabytes(max_memory_mb)
+
+    fitted = _fit(header, plan, limit)
+    if fitted is not None:
+        return Admission(fitted[0], fitted[1], 1)
+
+    if header.format == "JPEG":
+        for factor in _DOWNSAMPLE_FACTORS:
+            fitted = _fit(header, plan, limit, factor)
+            if fitted is not None:
+                return Admission(DOWNSAMPLE, fitted[1], factor)
+
+    raise ValueError(
+        f"Изображение {header.width}x{header.height} не помещается в лимит памяти "
+        f"{max_memory_mb} МБ даже в полосовом режиме"
+    )
+
+
+def init_admission(app):
+    _limits["max_pixels"] = app.config.get("MAX_IMAGE_PIXELS", DEFAULT_MAX_PIXELS)
+    decode_budget.limit = _megabytes(app.config.get("UPLOAD_DECODE_BUDGET_MB"))
@@ -1,17 +1,26 @@
 from extensions import db
 from models.image_analysis import ImageAnalysis
+from services.image_analysis import analyzer_version as default_analyzer_version
+from services.instrumentation import timed
 
 
-def save_analysis(image_id: int, analysis_data: dict) -> ImageAnalysis:
+def save_analysis(image_id: int, analysis_data: dict, content_digest: str = None,
+                  analyzer_version: str = None, commit: bool = True) -> ImageAnalysis:
     analysis = ImageAnalysis(
         image_id=image_id,
         sharpness=analysis_data["sharpness"],
         brightness=analysis_data["brightness"],
         contrast=analysis_data["contrast"],
         noise=analysis_data["noise"],
+        color_balance=analysis_data.get("color_balance"),
+        overall_quality=analysis_data.get("overall_quality"),
+        content_digest=content_digest,
+        analyzer_version=analyzer_version or default_analyzer_version(),
     )
 
     db.session.add(analysis)
-    db.session.commit()
+    if commit:
+        with timed("iqa_db_commit_seconds", route="save_analysis"):
+            db.session.commit()
 
     return analysis
@@ -0,0 +1,189 @@
+"""
+Автоподбор силы этапов: перебор небольшой сетки вместо формулы auto_improve.
+
+Варианты — все сочетания значений SEARCH_GRID (None — этап пропускается)
+в порядке этапов плана. Перебор идёт в глубину на кадре анализа
+(ANALYSIS_MAX_SIDE), поэтому общий префикс считается один раз: denoise —
+по разу на значение, яркость — на каждый результат denoise и т.д.; размытие
+unsharp — одно на все силы sharpen. Промежуточные кадры строятся лениво:
+после ранней остановки оставшиеся префиксы не считаются вовсе.
+
+Каждый вариант оценивается fast-профилем анализа по массиву в памяти
+(overall_quality). Перебор останавливается на первом варианте с оценкой не
+ниже target либо после max_candidates оценок; побеждает лучший из
+оценённых, и только его план выполняется на полном кадре (process_image).
+
+Первым оценивается исходный кадр: если он уже не хуже target, план пустой.
+
+    python -m services.auto_tune PATH [PATH ...] [--target 65] [--max-candidates N]
+"""
+import time
+from collections import namedtuple
+
+from services.image_analysis import FAST, AnalysisContext, analyze_context, analyzer_version
+from services.image_processing import adjust_brightness, denoise_image, enhance_contrast, unsharp_blur, unsharp_mask
+from services.instrumentation import registry, timed
+
+
+# (этап, параметр, значения) в порядке выполнения; мягкие значения — первыми
+SEARCH_GRID = (
+    ("denoise", "strength", (None, 30, 50)),
+    ("brightness", "gamma", (None, 0.85, 1.0, 1.2)),
+    ("contrast", "clip_limit", (None, 1.5, 2.5)),
+    ("sharpen", "strength", (None, 0.5, 1.0)),
+)
+
+DEFAULT_TARGET = 65.0
+# None — вся сетка (grid_size() оценок)
+DEFAULT_MAX_CANDIDATES = None
+
+# Для оценки памяти по заголовку (services/admission.py): победитель — подмножество этих этапов
+WORST_CASE_PLAN = [(stage, {param: values[-1]}) for stage, param, values in SEARCH_GRID]
+
+TuneResult = namedtuple("TuneResult", "plan score baseline candidates stopped_early")
+
+
+def grid_size() -> int:
+    size = 1
+    for _, _, values in SEARCH_GRID:
+        size *= len(values)
+    return size
+
+
+def search_settings(config) -> dict:
+    """Параметры перебора из конфига приложения — они же часть ключа производного"""
+    return {
+        "target": config.get("AUTO_TUNE_TARGET_QUALITY", DEFAULT_TARGET),
+        "max_candidates": config.get("AUTO_TUNE_MAX_CANDIDATES", DEFAULT_MAX_CANDIDATES),
+    }
+
+
+def search_plan(settings: dict) -> list:
+    """
+    План для ключа производного (services/storage.derivation_key): результат
+    определяется оригиналом, сеткой, параметрами перебора и версией fast-оценки —
+    после изменения метрик победитель может стать другим
+    """
+    grid = [[stage, param, list(values)] for stage, param, values in SEARCH_GRID]
+    return [("auto_tune", {"grid": grid, "scorer": analyzer_version(FAST), **settings})]
+
+
+def _apply(stage: str, frame, value):
+    if stage == "denoise":
+        return denoise_image(frame, strength=value)
+    if stage == "brightness":
+        return adjust_brightness(frame, gamma=value)
+    if stage == "contrast":
+        return enhance_contrast(frame, clip_limit=value)
+    raise ValueError(f"Неизвестный этап обработки: {stage}")
+
+
+def _variants(frame, depth: int = 0, prefix: tuple = ()):
+    """(план, кадр) всех вариантов сетки; кадр префикса общий для его продолжений"""
+    if depth == len(SEARCH_GRID):
+        yield list(prefix), frame
+        return
+
+    stage, param, values = SEARCH_GRID[depth]
+    blurred = None
+    for value in values:
+        if value is None:
+            yield from _variants(frame, depth + 1, prefix)
+            continue
+        if stage == "sharpen":
+            if blurred is None:
+                blurred = unsharp_blur(frame)
+            result = unsharp_mask(frame, blurred, value)
+        else:
+            result = _apply(stage, frame, value)
+        yield from _variants(result, depth + 1, prefix + ((stage, {param: value}),))
+
+
+def score_frame(frame) -> float:
+    return float(analyze_context(AnalysisContext(frame), profile=FAST)["overall_quality"])
+
+
+def search(image, target: float = DEFAULT_TARGET, max_candidates: int = DEFAULT_MAX_CANDIDATES) -> TuneResult:
+    """
+    Лучший план сетки для кадра image (BGR, любой размер — уменьшается до кадра анализа).
+    target / max_candidates — None, чтобы перебрать сетку целиком.
+    """
+    frame = AnalysisContext(image).bgr
+    best_plan, best_score, baseline = [], None, None
+    candidates = 0
+    stopped_early = False
+
+    with timed("iqa_auto_tune_seconds"):
+        for plan, variant in _variants(frame):
+            score = score_frame(variant)
+            candidates += 1
+            if baseline is None:
+                baseline = score
+            if best_score is None or score > best_score:
+                best_plan, best_score = plan, score
+            if target is not None and score >= target:
+                stopped_early = True
+                break
+            if max_candidates is not None and candidates >= max_candidates:
+                break
+
+    registry.inc("iqa_auto_tune_candidates_total", candidates)
+    return TuneResult(best_plan, best_score, baseline, candidates, stopped_early)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    import cv2
+
+    from services.image_analysis import load_backends
+    from services.image_processing import compile_plan, execute_plan
+
+    parser = argparse.ArgumentParser(
+        prog="python -m services.auto_tune",
+        description="Перебор сетки сил этапов: победитель, число оценок и время",
+    )
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET, help="ранняя остановка; < 0 — без неё")
+    parser.add_argument("--max-candidates", type=int, default=DEFAULT_MAX_CANDIDATES, help="по умолчанию — вся сетка")
+    args = parser.parse_args()
+
+    # Импорт бэкендов метрик не должен попасть во время первого перебора
+    load_backends()
+    for path in args.paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(json.dumps({"path": path, "error": "не удалось загрузить изображение"}, ensure_ascii=False))
+            continue
+
+        started = time.perf_counter()
+        tuned = search(
+            image,
+            target=args.target if args.target >= 0 else None,
+            max_candidates=args.max_candidates,
+        )
+        search_s = time.perf_counter() - started
+
+        # Для сравнения — план формулы auto_improve, оценённый так же
+        ctx = AnalysisContext(image)
+        formula_plan = compile_plan({"auto_improve": True}, analyze_context(ctx, profile=FAST))
+        formula_score = score_frame(execute_plan(ctx.bgr.copy(), formula_plan))
+
+        started = time.perf_counter()
+        execute_plan(image, tuned.plan)
+        render_s = time.perf_counter() - started
+
+        print(json.dumps({
+            "path": path,
+            "plan": tuned.plan,
+            "score": round(tuned.score, 2),
+            "baseline": round(tuned.baseline, 2),
+            "formula_plan": formula_plan,
+            "formula_score": round(formula_score, 2),
+            "candidates": tuned.candidates,
+            "grid": grid_size(),
+            "stopped_early": tuned.stopped_early,
+            "search_s": round(search_s, 3),
+            "render_s": round(render_s, 3),
+        }, ensure_ascii=False))
@@ -0,0 +1,277 @@
+"""
+Пакетный анализ архивов изображений на всех ядрах.
+
+    python -m services.batch ARCHIVE_DIR --output scores.jsonl
+    python -m services.batch manifest.txt --output scores.csv --workers 16 --chunksize 32
+    python -m services.batch ARCHIVE_DIR --output scores.jsonl --process --output-dir out/
+    python -m services.batch ARCHIVE_DIR --output scores.jsonl --vectorized
+
+Вход — каталоги (обходятся рекурсивно) и/или файлы-манифесты со списком путей,
+по одному на строку. Результаты дописываются в JSONL/CSV по мере готовности,
+а обработанные пути — в файл-чекпоинт, поэтому прерванный запуск продолжается
+с того же места повторной командой.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from itertools import islice
+from multiprocessing import Pool
+
+from services.batch_metrics import analyze_batch
+from services.decision_engine import recommend_actions
+from services.image_analysis import PRECISE, PROFILES, analyze_image, decode_for_analysis
+from services.image_processing import process_image
+from services.threads import configure_threads, cpu_budget
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+
+METRIC_FIELDS = ["sharpness", "brightness", "contrast", "noise", "color_balance", "overall_quality"]
+ACTION_FIELDS = ["enhance_brightness", "sharpen", "denoise", "confidence"]
+CSV_FIELDS = ["path", "status", "seconds"] + METRIC_FIELDS + ACTION_FIELDS + ["processed_filename", "error"]
+
+
+def iter_inputs(inputs):
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(root, name)
+        else:
+            with open(item, encoding="utf-8") as manifest:
+                for line in manifest:
+                    path = line.strip()
+                    if path and not path.startswith("#"):
+                        yield path
+
+
+def load_checkpoint(path: str) -> set:
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def output_filename(path: str) -> str:
+    """
+    Имя результата в общем --output-dir: одноимённые файлы из разных каталогов
+    архива не перезаписывают друг друга, а повторный запуск пишет в то же имя
+    """
+    path_digest = hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+    return f"processed_{path_digest}_{os.path.basename(path)}"
+
+
+def _apply_decisions(row, metrics, path, process_options):
+    actions = recommend_actions(metrics)
+    row.update({k: actions[k] for k in ACTION_FIELDS})
+
+    if process_options:
+        row["processed_filename"] = process_image(
+            image_path=path,
+            actions=actions,
+            metrics=metrics,
+            output_filename=output_filename(path),
+            **process_options,
+        )
+
+
+def _error_text(exc):
+    return "".join(traceback.format_exception_only(type(exc), exc)).strip()
+
+
+def _error_row(row, exc):
+    row["status"] = "error"
+    row["error"] = _error_text(exc)
+
+
+def _score_one(task):
+    path, options = task
+    started = time.perf_counter()
+    row = {"path": path, "status": "ok"}
+    try:
+        metrics = analyze_image(path, profile=options["profile"])
+        row.update({k: float(v) for k, v in metrics.items()})
+        _apply_decisions(row, metrics, path, options["process"])
+    except Exception as exc:  # одна битая картинка не должна останавливать архив
+        _error_row(row, exc)
+    row["seconds"] = round(time.perf_counter() - started, 6)
+    return row
+
+
+def _analyze_rows(rows, images, profile):
+    """
+    analyze_batch для пачки; если пачка падает, каждое изображение считается
+    отдельно — ошибка остаётся в строке своего файла, как в _score_one
+    """
+    try:
+        return analyze_batch(images, profile=profile)
+    except Exception:
+        metrics_list = []
+        for row, image in zip(rows, images):
+            try:
+                metrics_list.append(analyze_batch([image], profile=profile)[0])
+            except Exception as exc:
+                _error_row(row, exc)
+                metrics_list.append(None)
+        return metrics_list
+
+
+def _score_chunk(task):
+    """Векторизованный путь: пачка путей декодируется и оценивается одним analyze_batch"""
+    paths, options = task
+    started = time.perf_counter()
+    rows, decoded, images = [], [], []
+    for path in paths:
+        row = {"path": path, "status": "ok"}
+        try:
+            image = decode_for_analysis(path)
+            if image is None:
+                raise ValueError("Не удалось загрузить изображение")
+        except Exception as exc:
+            _error_row(row, exc)
+        else:
+            decoded.append(row)
+            images.append(image)
+        rows.append(row)
+
+    metrics_list = _analyze_rows(decoded, images, options["profile"]) if images else []
+    for row, metrics in zip(decoded, metrics_list):
+        if metrics is None:
+            continue
+        row.update(metrics)
+        try:
+            _apply_decisions(row, metrics, row["path"], options["process"])
+        except Exception as exc:
+            _error_row(row, exc)
+
+    # Время пачки делится поровну между её изображениями
+    per_image = round((time.perf_counter() - started) / max(len(rows), 1), 6)
+    for row in rows:
+        row["seconds"] = per_image
+    return rows
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_results(pool, paths, options, chunksize, vectorized):
+    if not vectorized:
+        tasks = ((path, options) for path in paths)
+        yield from pool.imap_unordered(_score_one, tasks, chunksize=chunksize)
+        return
+
+    # Воркеру уходит сразу пачка путей, метрики считаются по стеку миниатюр
+    tasks = ((chunk, options) for chunk in _chunked(paths, chunksize))
+    for rows in pool.imap_unordered(_score_chunk, tasks):
+        yield from rows
+
+
+class ResultWriter:
+    def __init__(self, output_path: str, fmt: str):
+        self.fmt = fmt
+        new_file = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        self._file = open(output_path, "a", encoding="utf-8", newline="")
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.DictWriter(self._file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if new_file:
+                self._csv.writeheader()
+
+    def write(self, row: dict):
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def run_batch(inputs, output_path: str, fmt: str = "jsonl", workers: int = None,
+              chunksize: int = 16, process_dir: str = None, checkpoint_path: str = None,
+              vectorized: bool = False, max_memory_mb: int = None, profile: str = PRECISE) -> dict:
+    checkpoint_path = checkpoint_path or output_path + ".ckpt"
+    done = load_checkpoint(checkpoint_path)
+
+    options = {"profile": profile, "process": None}
+    if process_dir:
+        os.makedirs(process_dir, exist_ok=True)
+        options["process"] = {"output_dir": process_dir, "max_memory_mb": max_memory_mb}
+
+    pending = (path for path in iter_inputs(inputs) if path not in done)
+
+    writer = ResultWriter(output_path, fmt)
+    stats = {"ok": 0, "error": 0, "skipped": len(done)}
+    started = time.perf_counter()
+    try:
+        # Ядра делятся между процессами пула, как у JobRunner (services/threads.py)
+        processes = workers or os.cpu_count() or 1
+        threads = max(1, cpu_budget() // processes)
+        with Pool(processes=processes, initializer=configure_threads, initargs=(threads,)) as pool, \
+                open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            for row in _iter_results(pool, pending, options, chunksize, vectorized):
+                writer.write(row)
+                # Чекпоинт пишется после результата: при обрыве строка может повториться, но не потеряться
+                checkpoint.write(row["path"] + "\n")
+                checkpoint.flush()
+                stats[row["status"]] += 1
+    finally:
+        writer.close()
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m services.batch", description="Пакетный анализ изображений")
+    parser.add_argument("inputs", nargs="+", help="каталоги с изображениями или файлы-манифесты")
+    parser.add_argument("--output", required=True, help="файл результатов (.jsonl или .csv)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="по умолчанию — по расширению --output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="число процессов (по умолчанию все ядра)")
+    parser.add_argument("--chunksize", type=int, default=16, help="сколько путей отдавать воркеру за раз")
+    parser.add_argument("--process", action="store_true", help="также применять рекомендованные улучшения")
+    parser.add_argument("--output-dir", help="куда писать обработанные изображения (для --process)")
+    parser.add_argument("--profile", choices=PROFILES, default=PRECISE,
+                        help="профиль анализа (по умолчанию precise — для аудитов)")
+    parser.add_argument("--max-memory-mb", type=int,
+                        help="лимит памяти на обработку одного изображения (большие кадры — полосами)")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="считать метрики пачками по --chunksize изображений (services/batch_metrics.py)")
+    parser.add_argument("--checkpoint", help="файл чекпоинта (по умолчанию OUTPUT.ckpt)")
+    args = parser.parse_args(argv)
+
+    if args.process and not args.output_dir:
+        parser.error("--process требует --output-dir")
+
+    fmt = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    stats = run_batch(
+        args.inputs,
+        output_path=args.output,
+        fmt=fmt,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        process_dir=args.output_dir if args.process else None,
+        checkpoint_path=args.checkpoint,
+        vectorized=args.vectorized,
+        max_memory_mb=args.max_memory_mb,
+        profile=args.profile,
+    )
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Векторизованный расчёт метрик сразу для пачки изображений.
+
+Изображения приводятся к размеру анализа (fit_analysis_size), группируются
+по форме и складываются в массив (N, H, W, 3); яркость, контраст, энтропия
+гистограммы, дисперсия Лапласиана, Собель и баланс цвета считаются для всей
+группы одним набором NumPy-операций. Результаты совпадают со скалярными
+функциями из services/image_analysis.py в пределах SCALAR_TOLERANCE.
+"""
+import cv2
+import numpy as np
+
+from services.image_analysis import (
+    FAST,
+    AnalysisContext,
+    analyze_context,
+    decode_for_analysis,
+    fast_noise_score,
+    fit_analysis_size,
+    noise_score,
+)
+
+
+SCALAR_TOLERANCE = 1e-6
+DEFAULT_BATCH_SIZE = 64
+
+
+def _tall(stack):
+    # (N, H, W, ...) -> (N*H, W, ...): попиксельные операции OpenCV идут одним вызовом на всю группу
+    n, h = stack.shape[:2]
+    return stack.reshape((n * h,) + stack.shape[2:])
+
+
+def _gray_stack(stack):
+    n, h, w = stack.shape[:3]
+    return cv2.cvtColor(_tall(stack), cv2.COLOR_BGR2GRAY).reshape(n, h, w)
+
+
+def _histograms(gray):
+    return np.stack([np.bincount(row, minlength=256) for row in gray.reshape(gray.shape[0], -1)])
+
+
+def _hist_percentiles(hist, percentiles):
+    # np.percentile(method="linear") по гистограмме, без сортировки пикселей
+    total = hist[0].sum()
+    cumulative = np.cumsum(hist, axis=1)
+    positions = np.asarray(percentiles, dtype=np.float64) / 100 * (total - 1)
+    lower = np.floor(positions)
+    upper = np.minimum(lower + 1, total - 1)
+
+    def value_at(index):
+        return np.argmax(cumulative[:, :, None] > index[None, None, :], axis=1)
+
+    low_values = value_at(lower)
+    return low_values + (positions - lower) * (value_at(upper) - low_values)
+
+
+def _entropy(hist):
+    # То же, что scipy.stats.entropy(hist + 1e-10) построчно
+    p = hist + 1e-10
+    p = p / p.sum(axis=1, keepdims=True)
+    return -(p * np.log(p)).sum(axis=1)
+
+
+def _masked_var(values, border):
+    # Дисперсия по каждому изображению без строк-рамок: (N, H+2*border, W) -> (N,)
+    inner = values[:, border:-border, :]
+    count = inner.shape[1] * inner.shape[2]
+    total = inner.sum(axis=(1, 2), dtype=np.float64)
+    squares = np.einsum("ijk,ijk->i", inner, inner, dtype=np.float64)
+    return squares / count - (total / count) ** 2
+
+
+def _laplacian_var(gray):
+    # cv2.Laplacian(ksize=1), BORDER_REFLECT_101. Изображения в высоком кадре разделены
+    # собственными отражёнными строками, поэтому ядро не смешивает соседей по пачке
+    n, h, w = gray.shape
+    padded = np.pad(gray, ((0, 0), (1, 1), (0, 0)), mode="reflect")
+    lap = cv2.Laplacian(_tall(padded), cv2.CV_64F)
+    return _masked_var(lap.reshape(n, h + 2, w), 1)
+
+
+def _sobel_var(gray):
+    # skimage.filters.sobel = img_as_float + ядра [1,2,1]/4 x [1,0,-1], |grad| / sqrt(2), mode="reflect".
+    # Считаем целочисленный cv2.Sobel (без /4/255) и масштабируем уже дисперсию
+    n, h, w = gray.shape
+    padded = _tall(np.pad(gray, ((0, 0), (1, 1), (0, 0)), mode="symmetric"))
+    grad_x = cv2.Sobel(padded, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_REFLECT)
+    grad_y = cv2.Sobel(padded, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_REFLECT)
+    magnitude = cv2.magnitude(grad_x, grad_y).reshape(n, h + 2, w)
+    scale = 1 / (4 * 255 * np.sqrt(2))
+    return _masked_var(magnitude, 1) * scale * scale
+
+
+def _score_stack(stack) -> dict:
+    n, h, w = stack.shape[:3]
+    gray = _gray_stack(stack)
+    hist = _histograms(gray)
+
+    # mean/std по гистограмме — точные целочисленные суммы
+    levels = np.arange(256, dtype=np.float64)
+    count = h * w
+    mean = hist @ levels / count
+    std = np.sqrt(np.maximum(hist @ (levels ** 2) / count - mean ** 2, 0))
+
+    # Резкость
+    combined = (_laplacian_var(gray) + _sobel_var(gray) * 100) / 2
+    sharpness = np.minimum(100, np.log1p(combined) * 10)
+
+    # Яркость
+    brightness = np.clip((mean / 255 * 100) * (_entropy(hist) / np.log2(256)), 0, 100)
+
+    # Контраст (is_low_contrast: перцентили 1/99 относительно диапазона uint8)
+    low, high = _hist_percentiles(hist, [1, 99]).T
+    is_low = (high - low) / 255 < 0.05
+    safe_mean = np.where(mean == 0, 1, mean)
+    contrast = np.where(is_low, 0.5, 1.0) * (std / safe_mean * 200)
+    contrast = np.where(mean == 0, 0.0, np.clip(contrast, 0, 100))
+
+    # Баланс цвета: суммы по строкам одним cv2.reduce, затем по изображениям
+    hsv = cv2.cvtColor(_tall(stack), cv2.COLOR_BGR2HSV)
+    row_sums = cv2.reduce(hsv, 1, cv2.REDUCE_SUM, dtype=cv2.CV_64F).reshape(n, h, 3)
+    saturation_mean = row_sums[:, :, 1].sum(axis=1) / count
+    row_sums = cv2.reduce(_tall(stack), 1, cv2.REDUCE_SUM, dtype=cv2.CV_64F).reshape(n, h, 3)
+    balance_std = (row_sums.sum(axis=1) / count).std(axis=1)
+    color_balance = (saturation_mean / 255 * 50) + np.maximum(0, 50 - balance_std)
+
+    return {
+        "sharpness": sharpness,
+        "brightness": brightness,
+        "contrast": contrast,
+        "color_balance": color_balance,
+    }
+
+
+def analyze_batch(images, include_noise: bool = True, batch_size: int = DEFAULT_BATCH_SIZE,
+                  profile: str = None) -> list:
+    """
+    images — BGR-массивы любого размера. Возвращает список словарей метрик
+    в исходном порядке, в том же формате, что analyze_image.
+    Шум не векторизуется и считается поштучно (wavelet или, для FAST, Immerkær).
+    """
+    estimate_noise = fast_noise_score if profile == FAST else noise_score
+
+    normalized = []
+    for image in images:
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        normalized.append(fit_analysis_size(image))
+
+    buckets = {}
+    for index, image in enumerate(normalized):
+        buckets.setdefault(image.shape, []).append(index)
+
+    results = [None] * len(normalized)
+    for indices in buckets.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            stack = np.stack([normalized[i] for i in chunk])
+            scores = _score_stack(stack)
+
+            for row, index in enumerate(chunk):
+                metrics = {
+                    "sharpness": float(scores["sharpness"][row]),
+                    "brightness": float(scores["brightness"][row]),
+                    "contrast": float(scores["contrast"][row]),
+                }
+                if include_noise:
+                    metrics["noise"] = estimate_noise(AnalysisContext(normalized[index]))
+                metrics["color_balance"] = float(scores["color_balance"][row])
+                metrics["overall_quality"] = float(np.mean(list(metrics.values())))
+                results[index] = metrics
+
+    return results
+
+
+def load_batch(paths) -> list:
+    images = []
+    for path in paths:
+        image = decode_for_analysis(path)
+        if image is None:
+            raise ValueError(f"Не удалось загрузить изображение: {path}")
+        images.append(image)
+    return images
+
+
+def compare_with_scalar(images) -> dict:
+    """Максимальное расхождение с поштучным analyze_context по каждой метрике"""
+    batch = analyze_batch(images)
+    drift = {}
+    for image, vector in zip(images, batch):
+        scalar = analyze_context(AnalysisContext(image))
+        for key, value in vector.items():
+            drift[key] = max(drift.get(key, 0.0), abs(value - float(scalar[key])))
+    return drift
@@ -0,0 +1,452 @@
+"""
+Воспроизводимый бенчмарк анализа и обработки.
+
+    python -m services.benchmark --output bench.json
+    python -m services.benchmark --resolutions 0.3 2 --repeat 5 --output bench.json
+    python -m services.benchmark --output new.json --compare bench.json
+    python -m services.benchmark --encode --resolutions 12 --output encode.json
+    python -m services.benchmark --startup --repeat 5 --output startup.json
+
+Генерирует синтетические сцены (шум, размытие, тёмная, низкий контраст) на
+0.3 / 2 / 12 / 48 Мп и замеряет каждую calculate_*, analyze_image (оба профиля)
+и process_image для всех сочетаний ручных действий и auto_improve. Каждый случай
+идёт в свежем процессе, поэтому пиковый RSS относится к нему одному.
+Отчёт — JSON с p50/p99, пропускной способностью и памятью; --compare сверяет
+p50 с прошлым отчётом и завершается с кодом 1 при регрессии больше порога.
+--encode вместо этого сравнивает настройки кодирования результата: время и размер файла.
+--startup замеряет холодный старт процесса без прогрева и с ним (services/warmup.py).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import cv2
+import numpy as np
+
+from services import image_analysis
+from services.encoding import encode_image, resolve_encoding
+from services.image_processing import process_image
+
+
+SCENARIOS = ("noise", "blur", "dark", "low_contrast")
+RESOLUTIONS_MP = (0.3, 2, 12, 48)
+
+METRIC_TARGETS = (
+    "calculate_sharpness",
+    "calculate_brightness",
+    "calculate_contrast",
+    "calculate_noise",
+    "calculate_color_balance",
+)
+ANALYZE_TARGETS = ("analyze_image:precise", "analyze_image:fast")
+
+MANUAL_ACTIONS = ("enhance_brightness", "sharpen", "denoise")
+
+
+def action_combinations():
+    """Все подмножества ручных действий (включая пустое — только decode + encode) и auto_improve"""
+    combos = []
+    for flags in product((False, True), repeat=len(MANUAL_ACTIONS)):
+        combos.append(dict(zip(MANUAL_ACTIONS, flags), auto_improve=False))
+    combos.append({action: False for action in MANUAL_ACTIONS} | {"auto_improve": True})
+    return combos
+
+
+def combo_name(actions: dict) -> str:
+    if actions.get("auto_improve"):
+        return "auto_improve"
+    return "+".join(a for a in MANUAL_ACTIONS if actions.get(a)) or "none"
+
+
+def frame_size(megapixels: float):
+    """Кадр 4:3 заданной площади"""
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    return width, int(round(width * 3 / 4))
+
+
+def synthetic_scene(scenario: str, megapixels: float, seed: int = 0):
+    """
+    Сцена строится в 1024 px и растягивается до нужного размера, затем
+    к ней применяется дефект сценария — без float-копий полного кадра.
+    """
+    rng = np.random.default_rng(seed)
+    base_w, base_h = 1024, 768
+    yy, xx = np.mgrid[0:base_h, 0:base_w].astype(np.float32)
+    base = np.empty((base_h, base_w, 3), dtype=np.float32)
+    for channel in range(3):
+        fx, fy = rng.uniform(0.005, 0.04, size=2)
+        base[:, :, channel] = 128 + 90 * np.sin(xx * fx + rng.uniform(0, 6)) * np.cos(yy * fy)
+    for _ in range(40):
+        center = (int(rng.integers(0, base_w)), int(rng.integers(0, base_h)))
+        color = tuple(float(c) for c in rng.uniform(0, 255, size=3))
+        cv2.circle(base, center, int(rng.integers(3, 80)), color, -1)
+    base = np.clip(base, 0, 255).astype(np.uint8)
+
+    width, height = frame_size(megapixels)
+    image = cv2.resize(base, (width, height), interpolation=cv2.INTER_LINEAR)
+    # Мелкая текстура, чтобы у кадра на любом разрешении была резкость
+    texture = np.empty((height, width, 3), dtype=np.int16)
+    cv2.setRNGSeed(seed)
+    cv2.randn(texture, 0, 4)
+    image = cv2.add(image, texture, dtype=cv2.CV_8U)
+
+    if scenario == "noise":
+        cv2.randn(texture, 0, 22)
+        image = cv2.add(image, texture, dtype=cv2.CV_8U)
+    elif scenario == "blur":
+        image = cv2.GaussianBlur(image, (0, 0), max(1.5, 3.0 * width / 1024))
+    elif scenario == "dark":
+        image = cv2.convertScaleAbs(image, alpha=0.3)
+    elif scenario == "low_contrast":
+        image = cv2.convertScaleAbs(image, alpha=0.25, beta=96)
+    else:
+        raise ValueError(f"Неизвестный сценарий: {scenario}")
+    return image
+
+
+def _reset_peak_rss():
+    """
+    Дочерний процесс наследует пик RSS родителя (через fork/exec), поэтому в Linux
+    пик сбрасывается явно; на других системах ru_maxrss остаётся как есть.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss в Linux — КБ, в macOS — байты
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _target_call(target: str, image_path: str, output_dir: str):
+    if target.startswith("analyze_image:"):
+        profile = target.split(":", 1)[1]
+        return lambda: image_analysis.analyze_image(image_path, profile=profile)
+    if target.startswith("process_image:"):
+        actions = next(a for a in action_combinations() if combo_name(a) == target.split(":", 1)[1])
+        metrics = image_analysis.analyze_image(image_path) if actions["auto_improve"] else None
+        return lambda: process_image(image_path, actions, output_dir, metrics=metrics)
+    return lambda: getattr(image_analysis, target)(image_path)
+
+
+def run_case(task) -> dict:
+    """Выполняется в отдельном процессе: прогрев, repeat замеров, пиковая память"""
+    target, image_path, output_dir, repeat = task
+    call = _target_call(target, image_path, output_dir)
+    _reset_peak_rss()
+    baseline_rss = _peak_rss_mb()
+
+    call()  # прогрев: ленивые импорты, кэши OpenCV
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+
+    return {"timings": timings, "baseline_rss_mb": baseline_rss, "peak_rss_mb": _peak_rss_mb()}
+
+
+def summarize(timings, megapixels: float) -> dict:
+    seconds = np.asarray(timings)
+    mean = float(seconds.mean())
+    return {
+        "p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "p99_ms": float(np.percentile(seconds, 99) * 1000),
+        "mean_ms": mean * 1000,
+        "min_ms": float(seconds.min() * 1000),
+        "images_per_s": 1 / mean if mean else None,
+        "megapixels_per_s": megapixels / mean if mean else None,
+    }
+
+
+def case_key(case: dict) -> tuple:
+    return case["target"], case["scenario"], case["megapixels"]
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+        "numpy": np.__version__,
+    }
+
+
+def run_benchmark(resolutions=RESOLUTIONS_MP, scenarios=SCENARIOS, targets=None,
+                  repeat: int = 3, seed: int = 0, image_format: str = "jpg", log=None) -> dict:
+    if targets is None:
+        targets = list(METRIC_TARGETS) + list(ANALYZE_TARGETS) + [
+            f"process_image:{combo_name(a)}" for a in action_combinations()
+        ]
+    if log is None:
+        log = lambda message: None  # noqa: E731
+
+    cases = []
+    started = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="iqa-bench-") as workdir:
+        output_dir = os.path.join(workdir, "out")
+        os.makedirs(output_dir)
+
+        for megapixels, scenario in product(resolutions, scenarios):
+            image = synthetic_scene(scenario, megapixels, seed=seed)
+            height, width = image.shape[:2]
+            image_path = os.path.join(workdir, f"{scenario}_{megapixels}mp.{image_format}")
+            cv2.imwrite(image_path, image)
+            file_bytes = os.path.getsize(image_path)
+            del image
+
+            for target in targets:
+                # Один процесс на случай: ru_maxrss не смешивается с прошлыми замерами
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    measured = pool.submit(run_case, (target, image_path, output_dir, repeat)).result()
+
+                case = {
+                    "target": target,
+                    "scenario": scenario,
+                    "megapixels": megapixels,
+                    "width": width,
+                    "height": height,
+                    "file_bytes": file_bytes,
+                    "repeat": repeat,
+                    **summarize(measured["timings"], width * height / 1e6),
+                    "baseline_rss_mb": measured["baseline_rss_mb"],
+                    "peak_rss_mb": measured["peak_rss_mb"],
+                }
+                cases.append(case)
+                log(f"{target:48s} {scenario:13s} {megapixels:>5} Мп  p50 {case['p50_ms']:9.1f} мс  "
+                    f"RSS {case['peak_rss_mb']:7.1f} МБ")
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "settings": {"repeat": repeat, "seed": seed, "format": image_format},
+        "seconds": round(time.perf_counter() - started, 3),
+        "cases": cases,
+    }
+
+
+# Сетка настроек кодирования: имя случая -> (расширение, переопределения services.encoding)
+ENCODE_SETTINGS = {
+    **{f"png:{level}": (".png", {"format": "png", "png_compression": level}) for level in (0, 1, 3, 6, 9)},
+    **{f"jpg:{quality}": (".jpg", {"format": "jpg", "jpeg_quality": quality, "jpeg_progressive": False})
+       for quality in (75, 85, 92, 95)},
+    "jpg:92:progressive": (".jpg", {"format": "jpg", "jpeg_quality": 92, "jpeg_progressive": True}),
+    **{f"webp:{quality}": (".webp", {"format": "webp", "webp_quality": quality}) for quality in (75, 90)},
+    "webp:lossless": (".webp", {"format": "webp", "webp_quality": 101}),
+}
+
+
+def run_encode_benchmark(resolutions=RESOLUTIONS_MP, scenarios=SCENARIOS, settings=None,
+                         repeat: int = 3, seed: int = 0, log=None) -> dict:
+    """Время кодирования против размера файла для каждой настройки (в этом процессе, без RSS)"""
+    names = settings or list(ENCODE_SETTINGS)
+    if log is None:
+        log = lambda message: None  # noqa: E731
+
+    cases = []
+    started = time.perf_counter()
+    for megapixels, scenario in product(resolutions, scenarios):
+        image = synthetic_scene(scenario, megapixels, seed=seed)
+        height, width = image.shape[:2]
+        for name in names:
+            ext, overrides = ENCODE_SETTINGS[name]
+            resolved = resolve_encoding(overrides)
+            size = len(encode_image(image, ext, resolved))  # прогрев
+            timings = []
+            for _ in range(repeat):
+                begun = time.perf_counter()
+                encode_image(image, ext, resolved)
+                timings.append(time.perf_counter() - begun)
+
+            case = {
+                "target": f"encode:{name}",
+                "scenario": scenario,
+                "megapixels": megapixels,
+                "width": width,
+                "height": height,
+                "repeat": repeat,
+                "bytes": size,
+                "bits_per_pixel": size * 8 / (width * height),
+                **summarize(timings, width * height / 1e6),
+            }
+            cases.append(case)
+            log(f"{case['target']:48s} {scenario:13s} {megapixels:>5} Мп  p50 {case['p50_ms']:9.1f} мс  "
+                f"{size / 1024:9.0f} КБ")
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "settings": {"repeat": repeat, "seed": seed, "mode": "encode"},
+        "seconds": round(time.perf_counter() - started, 3),
+        "cases": cases,
+    }
+
+
+STARTUP_MODES = ("cold", "warm")
+STARTUP_STEPS = ("import_app_s", "warm_up_s", "first_analysis_s", "second_analysis_s")
+
+
+def run_startup_benchmark(resolutions=(2,), scenarios=("noise",), repeat: int = 3, seed: int = 0, log=None) -> dict:
+    """
+    Каждый замер — новый интерпретатор (python -m services.warmup --probe):
+    импорт приложения, прогрев (для warm) и два анализа. p50_ms — время от
+    запуска до первого результата анализа
+    """
+    if log is None:
+        log = lambda message: None  # noqa: E731
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    cases = []
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="iqa-bench-") as workdir:
+        for megapixels, scenario in product(resolutions, scenarios):
+            image = synthetic_scene(scenario, megapixels, seed=seed)
+            height, width = image.shape[:2]
+            image_path = os.path.join(workdir, f"{scenario}_{megapixels}mp.jpg")
+            cv2.imwrite(image_path, image)
+            del image
+
+            for mode in STARTUP_MODES:
+                command = [sys.executable, "-m", "services.warmup", "--probe", image_path]
+                if mode == "warm":
+                    command.append("--warm")
+                probes = []
+                for _ in range(repeat):
+                    completed = subprocess.run(command, cwd=project_root, capture_output=True, text=True, check=True)
+                    probes.append(json.loads(completed.stdout.splitlines()[-1]))
+
+                first_result = [p["import_app_s"] + p["warm_up_s"] + p["first_analysis_s"] for p in probes]
+                case = {
+                    "target": f"startup:{mode}",
+                    "scenario": scenario,
+                    "megapixels": megapixels,
+                    "width": width,
+                    "height": height,
+                    "repeat": repeat,
+                    **summarize(first_result, width * height / 1e6),
+                    **{f"{step[:-2]}_p50_ms": float(np.median([p[step] for p in probes]) * 1000)
+                       for step in STARTUP_STEPS},
+                    "peak_rss_mb": max(p["peak_rss_mb"] or 0 for p in probes),
+                }
+                cases.append(case)
+                log(f"{case['target']:48s} {scenario:13s} {megapixels:>5} Мп  p50 {case['p50_ms']:9.1f} мс  "
+                    f"(импорт {case['import_app_p50_ms']:.0f}, прогрев {case['warm_up_p50_ms']:.0f}, "
+                    f"первый анализ {case['first_analysis_p50_ms']:.0f})")
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "settings": {"repeat": repeat, "seed": seed, "mode": "startup"},
+        "seconds": round(time.perf_counter() - started, 3),
+        "cases": cases,
+    }
+
+
+def compare_reports(current: dict, baseline: dict, max_regression: float = 0.2) -> list:
+    """Случаи, где p50 вырос больше чем на max_regression (доля) относительно baseline"""
+    previous = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in current["cases"]:
+        old = previous.get(case_key(case))
+        if old is None or not old["p50_ms"]:
+            continue
+        ratio = case["p50_ms"] / old["p50_ms"]
+        if ratio > 1 + max_regression:
+            regressions.append({
+                "target": case["target"],
+                "scenario": case["scenario"],
+                "megapixels": case["megapixels"],
+                "baseline_p50_ms": old["p50_ms"],
+                "p50_ms": case["p50_ms"],
+                "ratio": round(ratio, 3),
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m services.benchmark", description="Бенчмарк анализа и обработки")
+    parser.add_argument("--output", required=True, help="JSON-отчёт")
+    parser.add_argument("--resolutions", type=float, nargs="+",
+                        help="мегапиксели (по умолчанию все; для --startup — 2)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS,
+                        help="сцены (по умолчанию все; для --startup — noise)")
+    parser.add_argument("--targets", nargs="+",
+                        help="что замерять: calculate_*, analyze_image:PROFILE, process_image:ДЕЙСТВИЯ (по умолчанию всё)")
+    parser.add_argument("--repeat", type=int, default=3, help="замеров на случай (после одного прогрева)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["jpg", "png"], default="jpg", help="формат входных файлов")
+    parser.add_argument("--encode", action="store_true",
+                        help="бенчмарк кодирования: время против размера файла для настроек ENCODE_SETTINGS")
+    parser.add_argument("--encode-settings", nargs="+", choices=list(ENCODE_SETTINGS),
+                        help="какие настройки кодирования замерять (по умолчанию все)")
+    parser.add_argument("--startup", action="store_true",
+                        help="холодный старт процесса: импорт, прогрев и первый анализ (без прогрева и с ним)")
+    parser.add_argument("--compare", help="прошлый отчёт для поиска регрессий")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимый рост p50 (доля)")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        report = run_startup_benchmark(
+            resolutions=args.resolutions or (2,),
+            scenarios=args.scenarios or ("noise",),
+            repeat=args.repeat,
+            seed=args.seed,
+            log=lambda message: print(message, file=sys.stderr),
+        )
+    elif args.encode:
+        report = run_encode_benchmark(
+            resolutions=args.resolutions or RESOLUTIONS_MP,
+            scenarios=args.scenarios or SCENARIOS,
+            settings=args.encode_settings,
+            repeat=args.repeat,
+            seed=args.seed,
+            log=lambda message: print(message, file=sys.stderr),
+        )
+    else:
+        report = run_benchmark(
+            resolutions=args.resolutions or RESOLUTIONS_MP,
+            scenarios=args.scenarios or SCENARIOS,
+            targets=args.targets,
+            repeat=args.repeat,
+            seed=args.seed,
+            image_format=args.format,
+            log=lambda message: print(message, file=sys.stderr),
+        )
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["regressions"] = compare_reports(report, json.load(f), args.max_regression)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if report.get("regressions"):
+        print(json.dumps(report["regressions"], ensure_ascii=False, indent=2), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
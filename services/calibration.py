@@ -0,0 +1,140 @@
+"""
+Калибровка fast-профиля анализа по precise.
+
+    python -m services.calibration ARCHIVE_DIR
+    python -m services.calibration --synthetic 300
+
+Для каждого изображения считает precise-метрики и сырые fast-оценки,
+подбирает линейное приведение fast -> precise (МНК) и печатает JSON:
+коэффициенты для FAST_CALIBRATION в services/image_analysis.py,
+корреляцию, среднюю ошибку до/после калибровки и долю совпадающих
+решений recommend_actions / auto-плана.
+"""
+import argparse
+import json
+import sys
+
+import cv2
+import numpy as np
+
+from services.batch import iter_inputs
+from services.decision_engine import recommend_actions
+from services.image_analysis import (
+    AnalysisContext,
+    FAST_CALIBRATION,
+    analyze_context,
+    load_context,
+    noise_score,
+    raw_fast_noise,
+    raw_fast_sharpness,
+    sharpness_score,
+)
+from services.image_processing import compile_plan
+
+
+CALIBRATED_METRICS = {
+    "sharpness": (sharpness_score, raw_fast_sharpness),
+    "noise": (noise_score, raw_fast_noise),
+}
+
+
+def synthetic_images(count: int, seed: int = 0):
+    """Сцены с разной степенью размытия, шума и экспозиции"""
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        height, width = rng.integers(256, 768, size=2)
+        yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+        image = np.zeros((height, width, 3), dtype=np.float32)
+        for channel in range(3):
+            fx, fy = rng.uniform(0.002, 0.05, size=2)
+            image[:, :, channel] = 128 + 90 * np.sin(xx * fx + rng.uniform(0, 6)) * np.cos(yy * fy)
+        for _ in range(rng.integers(5, 40)):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            color = tuple(float(c) for c in rng.uniform(0, 255, size=3))
+            cv2.circle(image, center, int(rng.integers(3, 80)), color, -1)
+
+        blur = rng.uniform(0, 3)
+        if blur > 0.3:
+            image = cv2.GaussianBlur(image, (0, 0), blur)
+        image = image * rng.uniform(0.3, 1.2) + rng.normal(0, rng.uniform(0, 25), image.shape)
+        yield np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _fit(precise, fast):
+    slope, intercept = np.polyfit(fast, precise, 1)
+    calibrated = np.clip(slope * fast + intercept, 0, 100)
+    return {
+        "slope": float(slope),
+        "intercept": float(intercept),
+        "pearson_r": float(np.corrcoef(precise, fast)[0, 1]),
+        "mae_raw": float(np.mean(np.abs(precise - fast))),
+        "mae_calibrated": float(np.mean(np.abs(precise - calibrated))),
+        "max_error_calibrated": float(np.max(np.abs(precise - calibrated))),
+    }
+
+
+def _decisions(metrics):
+    actions = recommend_actions(metrics)
+    auto_plan = compile_plan({"auto_improve": True}, metrics)
+    return (
+        (actions["enhance_brightness"], actions["sharpen"], actions["denoise"]),
+        tuple(stage for stage, _ in auto_plan),
+    )
+
+
+def calibrate(contexts) -> dict:
+    precise_rows, fast_rows = [], []
+    for ctx in contexts:
+        precise_rows.append(analyze_context(ctx))
+        fast_rows.append({name: raw(ctx) for name, (_, raw) in CALIBRATED_METRICS.items()})
+
+    if len(precise_rows) < 2:
+        raise ValueError("Для калибровки нужно хотя бы два изображения")
+
+    report = {"images": len(precise_rows), "metrics": {}}
+    coefficients = {}
+    for name in CALIBRATED_METRICS:
+        precise = np.array([row[name] for row in precise_rows])
+        fast = np.array([row[name] for row in fast_rows])
+        fit = _fit(precise, fast)
+        report["metrics"][name] = fit
+        coefficients[name] = (fit["slope"], fit["intercept"])
+
+    # Согласие решений: fast-метрики с новыми коэффициентами против precise
+    recommend_agree = plan_agree = 0
+    for precise, fast in zip(precise_rows, fast_rows):
+        mixed = dict(precise)
+        for name, (slope, intercept) in coefficients.items():
+            mixed[name] = float(np.clip(slope * fast[name] + intercept, 0, 100))
+        precise_decision, fast_decision = _decisions(precise), _decisions(mixed)
+        recommend_agree += precise_decision[0] == fast_decision[0]
+        plan_agree += precise_decision[1] == fast_decision[1]
+
+    report["agreement"] = {
+        "recommend_actions": recommend_agree / len(precise_rows),
+        "auto_plan": plan_agree / len(precise_rows),
+    }
+    report["current_calibration"] = {k: list(v) for k, v in FAST_CALIBRATION.items()}
+    report["suggested_calibration"] = {k: [round(v, 6) for v in c] for k, c in coefficients.items()}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m services.calibration", description=__doc__.split("\n")[1])
+    parser.add_argument("inputs", nargs="*", help="каталоги с изображениями или файлы-манифесты")
+    parser.add_argument("--synthetic", type=int, default=0, help="добавить N синтетических изображений")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if not args.inputs and not args.synthetic:
+        parser.error("укажите изображения или --synthetic N")
+
+    contexts = [load_context(path) for path in iter_inputs(args.inputs)]
+    contexts += [AnalysisContext(image) for image in synthetic_images(args.synthetic, args.seed)]
+
+    json.dump(calibrate(contexts), sys.stdout, indent=2, ensure_ascii=False)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,173 @@
+"""
+Решения по метрикам: рекомендации (RECOMMEND_RULES) и этапы авто-режима
+(AUTO_RULES) из таблиц services/rules.py.
+
+Строки image_analysis и processing_sessions хранят решения битовыми масками
+(decision_mask — рекомендации, auto_mask — авто-план) и версию правил. После
+изменения порогов маски пересчитываются массово:
+
+    python -m services.decision_engine redecide [--table sessions] [--chunk-size 20000] [--dry-run]
+
+Строки читаются серверным курсором пачками по chunk-size, решения для пачки
+считаются одной операцией NumPy, а обновляются только строки, у которых
+изменилась маска или версия правил.
+"""
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, event, or_, select
+
+from extensions import db
+from models.image_analysis import ImageAnalysis
+from models.processing_session import ProcessingSession
+from services.rules import AUTO, RECOMMEND, rules_version
+
+
 def recommend_actions(analysis: dict) -> dict:
-    actions = {
-        "enhance_brightness": False,
-        "sharpen": False,
-        "denoise": False,
-        "confidence": 0.0,
-        "summary": []
-    }
-
-    score = 0
-    total = 0
-
-    # Яркость
-    total += 1
-    if analysis["brightness"] < 90:
-        actions["enhance_brightness"] = True
-        actions["summary"].append("Изображение слишком тёмное")
-        score += 1
-
-    # Резкость
-    total += 1
-    if analysis["sharpness"] < 100:
-        actions["sharpen"] = True
-        actions["summary"].append("Низкая резкость")
-        score += 1
-
-    # Шум
-    total += 1
-    if analysis["noise"] > 15:
-        actions["denoise"] = True
-        actions["summary"].append("Присутствует шум")
-        score += 1
-
-    actions["confidence"] = round(score / total, 2)
+    actions = dict.fromkeys(RECOMMEND.actions, False)
+    actions["summary"] = []
+
+    fired = RECOMMEND.evaluate_one(analysis)
+    for rule in RECOMMEND.rules:
+        if fired[rule.action]:
+            actions[rule.action] = True
+            actions["summary"].append(rule.message)
+
+    actions["confidence"] = round(sum(fired.values()) / len(RECOMMEND.rules), 2)
     return actions
+
+
+def summarize_actions(actions: dict):
+    # Verdict и confidence
+    summary = []
+    if actions.get("auto_tune"):
+        summary.append("Автоподбор параметров")
+    elif actions.get("auto_improve"):
+        summary.append("Автоматический адаптивный режим")
+    if actions.get("enhance_brightness"):
+        summary.append("Повышена яркость")
+    if actions.get("sharpen"):
+        summary.append("Улучшена резкость")
+    if actions.get("denoise"):
+        summary.append("Убран шум")
+
+    verdict = " • ".join(summary) if summary else "Ничего не применено"
+    confidence = round(len(summary) / 4, 2)
+    return verdict, confidence
+
+
+# Столбцы метрик в каждой таблице; в processing_sessions шум лежит в blur_score,
+# а контраст — в color_balance_score (так их пишут маршруты)
+DECISION_TABLES = {
+    "analyses": (ImageAnalysis, {
+        "brightness": ImageAnalysis.brightness,
+        "sharpness": ImageAnalysis.sharpness,
+        "contrast": ImageAnalysis.contrast,
+        "noise": ImageAnalysis.noise,
+    }),
+    "sessions": (ProcessingSession, {
+        "brightness": ProcessingSession.brightness_score,
+        "sharpness": ProcessingSession.sharpness_score,
+        "contrast": ProcessingSession.color_balance_score,
+        "noise": ProcessingSession.blur_score,
+    }),
+}
+
+DEFAULT_CHUNK_SIZE = 20000
+
+
+def decision_masks(matrices) -> tuple:
+    """(decision_mask, auto_mask) для словаря {метрика: массив значений}"""
+    recommend = np.column_stack([matrices[metric] for metric in RECOMMEND.metrics])
+    auto = np.column_stack([matrices[metric] for metric in AUTO.metrics])
+    return RECOMMEND.masks(recommend), AUTO.masks(auto)
+
+
+def _set_masks(target, columns: dict):
+    values = {metric: [getattr(target, column.key)] for metric, column in columns.items()}
+    decision_mask, auto_mask = decision_masks({k: np.array(v, dtype=np.float64) for k, v in values.items()})
+    target.decision_mask = int(decision_mask[0])
+    target.auto_mask = int(auto_mask[0])
+    target.rules_version = rules_version()
+
+
+def _register_listeners():
+    for model, columns in DECISION_TABLES.values():
+        event.listen(model, "before_insert", lambda mapper, connection, target, columns=columns: _set_masks(target, columns))
+
+
+_register_listeners()
+
+
+def redecide(model, columns: dict, chunk_size: int = DEFAULT_CHUNK_SIZE, stale_only: bool = False) -> dict:
+    """
+    Пересчитывает маски всех строк таблицы. Ничего не коммитит.
+    stale_only — читать только строки с другой версией правил (по индексу rules_version).
+    """
+    version = rules_version()
+    table = model.__table__
+    stmt = (
+        select(table.c.id, table.c.decision_mask, table.c.auto_mask, table.c.rules_version, *columns.values())
+        .order_by(table.c.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    if stale_only:
+        stmt = stmt.where(or_(table.c.rules_version.is_(None), table.c.rules_version != version))
+
+    update = (
+        table.update()
+        .where(table.c.id == bindparam("row_id"))
+        .values(decision_mask=bindparam("new_decision"), auto_mask=bindparam("new_auto"), rules_version=version)
+    )
+
+    # changed — строки с новым решением; updated — записанные (включая смену только версии)
+    stats = {"rows": 0, "changed": 0, "updated": 0}
+    # yield_per -> серверный курсор (stream_results): в памяти одна пачка
+    for chunk in db.session.execute(stmt).partitions():
+        ids, old_decision, old_auto, versions, *metric_values = zip(*chunk)
+        matrices = {metric: np.array(values, dtype=np.float64) for metric, values in zip(columns, metric_values)}
+        new_decision, new_auto = decision_masks(matrices)
+
+        decided = (
+            (np.array(old_decision, dtype=np.float64) != new_decision)
+            | (np.array(old_auto, dtype=np.float64) != new_auto)
+        )
+        changed = decided | (np.array(versions, dtype=object) != version)
+        stats["rows"] += len(ids)
+        stats["changed"] += int(decided.sum())
+        stats["updated"] += int(changed.sum())
+        if changed.any():
+            ids = np.array(ids)
+            db.session.execute(update, [
+                {"row_id": int(row_id), "new_decision": int(decision), "new_auto": int(auto)}
+                for row_id, decision, auto in zip(ids[changed], new_decision[changed], new_auto[changed])
+            ])
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app import create_app
+
+    parser = argparse.ArgumentParser(prog="python -m services.decision_engine", description="Пересчёт решений")
+    parser.add_argument("command", choices=["redecide"])
+    parser.add_argument("--table", choices=sorted(DECISION_TABLES), action="append")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--stale-only", action="store_true", help="только строки другой версии правил")
+    parser.add_argument("--dry-run", action="store_true", help="посчитать изменения без записи")
+    args = parser.parse_args()
+
+    flask_app = create_app()
+    with flask_app.app_context():
+        report = {"rules_version": rules_version()}
+        for name in args.table or sorted(DECISION_TABLES):
+            started = time.perf_counter()
+            report[name] = redecide(*DECISION_TABLES[name], chunk_size=args.chunk_size, stale_only=args.stale_only)
+            report[name]["seconds"] = round(time.perf_counter() - started, 2)
+        if args.dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        print(json.dumps(report))
@@ -0,0 +1,164 @@
+"""
+Кодирование результатов обработки.
+
+Настройки — словарь (OUTPUT_ENCODING в конфиге, поверх него — параметры запроса):
+    format            "same" (как у оригинала), "png", "jpg" или "webp"
+    png_compression   0..9, уровень zlib
+    jpeg_quality      1..100
+    jpeg_progressive  bool
+    webp_quality      1..100; больше 100 — WebP без потерь
+
+encode_async кодирует на отдельном пуле потоков (cv2.imencode отпускает GIL),
+чтобы процесс-воркер мог сразу брать следующую задачу. Размер пула —
+IQA_ENCODE_WORKERS (по умолчанию 1 поток на процесс).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from services.instrumentation import record_written, timed
+
+
+FORMATS = ("same", "png", "jpg", "webp")
+
+DEFAULT_ENCODING = {
+    "format": "same",
+    "png_compression": 1,
+    "jpeg_quality": 92,
+    "jpeg_progressive": False,
+    "webp_quality": 90,
+}
+
+_RANGES = {
+    "png_compression": (0, 9),
+    "jpeg_quality": (1, 100),
+    "webp_quality": (1, 101),
+}
+
+_PARAMS = {
+    "png": ("png_compression",),
+    "jpg": ("jpeg_quality", "jpeg_progressive"),
+    "webp": ("webp_quality",),
+}
+
+_EXTENSIONS = {"png": ".png", "jpg": ".jpg", "webp": ".webp"}
+_FORMAT_BY_EXTENSION = {".png": "png", ".jpg": "jpg", ".jpeg": "jpg", ".webp": "webp"}
+
+# Сколько кадров может ждать кодирования в одном процессе: ограничивает память
+MAX_PENDING_ENCODES = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending_slots = threading.BoundedSemaphore(MAX_PENDING_ENCODES)
+
+
+def resolve_encoding(overrides: dict = None, base: dict = None) -> dict:
+    """Настройки по умолчанию <- base (конфиг) <- overrides (запрос), с проверкой"""
+    settings = dict(DEFAULT_ENCODING)
+    for layer in (base, overrides):
+        for key, value in (layer or {}).items():
+            if key not in DEFAULT_ENCODING:
+                raise ValueError(f"Неизвестный параметр кодирования: {key}")
+            if value is not None and value != "":
+                settings[key] = value
+
+    if settings["format"] not in FORMATS:
+        raise ValueError(f"Неизвестный формат результата: {settings['format']}")
+    for key, (low, high) in _RANGES.items():
+        try:
+            settings[key] = int(settings[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} должен быть целым числом") from None
+        if not low <= settings[key] <= high:
+            raise ValueError(f"{key} должен быть в диапазоне {low}..{high}")
+    if isinstance(settings["jpeg_progressive"], str):
+        settings["jpeg_progressive"] = settings["jpeg_progressive"].lower() in ("1", "true", "on", "yes")
+    settings["jpeg_progressive"] = bool(settings["jpeg_progressive"])
+    return settings
+
+
+def output_extension(settings: dict, source_name: str) -> str:
+    if settings is None or settings["format"] == "same":
+        ext = os.path.splitext(source_name)[1].lower()
+        return ext or ".png"
+    return _EXTENSIONS[settings["format"]]
+
+
+def imwrite_params(settings: dict, ext: str) -> list:
+    """Параметры cv2.imwrite/imencode для расширения; без settings — умолчания OpenCV"""
+    if settings is None:
+        return []
+    fmt = _FORMAT_BY_EXTENSION.get(ext.lower())
+    if fmt == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, settings["png_compression"]]
+    if fmt == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, settings["jpeg_quality"],
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(settings["jpeg_progressive"])]
+    if fmt == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, settings["webp_quality"]]
+    return []
+
+
+def encoding_key(settings: dict, ext: str) -> dict:
+    """Только параметры, влияющие на байты файла с этим расширением (для ключа результата)"""
+    if settings is None:
+        return {}
+    return {key: settings[key] for key in _PARAMS.get(_FORMAT_BY_EXTENSION.get(ext.lower()), ())}
+
+
+def encoding_from_form(form, base: dict = None) -> dict:
+    """Настройки запроса: output_format, quality (для jpg/webp), png_compression, progressive"""
+    overrides = {
+        "format": form.get("output_format"),
+        "png_compression": form.get("png_compression"),
+    }
+    quality = form.get("quality")
+    if quality:
+        overrides["jpeg_quality"] = overrides["webp_quality"] = quality
+    if "progressive" in form:
+        overrides["jpeg_progressive"] = form.get("progressive")
+    return resolve_encoding(overrides, base=base)
+
+
+def encode_image(image, ext: str, settings: dict = None) -> bytes:
+    with timed("iqa_encode_seconds", format=ext.lstrip(".")):
+        ok, encoded = cv2.imencode(ext, image, imwrite_params(settings, ext))
+    if not ok:
+        raise ValueError(f"Не удалось закодировать изображение в {ext}")
+    return encoded.tobytes()
+
+
+def write_image(path: str, image, settings: dict = None):
+    """Кодирует и записывает атомарно: читатель не увидит недописанный файл"""
+    data = encode_image(image, os.path.splitext(path)[1], settings)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    record_written("processing", path)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.environ.get("IQA_ENCODE_WORKERS", 1))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode")
+        return _executor
+
+
+def encode_async(path: str, image, settings: dict = None):
+    """
+    Запись на пуле кодирования -> Future. Если в очереди уже MAX_PENDING_ENCODES
+    кадров, вызов ждёт: обработка не обгоняет кодирование без ограничения памяти.
+    """
+    _pending_slots.acquire()
+    try:
+        future = _get_executor().submit(write_image, path, image, settings)
+    except BaseException:
+        _pending_slots.release()
+        raise
+    future.add_done_callback(lambda _: _pending_slots.release())
+    return future
@@ -1,25 +1,173 @@
+import importlib
+import io
+from functools import cached_property
+
 import cv2
 import numpy as np
-from skimage import restoration
-from skimage import exposure
-from skimage import filters
-from scipy.stats import entropy
+from PIL import Image as PILImage
 
+from services.instrumentation import instrumented, record_image, timed
+from services.threads import parallel_map
 
-def load_gray(image_path: str):
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError("Не удалось загрузить изображение")
+
+ANALYSIS_MAX_SIDE = 512
+
+# Бэкенды precise-метрик импортируются секунды, поэтому не при импорте модуля,
+# а при первом использовании (или заранее — services/warmup.py)
+HEAVY_MODULES = ("skimage.restoration", "skimage.exposure", "skimage.filters", "scipy.stats")
+
+
+def load_backends() -> tuple:
+    return tuple(importlib.import_module(name) for name in HEAVY_MODULES)
+
+# Меняйте при любом изменении формул метрик: кэш метрик (services/metrics_cache.py)
+# перестанет выдавать значения, посчитанные старой версией
+ANALYZER_VERSION = "3"
+
+# "precise" — эталонные метрики (wavelet-шум, skimage Sobel), для пакетных аудитов;
+# "fast" — оценки одной свёрткой OpenCV, для интерактивных загрузок
+PRECISE = "precise"
+FAST = "fast"
+PROFILES = (PRECISE, FAST)
+DEFAULT_PROFILE = PRECISE
+
+# Линейное приведение fast-оценок к шкале precise: score = a * fast + b.
+# Коэффициенты получены python -m services.calibration на синтетическом наборе
+FAST_CALIBRATION = {
+    "sharpness": (1.0, 0.0),
+    "noise": (0.992753, 0.81882),
+}
+
+# Для больших JPEG декодер сразу уменьшает кадр в 2/4/8 раз (масштабирование в DCT),
+# после чего остаётся небольшой resize до ANALYSIS_MAX_SIDE
+REDUCED_DECODE = True
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def reduced_decode_flag(source, min_side: int = ANALYSIS_MAX_SIDE) -> int:
+    """
+    Флаг imread/imdecode по заголовку (путь или файловый объект):
+    самый сильный уменьшенный декод, у которого большая сторона не меньше min_side
+    """
+    try:
+        with PILImage.open(source) as header:
+            if header.format != "JPEG":
+                return cv2.IMREAD_COLOR
+            max_side = max(header.size)
+    except (OSError, ValueError):
+        return cv2.IMREAD_COLOR
+
+    return reduced_flag(reduced_factor(max_side, min_side))
+
+
+def reduced_factor(max_side: int, min_side: int = ANALYSIS_MAX_SIDE) -> int:
+    """Во сколько раз уменьшать декод JPEG с большой стороной max_side (1 — не уменьшать)"""
+    for factor, _ in _REDUCED_FLAGS:
+        if max_side // factor >= min_side:
+            return factor
+    return 1
+
+
+def reduced_flag(factor: int) -> int:
+    return dict(_REDUCED_FLAGS).get(factor, cv2.IMREAD_COLOR)
+
+
+def decode_for_analysis(image_path: str, reduced_decode: bool = None):
+    """cv2.imread с уменьшенным декодом, если он включён; None, если файл не читается"""
+    if reduced_decode is None:
+        reduced_decode = REDUCED_DECODE
+    with timed("iqa_decode_seconds", source="analysis"):
+        flag = reduced_decode_flag(image_path) if reduced_decode else cv2.IMREAD_COLOR
+        image = cv2.imread(image_path, flag)
+    record_image("analysis", image, image_path)
+    return image
+
+
+def decode_bytes_for_analysis(data: bytes, reduced_decode: bool = None):
+    """То же, что decode_for_analysis, но из буфера в памяти (cv2.imdecode)"""
+    if reduced_decode is None:
+        reduced_decode = REDUCED_DECODE
+    with timed("iqa_decode_seconds", source="upload"):
+        flag = reduced_decode_flag(io.BytesIO(data)) if reduced_decode else cv2.IMREAD_COLOR
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    record_image("upload", image)
+    return image
+
+
+def fit_analysis_size(image):
     # Добавим resize для consistency (например, до 512x512 max), чтобы метрики были сравнимы
     height, width = image.shape[:2]
-    if max(height, width) > 512:
-        scale = 512 / max(height, width)
+    if max(height, width) > ANALYSIS_MAX_SIDE:
+        scale = ANALYSIS_MAX_SIDE / max(height, width)
         image = cv2.resize(image, (int(width * scale), int(height * scale)))
-    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
 
 
-def calculate_sharpness(image_path: str) -> float:
-    gray = load_gray(image_path)
+class AnalysisContext:
+    """
+    Изображение, декодированное один раз, и общие промежуточные данные метрик.
+    Цветовые плоскости и статистики считаются лениво и переиспользуются между метриками.
+    """
+
+    def __init__(self, bgr):
+        if bgr.ndim == 2:
+            bgr = cv2.cvtColor(bgr, cv2.COLOR_GRAY2BGR)
+        self.bgr = fit_analysis_size(bgr)
+
+    @classmethod
+    def from_path(cls, image_path: str, reduced_decode: bool = None) -> "AnalysisContext":
+        image = decode_for_analysis(image_path, reduced_decode)
+        if image is None:
+            raise ValueError("Не удалось загрузить изображение")
+        return cls(image)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, reduced_decode: bool = None) -> "AnalysisContext":
+        image = decode_bytes_for_analysis(data, reduced_decode) if data else None
+        if image is None:
+            raise ValueError("Не удалось загрузить изображение")
+        return cls(image)
+
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def hsv(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def mean(self) -> float:
+        return float(np.mean(self.gray))
+
+    @cached_property
+    def std(self) -> float:
+        return float(np.std(self.gray))
+
+    @cached_property
+    def hist(self):
+        from skimage import exposure
+
+        return exposure.histogram(self.gray)[0]
+
+
+def load_context(image_path: str, reduced_decode: bool = None) -> AnalysisContext:
+    return AnalysisContext.from_path(image_path, reduced_decode=reduced_decode)
+
+
+def load_gray(image_path: str):
+    return load_context(image_path).gray
+
+
+@instrumented("iqa_metric_seconds", metric="sharpness")
+def sharpness_score(ctx: AnalysisContext) -> float:
+    from skimage import filters
+
+    gray = ctx.gray
     # Улучшенная резкость: variance Laplacian + normalization
     lap_var = cv2.Laplacian(gray, cv2.CV_64F).var()
     # Добавим edge detection с Sobel для лучшей оценки
@@ -31,26 +179,29 @@ def calculate_sharpness(image_path: str) -> float:
     return float(score)
 
 
-def calculate_brightness(image_path: str) -> float:
-    gray = load_gray(image_path)
+@instrumented("iqa_metric_seconds", metric="brightness")
+def brightness_score(ctx: AnalysisContext) -> float:
+    from scipy.stats import entropy
+
     # Улучшенно: не просто mean, а с учетом exposure
-    mean_bright = np.mean(gray)
+    mean_bright = ctx.mean
     # Проверяем underexposed/overexposed с histogram
-    hist = exposure.histogram(gray)[0]
-    entropy_val = entropy(hist + 1e-10)  # Entropy для динамического диапазона
+    entropy_val = entropy(ctx.hist + 1e-10)  # Entropy для динамического диапазона
     # Нормализуем в 0-100, корректируем на entropy (high entropy = better distribution)
     score = (mean_bright / 255 * 100) * (entropy_val / np.log2(256))  # Normalize entropy to 0-1
     return float(min(100, max(0, score)))
 
 
-def calculate_contrast(image_path: str) -> float:
-    gray = load_gray(image_path)
+@instrumented("iqa_metric_seconds", metric="contrast")
+def contrast_score(ctx: AnalysisContext) -> float:
+    from skimage import exposure
+
     # Улучшенно: RMS contrast = std / mean (normalized)
-    if np.mean(gray) == 0:
+    if ctx.mean == 0:
         return 0.0
-    rms_contrast = np.std(gray) / np.mean(gray)
+    rms_contrast = ctx.std / ctx.mean
     # Добавим check low contrast от skimage
-    is_low = exposure.is_low_contrast(gray)
+    is_low = exposure.is_low_contrast(ctx.gray)
     # Нормализуем в 0-100: typical good RMS ~0.2-0.5, scale
     score = rms_contrast * 200  # Пример: 0.5 -> 100
     if is_low:
@@ -58,30 +209,74 @@ def calculate_contrast(image_path: str) -> float:
     return float(min(100, max(0, score)))
 
 
-def calculate_noise(image_path: str) -> float:
+@instrumented("iqa_metric_seconds", metric="noise")
+def noise_score(ctx: AnalysisContext) -> float:
     """
     Улучшенная оценка шума: используем wavelet-based estimation из skimage
     """
-    gray = load_gray(image_path)
+    from skimage import restoration
+
     # estimate_sigma возвращает std шума (Gaussian assumption)
-    sigma = restoration.estimate_sigma(gray, average_sigmas=True, channel_axis=None)
+    sigma = restoration.estimate_sigma(ctx.gray, average_sigmas=True, channel_axis=None)
     # Нормализуем: low noise ~0-5, high >20, invert to score 0-100 (higher = less noise)
     score = max(0, 100 - (sigma * 5))  # Scale: sigma=20 -> 0, sigma=0 ->100, подгони
     return float(score)
 
 
-def calculate_color_balance(image_path: str) -> float:
+def raw_fast_sharpness(ctx: AnalysisContext) -> float:
+    """Та же формула, что sharpness_score, но Laplacian и Sobel — float32 OpenCV"""
+    gray = ctx.gray
+    lap_var = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F))[1][0, 0] ** 2
+    # skimage.filters.sobel = ядра /4 на изображении /255 и модуль градиента /sqrt(2)
+    grad_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_REFLECT)
+    grad_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_REFLECT)
+    sobel_std = cv2.meanStdDev(cv2.magnitude(grad_x, grad_y))[1][0, 0] / (4 * 255 * np.sqrt(2))
+    combined = (lap_var + sobel_std ** 2 * 100) / 2
+    return float(min(100, np.log1p(combined) * 10))
+
+
+IMMERKAER_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+def raw_fast_noise(ctx: AnalysisContext) -> float:
+    """
+    Оценка шума Immerkær (1996): одна свёртка 3x3, разностное ядро подавляет
+    структуру изображения, среднее |отклика| пропорционально sigma шума.
+    """
+    gray = ctx.gray
+    height, width = gray.shape
+    if height < 3 or width < 3:
+        return 100.0
+
+    response = cv2.filter2D(gray, cv2.CV_32F, IMMERKAER_KERNEL)[1:-1, 1:-1]
+    sigma = np.sqrt(np.pi / 2) * cv2.norm(response, cv2.NORM_L1) / (6 * (width - 2) * (height - 2))
+    return float(max(0, 100 - (sigma * 5)))
+
+
+def calibrate_fast(metric: str, score: float) -> float:
+    slope, intercept = FAST_CALIBRATION[metric]
+    return float(min(100, max(0, slope * score + intercept)))
+
+
+@instrumented("iqa_metric_seconds", metric="fast_sharpness")
+def fast_sharpness_score(ctx: AnalysisContext) -> float:
+    return calibrate_fast("sharpness", raw_fast_sharpness(ctx))
+
+
+@instrumented("iqa_metric_seconds", metric="fast_noise")
+def fast_noise_score(ctx: AnalysisContext) -> float:
+    return calibrate_fast("noise", raw_fast_noise(ctx))
+
+
+@instrumented("iqa_metric_seconds", metric="color_balance")
+def color_balance_score(ctx: AnalysisContext) -> float:
     """
     Новая функция для баланса цвета (поскольку в HTML есть score)
     """
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError("Не удалось загрузить изображение")
     # Конверт в HSV для saturation
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    saturation_mean = np.mean(hsv[:,:,1])
+    saturation_mean = np.mean(ctx.hsv[:, :, 1])
     # Баланс каналов: std means RGB (low std = balanced)
-    means = np.mean(image, axis=(0,1))
+    means = np.mean(ctx.bgr, axis=(0, 1))
     balance_std = np.std(means)
     # Colorfulness: sqrt( std(RG)^2 + std(YB)^2 ) + 0.3 * mean( std(RG) + std(YB) ) но упростим
     # Нормализуем в 0-100: high saturation good, low balance_std good
@@ -89,17 +284,88 @@ def calculate_color_balance(image_path: str) -> float:
     return float(score)
 
 
-def analyze_image(image_path: str) -> dict:
-    """
-    Полный анализ изображения: улучшенный с нормализацией в scores 0-100
-    """
-    analysis = {
-        "sharpness": calculate_sharpness(image_path),
-        "brightness": calculate_brightness(image_path),
-        "contrast": calculate_contrast(image_path),
-        "noise": calculate_noise(image_path),
-        "color_balance": calculate_color_balance(image_path),
+def calculate_sharpness(image_path: str) -> float:
+    return sharpness_score(load_context(image_path))
+
+
+def calculate_brightness(image_path: str) -> float:
+    return brightness_score(load_context(image_path))
+
+
+def calculate_contrast(image_path: str) -> float:
+    return contrast_score(load_context(image_path))
+
+
+def calculate_noise(image_path: str) -> float:
+    return noise_score(load_context(image_path))
+
+
+def calculate_color_balance(image_path: str) -> float:
+    return color_balance_score(load_context(image_path))
+
+
+def analyzer_version(profile: str = None) -> str:
+    """Версия для ключа кэша метрик: профили дают разные числа"""
+    profile = profile or DEFAULT_PROFILE
+    return ANALYZER_VERSION if profile == PRECISE else f"{ANALYZER_VERSION}-{profile}"
+
+
+def analyze_context(ctx: AnalysisContext, profile: str = None) -> dict:
+    profile = profile or DEFAULT_PROFILE
+    if profile not in PROFILES:
+        raise ValueError(f"Неизвестный профиль анализа: {profile}")
+    fast = profile == FAST
+
+    metrics = {
+        "sharpness": fast_sharpness_score if fast else sharpness_score,
+        "brightness": brightness_score,
+        "contrast": contrast_score,
+        "noise": fast_noise_score if fast else noise_score,
+        "color_balance": color_balance_score,
     }
+    # Серый кадр нужен почти всем метрикам: считаем до параллельного запуска
+    ctx.gray
+    scores = parallel_map(lambda score: score(ctx), metrics.values())
+    analysis = dict(zip(metrics, scores))
 
     analysis["overall_quality"] = np.mean(list(analysis.values()))
-    return analysis
\ No newline at end of file
+    return analysis
+
+
+def analyze_image(image_path: str, profile: str = None) -> dict:
+    """
+    Полный анализ изображения: улучшенный с нормализацией в scores 0-100.
+    Файл декодируется один раз, метрики работают с общим AnalysisContext.
+    profile — PRECISE или FAST, по умолчанию DEFAULT_PROFILE.
+    """
+    return analyze_context(load_context(image_path), profile=profile)
+
+
+def decode_drift(image_path: str) -> dict:
+    """
+    Режим проверки: насколько метрики уменьшенного декода отличаются от полного.
+    Возвращает {метрика: reduced - full}.
+    """
+    full = analyze_context(load_context(image_path, reduced_decode=False))
+    reduced = analyze_context(load_context(image_path, reduced_decode=True))
+    return {key: float(reduced[key] - full[key]) for key in full}
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        prog="python -m services.image_analysis",
+        description="Сравнение метрик уменьшенного и полного декодирования",
+    )
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    worst = {}
+    for path in args.paths:
+        drift = decode_drift(path)
+        print(json.dumps({"path": path, **drift}, ensure_ascii=False))
+        for key, value in drift.items():
+            worst[key] = max(worst.get(key, 0.0), abs(value))
+    print(json.dumps({"max_abs_drift": worst}))
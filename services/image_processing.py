@@ -2,62 +2,120 @@ import cv2
 import numpy as np
 import os
 
+from services.encoding import encode_async, write_image
+from services.image_analysis import reduced_flag
+from services.instrumentation import record_image, timed
+from services.rules import AUTO
 
-def adjust_brightness(image):
-    """Только яркость — gamma + shift, без потери контраста"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    current_mean = np.mean(gray)
-    target_mean = 115
 
+# Меняйте при любом изменении этапов обработки: сохранённые результаты
+# (services/storage.py) ищутся по (оригинал, план, PIPELINE_VERSION)
+PIPELINE_VERSION = "1"
+
+# Пороги авто-режима задаются таблицей services.rules.AUTO_RULES
+THRESHOLDS = AUTO.thresholds()
+
+TARGET_MEAN = 115
+
+# Веса OpenCV для COLOR_BGR2GRAY в порядке каналов B, G, R
+GRAY_WEIGHTS = (0.114, 0.587, 0.299)
+
+_LEVELS = np.arange(256, dtype=np.float64)
+
+
+def gamma_for_mean(current_mean: float) -> float:
     # Gamma-коррекция
     gamma = 1.0
     if current_mean < 70:
         gamma = 1.0 + (70 - current_mean) / 140.0 * 0.6  # max ~1.3
     elif current_mean > 160:
         gamma = 1.0 - (current_mean - 160) / 140.0 * 0.3  # min ~0.8
+    return gamma
+
+
+def gamma_table(current_mean: float, gamma: float = None):
+    """gamma — фиксированная сила (подбор services/auto_tune.py), иначе по средней яркости"""
+    if gamma is None:
+        gamma = gamma_for_mean(current_mean)
+    return ((_LEVELS / 255.0) ** (1.0 / gamma) * 255).astype(np.uint8)
 
-    lut = np.array([((i / 255.0) ** (1.0 / gamma)) * 255 for i in np.arange(0, 256)]).astype("uint8")
-    image_gamma = cv2.LUT(image, lut)
 
-    # Мягкий сдвиг
-    current_mean_after = np.mean(cv2.cvtColor(image_gamma, cv2.COLOR_BGR2GRAY))
-    delta = target_mean - current_mean_after
-    delta = np.clip(delta, -30, 30)
+def channel_histograms(image):
+    return np.stack([cv2.calcHist([image], [c], None, [256], [0, 256]).ravel() for c in range(3)])
 
-    return cv2.convertScaleAbs(image_gamma, alpha=1.0, beta=delta)
 
+def mean_after_lut(hists, lut) -> float:
+    """Средняя яркость (как COLOR_BGR2GRAY) после применения lut, по гистограммам каналов"""
+    pixels = hists[0].sum()
+    return sum(weight * float(hists[c] @ lut) / pixels for c, weight in enumerate(GRAY_WEIGHTS))
 
-def enhance_contrast(image, clip_limit=1.8):
+
+def fuse_brightness_lut(gamma_lut, current_mean_after: float):
+    # Мягкий сдвиг (как convertScaleAbs: |x + delta| с насыщением)
+    delta = np.clip(TARGET_MEAN - current_mean_after, -30, 30)
+    return np.clip(np.rint(np.abs(gamma_lut + delta)), 0, 255).astype(np.uint8)
+
+
+def brightness_lut(image, gray=None, gamma: float = None):
+    """
+    Gamma + мягкий сдвиг, слитые в одну таблицу.
+    Средняя яркость после gamma берётся из гистограмм каналов, без промежуточного кадра.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+    current_mean = cv2.mean(gray)[0]
+
+    gamma_lut = gamma_table(current_mean, gamma)
+    if np.array_equal(gamma_lut, _LEVELS):
+        current_mean_after = current_mean
+    else:
+        current_mean_after = mean_after_lut(channel_histograms(image), gamma_lut)
+
+    return fuse_brightness_lut(gamma_lut, current_mean_after)
+
+
+def adjust_brightness(image, dst=None, gray=None, gamma: float = None):
+    """Только яркость — gamma + shift, без потери контраста"""
+    return cv2.LUT(image, brightness_lut(image, gray=gray, gamma=gamma), dst=dst)
+
+
+def enhance_contrast(image, clip_limit=1.8, dst=None, lab=None):
     """CLAHE для контраста (только в auto-режиме, если нужно)"""
-    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-    l, a, b = cv2.split(lab)
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB, dst=lab)
+    l = cv2.extractChannel(lab, 0)
 
     clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
     l_clahe = clahe.apply(l)
 
     # Смешиваем 70% оригинал + 30% CLAHE → минимальная потеря контраста
-    l_mix = cv2.addWeighted(l, 0.7, l_clahe, 0.3, 0)
+    cv2.addWeighted(l, 0.7, l_clahe, 0.3, 0, dst=l)
 
-    lab_enhanced = cv2.merge([l_mix, a, b])
-    return cv2.cvtColor(lab_enhanced, cv2.COLOR_LAB2BGR)
+    cv2.insertChannel(l, lab, 0)
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=dst)
 
 
-def sharpen_image(image, strength=0.8):
-    blurred = cv2.GaussianBlur(image, (0, 0), sigmaX=2.5)
-    sharpened = cv2.addWeighted(image, 1 + strength, blurred, -strength, 0)
-    return np.clip(sharpened, 0, 255).astype(np.uint8)
+def unsharp_blur(image, dst=None):
+    return cv2.GaussianBlur(image, (0, 0), sigmaX=2.5, dst=dst)
 
 
-def denoise_image(image, strength=45):
-    return cv2.bilateralFilter(image, d=7, sigmaColor=strength, sigmaSpace=55)
+def unsharp_mask(image, blurred, strength, dst=None):
+    # addWeighted на uint8 уже насыщает результат в 0..255
+    return cv2.addWeighted(image, 1 + strength, blurred, -strength, 0, dst=dst)
 
 
-def process_image(image_path: str, actions: dict, output_dir: str, metrics: dict = None) -> str:
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError("Не удалось загрузить изображение")
+def sharpen_image(image, strength=0.8, dst=None, blurred=None):
+    return unsharp_mask(image, unsharp_blur(image, dst=blurred), strength, dst=dst)
+
 
-    thresholds = {"brightness": 65, "contrast": 65, "sharpness": 70, "noise": 70}
+def denoise_image(image, strength=45, dst=None):
+    return cv2.bilateralFilter(image, d=7, sigmaColor=strength, sigmaSpace=55, dst=dst)
+
+
+def compile_plan(actions: dict, metrics: dict = None) -> list:
+    """
+    Переводит выбор пользователя и метрики в план: список (этап, параметры)
+    в порядке выполнения. План сериализуется в JSON и не зависит от пикселей.
+    """
+    thresholds = THRESHOLDS
 
     # Определяем, что применять
     apply_brightness = actions.get("enhance_brightness", False)
@@ -66,40 +124,131 @@ def process_image(image_path: str, actions: dict, output_dir: str, metrics: dict
     apply_contrast = False  # CLAHE только в auto
 
     if actions.get("auto_improve", False) and metrics:
-        apply_brightness = metrics.get("brightness", 100) < thresholds["brightness"]
-        apply_contrast = metrics.get("contrast", 100) < thresholds["contrast"]
-        apply_sharpen = metrics.get("sharpness", 100) < thresholds["sharpness"]
-        apply_denoise = metrics.get("noise", 100) < thresholds["noise"]
+        decided = AUTO.evaluate_one(metrics)
+        apply_brightness = decided["enhance_brightness"]
+        apply_contrast = decided["contrast"]
+        apply_sharpen = decided["sharpen"]
+        apply_denoise = decided["denoise"]
 
         # Сила
-        brightness_strength = 1.0 if apply_brightness else 0
         contrast_clip = 1.5 + (thresholds["contrast"] - metrics.get("contrast", 100)) / 50 if apply_contrast else 0
         sharpen_strength = 0.6 + (thresholds["sharpness"] - metrics.get("sharpness", 100)) / 140 if apply_sharpen else 0
         denoise_strength = 30 + (thresholds["noise"] - metrics.get("noise", 100)) * 0.6 if apply_denoise else 0
 
     else:
         # Ручной: фиксированные мягкие значения
-        brightness_strength = 1.0
         contrast_clip = 1.8
         sharpen_strength = 0.8
         denoise_strength = 45
 
     # Порядок
+    plan = []
     if apply_denoise:
-        image = denoise_image(image, strength=int(denoise_strength))
-
+        plan.append(("denoise", {"strength": int(denoise_strength)}))
     if apply_brightness:
-        image = adjust_brightness(image)
-
+        plan.append(("brightness", {}))
     if apply_contrast:
-        image = enhance_contrast(image, clip_limit=contrast_clip)
-
+        plan.append(("contrast", {"clip_limit": float(contrast_clip)}))
     if apply_sharpen:
-        image = sharpen_image(image, strength=sharpen_strength)
+        plan.append(("sharpen", {"strength": float(sharpen_strength)}))
+    return plan
+
+
+def execute_plan(image, plan: list, progress=None):
+    """
+    Выполняет план на двух полнокадровых буферах (текущий + запасной) и одном
+    сером: точечные этапы идут на месте, фильтры пишут в запасной буфер.
+    Входной массив используется как рабочий буфер и может быть изменён.
+    Фильтры считаются полосами на свободных потоках (tiling.filter_parallel).
+    """
+    # tiling импортирует этапы из этого модуля
+    from services.tiling import STAGE_HALO, filter_parallel
+
+    if progress is None:
+        progress = lambda stage, fraction: None  # noqa: E731
+
+    current = image
+    spare = np.empty_like(image) if plan else None
+    gray = np.empty(image.shape[:2], dtype=np.uint8)
+
+    for index, (stage, params) in enumerate(plan):
+        with timed("iqa_process_stage_seconds", stage=stage, mode="full"):
+            if stage == "denoise":
+                filter_parallel(
+                    current, spare, STAGE_HALO[stage],
+                    lambda src, dst=None: denoise_image(src, strength=params["strength"], dst=dst),
+                )
+                current, spare = spare, current
+            elif stage == "brightness":
+                adjust_brightness(current, dst=current, gray=gray, gamma=params.get("gamma"))
+            elif stage == "contrast":
+                enhance_contrast(current, clip_limit=params["clip_limit"], dst=current, lab=spare)
+            elif stage == "sharpen":
+                filter_parallel(current, spare, STAGE_HALO[stage], unsharp_blur)
+                unsharp_mask(current, spare, params["strength"], dst=current)
+            else:
+                raise ValueError(f"Неизвестный этап обработки: {stage}")
+        progress(stage, 0.1 + 0.6 * (index + 1) / len(plan))
+
+    return current
+
+
+def process_image(image_path: str, actions: dict, output_dir: str, metrics: dict = None,
+                  progress=None, max_memory_mb: int = None, output_filename: str = None,
+                  encoding: dict = None, on_encoded=None, decode_factor: int = 1, tune: dict = None) -> str:
+    """
+    output_filename — имя результата в output_dir (по умолчанию processed_<имя оригинала>);
+    формат записи определяется его расширением, параметры — encoding (services/encoding.py).
+    on_encoded(error) — если задан, кодирование идёт в фоне на пуле services/encoding.py,
+    функция возвращается сразу, а on_encoded вызывается после записи (error=None) или сбоя.
+    progress(stage, fraction) — необязательный колбэк для отчёта о ходе обработки.
+    max_memory_mb — лимит пиковой памяти: если полнокадровый план в него не влезает,
+    этапы выполняются полосами (services/tiling.py), а если не влезает и так — ValueError.
+    decode_factor — JPEG декодируется уменьшенным в 2/4/8 раз (services/admission.py, режим downsample).
+    tune — параметры автоподбора (services/auto_tune.search_settings): план не из actions,
+    а победитель перебора на кадре анализа.
+    """
+    if progress is None:
+        progress = lambda stage, fraction: None  # noqa: E731
+
+    with timed("iqa_decode_seconds", source="processing"):
+        image = cv2.imread(image_path, reduced_flag(decode_factor))
+    if image is None:
+        raise ValueError("Не удалось загрузить изображение")
+    record_image("processing", image, image_path)
+
+    progress("decoded", 0.1)
+    if tune is None:
+        plan = compile_plan(actions, metrics)
+    else:
+        # auto_tune импортирует этапы из этого модуля
+        from services.auto_tune import search
+
+        plan = search(image, **tune).plan
+        progress("auto_tune", 0.3)
 
-    filename = os.path.basename(image_path)
-    output_filename = f"processed_{filename}"
+    if max_memory_mb is None:
+        image = execute_plan(image, plan, progress=progress)
+    else:
+        # tiling импортирует этапы из этого модуля
+        from services import tiling
+
+        budget = max_memory_mb << 20
+        if tiling.full_frame_footprint(image.shape, plan) <= budget:
+            image = execute_plan(image, plan, progress=progress)
+        else:
+            band_rows = tiling.band_rows_for_budget(image.shape, plan, budget)
+            image = tiling.execute_plan_tiled(image, plan, band_rows, progress=progress)
+
+    if output_filename is None:
+        output_filename = f"processed_{os.path.basename(image_path)}"
     output_path = os.path.join(output_dir, output_filename)
 
-    cv2.imwrite(output_path, image)
-    return output_filename
\ No newline at end of file
+    if on_encoded is None:
+        write_image(output_path, image, encoding)
+        progress("encode", 1.0)
+    else:
+        progress("encoding", 0.8)
+        future = encode_async(output_path, image, encoding)
+        future.add_done_callback(lambda f: on_encoded(f.exception()))
+    return output_filename
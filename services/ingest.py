@@ -0,0 +1,162 @@
+"""
+Приём загрузки за один проход: поток читается в память один раз, декодируется
+cv2.imdecode, метрики считаются по этому массиву, а Image, анализ и сессия
+сохраняются одной транзакцией. Файл пишется в хранилище (services/storage.py)
+фоновым потоком; всё, что читает загрузку с диска, сначала вызывает wait_for_file.
+"""
+import atexit
+import hashlib
+import io
+import os
+import queue
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from extensions import db
+from models.image import Image
+from services.admission import check_pixels, decode_budget, read_header, upload_footprint
+from services.image_analysis import AnalysisContext
+from services.instrumentation import record_written, timed
+from services.metrics_cache import get_metrics_for_bytes
+from services.near_duplicates import hash_for_upload, set_image_hash
+from services.previews import schedule_pyramid
+from services.quality_maps import schedule_overlays
+from services.repository import add_session, commit
+from services.storage import acquire_upload, object_path
+
+
+class BackgroundWriter:
+    """Очередь записи файлов в одном фоновом потоке с ожиданием по пути"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, path: str, data: bytes):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="upload-writer", daemon=True)
+                self._thread.start()
+            done = self._pending.get(path)
+            if done is None:
+                done = self._pending[path] = [threading.Event(), 0]
+            done[1] += 1
+            self._errors.pop(path, None)
+        self._queue.put((path, data, done))
+
+    def wait(self, path: str, timeout: float = None):
+        """Ждёт записи path, если она ещё в очереди; ошибку записи пробрасывает"""
+        with self._lock:
+            done = self._pending.get(path)
+        if done is not None and not done[0].wait(timeout):
+            raise TimeoutError(f"Файл ещё не записан: {path}")
+        with self._lock:
+            error = self._errors.get(path)
+        if error is not None:
+            raise error
+
+    def flush(self, timeout: float = None):
+        with self._lock:
+            pending = list(self._pending)
+        for path in pending:
+            try:
+                self.wait(path, timeout)
+            except OSError:
+                pass
+
+    def _loop(self):
+        while True:
+            path, data, done = self._queue.get()
+            try:
+                with timed("iqa_upload_write_seconds"):
+                    # Через временный файл: читатель не увидит недописанный файл
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                record_written("upload", path)
+            except OSError as exc:
+                with self._lock:
+                    self._errors[path] = exc
+            finally:
+                with self._lock:
+                    done[1] -= 1
+                    if done[1] == 0:
+                        self._pending.pop(path, None)
+                        done[0].set()
+
+
+file_writer = BackgroundWriter()
+atexit.register(file_writer.flush)
+
+
+def wait_for_file(path: str, timeout: float = 30):
+    """
+    Ждёт файл загрузки: свою очередь записи, затем сам файл на диске — загрузку
+    мог принять другой процесс (воркер gunicorn), чья очередь отсюда не видна.
+    Запись атомарна (os.replace), поэтому появившийся файл уже дописан.
+    """
+    deadline = time.monotonic() + timeout
+    file_writer.wait(path, timeout)
+    while not os.path.exists(path):
+        if time.monotonic() >= deadline:
+            raise FileNotFoundError(f"Файл не найден: {path}")
+        time.sleep(0.05)
+
+
+def ingest_upload(file, upload_dir: str, user_id: int = 1, profile: str = None):
+    """
+    Загрузка -> (image, session, metrics). Битый файл — ValueError до любой записи.
+    Содержимое, уже лежащее в хранилище, не декодируется и не пишется повторно.
+    """
+    data = file.read()
+    # Размер и глубина — по заголовку, до декода и до любой записи
+    header = read_header(io.BytesIO(data))
+    check_pixels(header)
+
+    digest = hashlib.sha256(data).hexdigest()
+    filename = secure_filename(file.filename)
+
+    stored, needs_write = acquire_upload(digest, filename, len(data))
+    ctx = None
+    if needs_write:
+        try:
+            # Одновременные декоды больших загрузок ждут своей очереди в бюджете процесса
+            with decode_budget.reserve(upload_footprint(header)):
+                ctx = AnalysisContext.from_bytes(data)
+        except ValueError:
+            db.session.rollback()
+            raise
+
+    image = Image(
+        user_id=user_id,
+        original_filename=filename,
+        content_digest=digest,
+        stored_path=stored.relpath,
+    )
+    phash = hash_for_upload(digest, ctx=ctx, data=data)
+    if phash is not None:
+        set_image_hash(image, phash)
+    db.session.add(image)
+    db.session.flush()  # нужен image.id для строки анализа
+
+    metrics = get_metrics_for_bytes(data, digest, image.id, profile=profile, commit=False, ctx=ctx)
+
+    session = add_session(image.id, metrics)
+    commit("upload")
+
+    # Файл ставится в очередь только после успешного коммита
+    file_path = object_path(upload_dir, stored.relpath)
+    if needs_write or not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_writer.submit(file_path, data)
+        # Превью и карты качества строятся из того же буфера, не дожидаясь записи оригинала
+        schedule_pyramid(upload_dir, digest, data)
+        if ctx is not None:
+            schedule_overlays(upload_dir, digest, ctx)
+    return image, session, metrics
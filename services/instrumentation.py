@@ -0,0 +1,229 @@
+"""
+Лёгкая инструментация горячих путей: таймеры, гистограммы задержек, счётчики.
+
+    with timed("iqa_decode_seconds"):
+        ...
+
+    @instrumented("iqa_metric_seconds", metric="noise")
+    def noise_score(ctx): ...
+
+Данные живут в памяти процесса и отдаются маршрутом /metrics в текстовом
+формате Prometheus. Воркеры очереди (services/jobs.py) — отдельные процессы:
+их измерения возвращаются вместе с результатом задачи (drain/merge).
+
+IQA_PROFILE_DIR=/path — для каждого запроса сохраняется дамп cProfile
+(<время>_<endpoint>.prof), смотреть через python -m pstats или snakeviz.
+"""
+import cProfile
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    "iqa_decode_seconds": "Декодирование изображения",
+    "iqa_metric_seconds": "Расчёт одной метрики анализа",
+    "iqa_process_stage_seconds": "Этап обработки изображения",
+    "iqa_auto_tune_seconds": "Перебор сетки автоподбора на кадре анализа",
+    "iqa_auto_tune_candidates_total": "Оценено вариантов автоподбора",
+    "iqa_encode_seconds": "Кодирование и запись результата (cv2.imwrite)",
+    "iqa_upload_write_seconds": "Фоновая запись загруженного файла",
+    "iqa_preview_seconds": "Сборка пирамиды превью",
+    "iqa_db_commit_seconds": "Коммит SQLAlchemy в маршрутах",
+    "iqa_request_seconds": "HTTP-запрос целиком",
+    "iqa_image_megapixels": "Размер декодированных изображений, Мп",
+    "iqa_bytes_read_total": "Прочитано байт изображений",
+    "iqa_bytes_written_total": "Записано байт изображений",
+    "iqa_images_total": "Обработано изображений",
+}
+
+MEGAPIXEL_BUCKETS = (0.1, 0.3, 1, 2, 5, 12, 24, 48, 100, 200)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(str(v))}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def drain(self) -> dict:
+        """Забирает накопленное (для передачи из процесса-воркера) и обнуляет реестр"""
+        with self._lock:
+            state = {"histograms": self._histograms, "counters": self._counters}
+            self._histograms, self._counters = {}, {}
+        return state
+
+    def merge(self, state: dict):
+        with self._lock:
+            for key, other in state["histograms"].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(other.buckets)
+                histogram.counts = [a + b for a, b in zip(histogram.counts, other.counts)]
+                histogram.sum += other.sum
+                histogram.count += other.count
+            for key, value in state["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        """{(имя, метки): (count, sum)} по гистограммам и {(имя, метки): значение} по счётчикам"""
+        with self._lock:
+            return {
+                "histograms": {k: (h.count, h.sum) for k, h in self._histograms.items()},
+                "counters": dict(self._counters),
+            }
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, key), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, (('le', repr(float(bound))),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for (metric, key), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+@contextmanager
+def timed(name: str, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - started, **labels)
+
+
+def instrumented(name: str, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_image(source: str, image, path: str = None):
+    """Размер декодированного кадра и, если известен файл, прочитанные байты"""
+    if image is None:
+        return
+    height, width = image.shape[:2]
+    registry.observe("iqa_image_megapixels", height * width / 1e6, buckets=MEGAPIXEL_BUCKETS, source=source)
+    registry.inc("iqa_images_total", source=source)
+    if path is not None:
+        try:
+            registry.inc("iqa_bytes_read_total", os.path.getsize(path), source=source)
+        except OSError:
+            pass
+
+
+def record_written(source: str, path: str):
+    try:
+        registry.inc("iqa_bytes_written_total", os.path.getsize(path), source=source)
+    except OSError:
+        pass
+
+
+def init_instrumentation(app):
+    # flask нужен только веб-процессу; сервисы и воркеры импортируют модуль без него
+    from flask import g, request
+
+    profile_dir = os.environ.get("IQA_PROFILE_DIR")
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    @app.before_request
+    def _start_request_timer():
+        g.instrumentation_started = time.perf_counter()
+        if profile_dir:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def _finish_request_timer(response):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            endpoint = (request.endpoint or "unknown").replace(".", "_")
+            profiler.dump_stats(os.path.join(profile_dir, f"{time.time():.6f}_{endpoint}.prof"))
+
+        started = g.pop("instrumentation_started", None)
+        if started is not None:
+            registry.observe(
+                "iqa_request_seconds",
+                time.perf_counter() - started,
+                endpoint=request.endpoint or "unknown",
+                status=response.status_code,
+            )
+        return response
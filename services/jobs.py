@@ -0,0 +1,414 @@
+"""
+Локальная очередь задач обработки: SQLite-хранилище + пул процессов.
+
+Маршрут /process ставит задачу в очередь и сразу отвечает 202, диспетчер
+забирает задачи из SQLite и отдаёт их пулу воркеров, а по завершении
+создаёт Result в основной БД. Внешний брокер не нужен.
+
+Запуск воркеров отдельным процессом (если JOBS_RUN_IN_APP = False):
+    python -m services.jobs
+"""
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from services.admission import MemoryBudget
+from services.decision_engine import summarize_actions
+from services.image_processing import process_image
+from services.instrumentation import registry
+from services.previews import schedule_pyramid
+from services.quality_maps import schedule_overlays
+from services.repository import add_result, commit
+from services.storage import object_path, store_derived
+from services.threads import configure_threads, threads_per_process
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Этап running-задачи: файл результата записан пулом кодирования воркера
+ENCODED = "encoded"
+
+
+class JobQueue:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    progress REAL NOT NULL DEFAULT 0,
+                    result_id INTEGER,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, id)")
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            # Измерения фонового кодирования воркера (registry.drain) для диспетчера
+            if "measurements" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN measurements BLOB")
+            # Диспетчер, выполняющий running-задачу; аренда продлевается через updated_at
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, session_id: int, payload: dict) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO jobs (session_id, payload, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, json.dumps(payload), QUEUED, now, now),
+            )
+            return cur.lastrowid
+
+    def claim_next(self, owner: str = None):
+        """Атомарно переводит самую старую queued-задачу в running за диспетчером owner"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = ?, owner = ?, updated_at = ? WHERE id = ?",
+                    (RUNNING, "started", owner, time.time(), row["id"]),
+                )
+            conn.execute("COMMIT")
+        return dict(row) if row is not None else None
+
+    def requeue(self, job_id: int):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, progress = 0, owner = NULL, updated_at = ? "
+                "WHERE id = ?",
+                (QUEUED, time.time(), job_id),
+            )
+
+    def heartbeat(self, owner: str):
+        """Продлевает аренду running-задач диспетчера owner"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE status = ? AND owner = ?",
+                (time.time(), RUNNING, owner),
+            )
+
+    def requeue_expired(self, lease_s: float) -> int:
+        """
+        Running-задачи без продления аренды дольше lease_s (их диспетчер остановлен)
+        возвращаются в очередь; задачи живых диспетчеров других процессов не трогаются
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, progress = 0, owner = NULL, updated_at = ? "
+                "WHERE status = ? AND updated_at < ?",
+                (QUEUED, now, RUNNING, now - lease_s),
+            )
+            return cur.rowcount
+
+    def set_progress(self, job_id: int, stage: str, progress: float):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, progress = ?, updated_at = ? WHERE id = ?",
+                (stage, progress, time.time(), job_id),
+            )
+
+    def set_encoded(self, job_id: int, measurements: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, progress = 1, measurements = ?, updated_at = ? WHERE id = ?",
+                (ENCODED, pickle.dumps(measurements), time.time(), job_id),
+            )
+
+    def finish(self, job_id: int, result_id: int):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, progress = 1, result_id = ?, "
+                "updated_at = ? WHERE id = ?",
+                (DONE, "done", result_id, time.time(), job_id),
+            )
+
+    def fail(self, job_id: int, error: str, measurements: dict = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, measurements = COALESCE(?, measurements), "
+                "updated_at = ? WHERE id = ?",
+                (FAILED, error, None if measurements is None else pickle.dumps(measurements), time.time(), job_id),
+            )
+
+    def get(self, job_id: int):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+
+def run_processing_job(queue_path: str, job_id: int, payload: dict):
+    """
+    Выполняется в процессе-воркере: только CV, без доступа к основной БД.
+    Возвращает (имя файла, измерения инструментации для реестра диспетчера).
+    Измерения кодирования, которое идёт уже после возврата, передаются через строку задачи.
+    """
+    queue = JobQueue(queue_path)
+
+    def progress(stage, fraction):
+        queue.set_progress(job_id, stage, fraction)
+
+    def on_encoded(error):
+        # Кодирование идёт в потоке воркера уже после возврата из задачи
+        if error is None:
+            queue.set_encoded(job_id, registry.drain())
+        else:
+            queue.fail(job_id, repr(error), registry.drain())
+
+    processed_filename = process_image(
+        image_path=payload["image_path"],
+        actions=payload["actions"],
+        output_dir=payload["output_dir"],
+        metrics=payload["metrics"],
+        progress=progress,
+        max_memory_mb=payload.get("max_memory_mb"),
+        output_filename=payload.get("output_filename"),
+        encoding=payload.get("encoding"),
+        on_encoded=on_encoded,
+        decode_factor=payload.get("decode_factor", 1),
+        tune=payload.get("tune"),
+    )
+    # pid — чтобы диспетчер не ждал кодирования от погибшего воркера
+    return processed_filename, registry.drain(), os.getpid()
+
+
+class JobRunner:
+    """Диспетчер: забирает задачи из очереди и держит пул процессов загруженным"""
+
+    def __init__(self, app, queue: JobQueue, workers: int, poll_interval: float = 0.2):
+        self.app = app
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._slots = threading.Semaphore(workers)
+        # Сумма оценок памяти выполняемых задач (payload["memory_bytes"], services/admission.py)
+        memory_mb = app.config.get("JOBS_MEMORY_BUDGET_MB")
+        self._memory = MemoryBudget(None if memory_mb is None else int(memory_mb) << 20)
+        self._wakeup = threading.Event()
+        self._pool = None
+        self._finalizer = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # Несколько процессов (веб-воркеры gunicorn, python -m services.jobs) делят
+        # одну очередь: каждый продлевает аренду своих задач, чужие не трогает
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_s = app.config.get("JOB_LEASE_S", 60)
+
+    def _create_pool(self):
+        context = multiprocessing.get_context(self.app.config.get("JOB_START_METHOD", "spawn"))
+        # Каждый процесс обработки получает свою долю бюджета ядер
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context,
+            initializer=configure_threads, initargs=(threads_per_process(self.app.config),),
+        )
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._pool = self._create_pool()
+            self._finalizer = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job-finalizer")
+            self._thread = threading.Thread(target=self._loop, name="job-dispatcher", daemon=True)
+            self._thread.start()
+            threading.Thread(target=self._keep_leases, name="job-lease", daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def join(self):
+        """Ждёт диспетчер (отдельный процесс воркеров, python -m services.jobs)"""
+        self._thread.join()
+
+    def _keep_leases(self):
+        """Продление аренды своих задач и возврат в очередь задач остановленных диспетчеров"""
+        while True:
+            if self.queue.requeue_expired(self.lease_s):
+                self.notify()
+            time.sleep(self.lease_s / 4)
+            self.queue.heartbeat(self.owner)
+
+    def _restart_pool(self, broken):
+        with self._lock:
+            if self._pool is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create_pool()
+
+    def _loop(self):
+        while True:
+            self._slots.acquire()
+            job = self.queue.claim_next(self.owner)
+            if job is None:
+                self._slots.release()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            payload = json.loads(job["payload"])
+            # Задачи идут по порядку: следующая ждёт, пока её оценка не влезет в бюджет
+            self._memory.acquire(payload.get("memory_bytes", 0))
+            pool = self._pool
+            try:
+                future = pool.submit(run_processing_job, self.queue.path, job["id"], payload)
+            except Exception as exc:  # диспетчер не должен останавливаться
+                self._memory.release(payload.get("memory_bytes", 0))
+                self._slots.release()
+                if isinstance(exc, BrokenProcessPool):
+                    # Процесс пула погиб (OOM, сбой в cv2) на предыдущей задаче: эта
+                    # задача ни при чём — новый пул, и она снова в очереди
+                    self._restart_pool(pool)
+                    self.queue.requeue(job["id"])
+                else:
+                    self.queue.fail(job["id"], repr(exc))
+                continue
+            future.add_done_callback(
+                lambda f, job=job, payload=payload: self._complete(job, payload, f)
+            )
+
+    def _complete(self, job, payload, future):
+        # Слот освобождается, как только воркер закончил пиксели: кодирование
+        # идёт в его фоне, а Result создаётся после записи файла (_finalize)
+        try:
+            processed_filename, measurements, worker_pid = future.result()
+            registry.merge(measurements)
+        except Exception as exc:  # задача не должна ронять диспетчер
+            self.queue.fail(job["id"], repr(exc))
+            self._memory.release(payload.get("memory_bytes", 0))
+            return
+        finally:
+            self._slots.release()
+            self.notify()
+        self._finalizer.submit(self._finalize, job, payload, processed_filename, worker_pid)
+
+    def _wait_encoded(self, job_id: int, worker_pid: int) -> bool:
+        """
+        Ждёт записи файла воркером; измерения кодирования попадают в реестр диспетчера.
+        Если воркер погиб до on_encoded или кодирование не уложилось в
+        JOB_ENCODE_TIMEOUT_S, задача помечается failed.
+        """
+        deadline = time.monotonic() + self.app.config.get("JOB_ENCODE_TIMEOUT_S", 300)
+        while True:
+            row = self.queue.get(job_id)
+            if row is None:
+                return False
+            if row["status"] == FAILED or row["stage"] == ENCODED:
+                if row["measurements"]:
+                    registry.merge(pickle.loads(row["measurements"]))
+                return row["status"] != FAILED
+            if not _process_alive(worker_pid):
+                self.queue.fail(job_id, "Процесс воркера завершился до записи результата")
+                return False
+            if time.monotonic() > deadline:
+                self.queue.fail(job_id, "Превышено время записи результата")
+                return False
+            time.sleep(self.poll_interval / 4)
+
+    def _finalize(self, job, payload, processed_filename, worker_pid):
+        try:
+            # Кадр живёт в воркере до конца кодирования — до тех пор и память занята
+            encoded = self._wait_encoded(job["id"], worker_pid)
+        finally:
+            self._memory.release(payload.get("memory_bytes", 0))
+        try:
+            if not encoded:
+                return
+            with self.app.app_context():
+                if payload.get("derivation_key"):
+                    # Результат переезжает из tmp в хранилище под своим digest
+                    stored = store_derived(
+                        self.app.config["UPLOAD_FOLDER"],
+                        os.path.join(payload["output_dir"], processed_filename),
+                        payload["derivation_key"],
+                    )
+                    processed_filename = stored.relpath
+                result = save_processing_result(job["session_id"], payload["actions"], processed_filename)
+                result_id = result.id
+                if payload.get("derivation_key"):
+                    root = self.app.config["UPLOAD_FOLDER"]
+                    schedule_pyramid(root, stored.digest, object_path(root, stored.relpath))
+                    schedule_overlays(root, stored.digest, object_path(root, stored.relpath))
+            self.queue.finish(job["id"], result_id)
+        except Exception as exc:
+            self.queue.fail(job["id"], repr(exc))
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def save_processing_result(session_id: int, actions: dict, processed_filename: str):
+    verdict, confidence = summarize_actions(actions)
+
+    result = add_result(session_id, processed_filename, verdict, confidence)
+    commit("job_result")
+    return result
+
+
+def init_jobs(app):
+    queue = JobQueue(app.config["JOBS_DB_PATH"])
+    app.extensions["job_queue"] = queue
+    if app.config.get("JOBS_RUN_IN_APP", True):
+        # Пул поднимается лениво при первой задаче, а не при импорте приложения
+        app.extensions["job_runner"] = JobRunner(app, queue, app.config.get("JOB_WORKERS", 2))
+
+
+def enqueue_processing(app, session_id: int, payload: dict) -> int:
+    job_id = app.extensions["job_queue"].enqueue(session_id, payload)
+    runner = app.extensions.get("job_runner")
+    if runner is not None:
+        runner.start()
+        runner.notify()
+    return job_id
+
+
+def get_job(app, job_id: int):
+    return app.extensions["job_queue"].get(job_id)
+
+
+if __name__ == "__main__":
+    from app import create_app
+
+    flask_app = create_app()
+    runner = JobRunner(flask_app, flask_app.extensions["job_queue"], flask_app.config.get("JOB_WORKERS", 2))
+    runner.start()
+    runner.join()
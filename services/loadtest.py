@@ -0,0 +1,340 @@
+"""
+Нагрузочный прогон приложения целиком, без внешних сервисов.
+
+    python -m services.loadtest --flows 40 --concurrency 4 --output load.json
+    python -m services.loadtest --config config.MemoryConfig --concurrency 1 --output load.json
+    python -m services.loadtest --database postgresql+psycopg2://... --output load.json
+
+Приложение собирается create_app с локальным профилем (по умолчанию SQLite-файл
+в рабочем каталоге прогона), очередь обработки и хранилище — там же. Каждый
+поток гоняет через настоящие маршруты (Flask test client, без сети) сценарий:
+
+    POST /  ->  GET /analyze/<image_id>  ->  POST /process/<session_id>
+            ->  GET /jobs/<job_id> до готовности  ->  GET /result/<result_id>
+
+Изображения — синтетические сцены services/benchmark.py; корпус меньше числа
+сценариев, поэтому часть загрузок попадает в кэши, как и в жизни.
+
+Отчёт: запросы/с и сценарии/с, перцентили задержки по маршрутам, время в БД
+(выполнение SQL и коммиты) против времени CV (декод, метрики, этапы обработки,
+кодирование, превью) по реестру services/instrumentation.py, пиковая память
+веб-процесса и процессов обработки.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+from sqlalchemy import event
+
+from extensions import db
+from models.processing_session import ProcessingSession
+from services.benchmark import SCENARIOS, _peak_rss_mb, environment, synthetic_scene
+from services.instrumentation import registry
+
+
+ROUTES = ("upload", "analyze", "process", "job", "job_status", "result")
+
+# Гистограммы реестра, из которых складывается время CV и время коммитов
+CV_HISTOGRAMS = {
+    "decode": "iqa_decode_seconds",
+    "metrics": "iqa_metric_seconds",
+    "processing": "iqa_process_stage_seconds",
+    "encode": "iqa_encode_seconds",
+    "previews": "iqa_preview_seconds",
+}
+COMMIT_HISTOGRAM = "iqa_db_commit_seconds"
+
+
+class DbTimer:
+    """Суммарное время выполнения SQL по всем соединениям движка"""
+
+    def __init__(self, engine):
+        self._lock = threading.Lock()
+        self.seconds = 0.0
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("loadtest_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["loadtest_started"].pop()
+        with self._lock:
+            self.seconds += elapsed
+            self.statements += 1
+
+
+class FlowError(Exception):
+    pass
+
+
+def build_corpus(size: int, megapixels: float, seed: int = 0) -> list:
+    """[(имя файла, JPEG-байты)]; сцены по кругу из SCENARIOS"""
+    corpus = []
+    for index in range(size):
+        scenario = SCENARIOS[index % len(SCENARIOS)]
+        image = synthetic_scene(scenario, megapixels, seed=seed + index)
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise ValueError("Не удалось закодировать изображение корпуса")
+        corpus.append((f"{scenario}_{index}.jpg", encoded.tobytes()))
+    return corpus
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.flows = []
+        self.failures = []
+
+    def add(self, route: str, seconds: float, ok: bool = True):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+    def finish_flow(self, seconds: float, error: str = None):
+        with self._lock:
+            if error is None:
+                self.flows.append(seconds)
+            else:
+                self.failures.append(error)
+
+
+def run_flow(app, client, name: str, data: bytes, recorder: Recorder,
+             poll_interval: float = 0.05, job_timeout: float = 300):
+    def call(route, method, url, expected=(200,), **kwargs):
+        started = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        ok = response.status_code in expected
+        recorder.add(route, time.perf_counter() - started, ok)
+        if not ok:
+            raise FlowError(f"{route} {url}: HTTP {response.status_code}")
+        return response
+
+    response = call("upload", "post", "/", data={"image": (io.BytesIO(data), name)},
+                    content_type="multipart/form-data")
+    session_id = int(re.search(r'action="/process/(\d+)"', response.get_data(as_text=True)).group(1))
+    # Страница анализа не показывает id изображения — он берётся из сессии
+    with app.app_context():
+        image_id = db.session.get(ProcessingSession, session_id).image_id
+
+    response = call("analyze", "get", f"/analyze/{image_id}")
+    session_id = int(re.search(r'action="/process/(\d+)"', response.get_data(as_text=True)).group(1))
+
+    response = call("process", "post", f"/process/{session_id}", expected=(200, 202),
+                    data={"auto_improve": "on"}, headers={"Accept": "application/json"})
+    job = response.get_json()
+    if job.get("status_url"):
+        started = time.perf_counter()
+        while True:
+            job = call("job_status", "get", job["status_url"]).get_json() | {"status_url": job["status_url"]}
+            if job["status"] in ("done", "failed"):
+                break
+            if time.perf_counter() - started > job_timeout:
+                raise FlowError(f"задача {job['job_id']} не завершилась за {job_timeout} с")
+            time.sleep(poll_interval)
+        recorder.add("job", time.perf_counter() - started, job["status"] == "done")
+        if job["status"] != "done":
+            raise FlowError(f"задача {job['job_id']}: {job['error']}")
+
+    call("result", "get", job["result_url"])
+
+
+def _child_peak_rss_mb() -> dict:
+    """{pid: пик RSS} дочерних процессов (Linux); пусто, если /proc недоступен"""
+    peaks = {}
+    try:
+        pids = set()
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                pids.update(int(pid) for pid in f.read().split())
+        for pid in pids:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peaks[pid] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peaks
+
+
+def _percentiles(seconds) -> dict:
+    if not seconds:
+        return {"count": 0}
+    values = np.asarray(seconds) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max()),
+    }
+
+
+def _histogram_sums(before: dict, after: dict) -> dict:
+    """{имя гистограммы: прирост суммы секунд} между двумя снимками реестра"""
+    totals = {}
+    for (name, labels), (count, total) in after["histograms"].items():
+        previous = before["histograms"].get((name, labels), (0, 0.0))[1]
+        totals[name] = totals.get(name, 0.0) + total - previous
+    return totals
+
+
+def run_load_test(flows: int = 40, concurrency: int = 4, corpus_size: int = 8, megapixels: float = 2,
+                  config: str = "config.LocalConfig", database: str = None, seed: int = 0,
+                  workdir: str = None, log=None, **overrides) -> dict:
+    # Модуль app при импорте сам создаёт приложение по IQA_CONFIG: без
+    # PostgreSQL пусть это будет пустая БД в памяти, прогон создаёт своё
+    os.environ.setdefault("IQA_CONFIG", "config.MemoryConfig")
+    from app import create_app
+
+    if log is None:
+        log = lambda message: None  # noqa: E731
+
+    workdir = workdir or tempfile.mkdtemp(prefix="iqa-load-")
+    settings = {
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "JOBS_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        **overrides,
+    }
+    if database:
+        settings["SQLALCHEMY_DATABASE_URI"] = database
+    elif config == "config.LocalConfig":
+        settings["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(workdir, "load.sqlite3")
+
+    log(f"Корпус: {corpus_size} изображений по {megapixels} Мп")
+    corpus = build_corpus(corpus_size, megapixels, seed=seed)
+
+    app = create_app(config, **settings)
+    with app.app_context():
+        db_timer = DbTimer(db.engine)
+    recorder = Recorder()
+
+    tasks = iter(range(flows))
+    tasks_lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with tasks_lock:
+                index = next(tasks, None)
+            if index is None:
+                return
+            name, data = corpus[index % len(corpus)]
+            started = time.perf_counter()
+            try:
+                run_flow(app, client, name, data, recorder)
+                recorder.finish_flow(time.perf_counter() - started)
+            except Exception as exc:  # сценарий засчитывается как сбой, прогон идёт дальше
+                recorder.finish_flow(time.perf_counter() - started, error=repr(exc))
+            done = len(recorder.flows) + len(recorder.failures)
+            if done % max(1, flows // 10) == 0:
+                log(f"{done}/{flows} сценариев")
+
+    registry_before = registry.snapshot()
+    db_before = (db_timer.seconds, db_timer.statements)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"load-{index}") for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    sums = _histogram_sums(registry_before, registry.snapshot())
+
+    requests_total = sum(len(latencies) for route, latencies in recorder.latencies.items() if route != "job")
+    workers = _child_peak_rss_mb()
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "settings": {
+            "flows": flows,
+            "concurrency": concurrency,
+            "corpus": corpus_size,
+            "megapixels": megapixels,
+            "config": config,
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split("@")[-1],
+            "job_workers": app.config.get("JOB_WORKERS"),
+            "seed": seed,
+        },
+        "seconds": round(wall, 3),
+        "flows_completed": len(recorder.flows),
+        "flows_failed": len(recorder.failures),
+        "failures": recorder.failures[:20],
+        "requests": requests_total,
+        "requests_per_s": requests_total / wall if wall else None,
+        "flows_per_s": len(recorder.flows) / wall if wall else None,
+        "flow": _percentiles(recorder.flows),
+        "routes": {
+            route: _percentiles(latencies) | {"errors": recorder.errors[route]}
+            for route, latencies in recorder.latencies.items()
+        },
+        "time": {
+            "db_sql_s": db_timer.seconds - db_before[0],
+            "db_statements": db_timer.statements - db_before[1],
+            "db_commit_s": sums.get(COMMIT_HISTOGRAM, 0.0),
+            "cv_s": {part: sums.get(name, 0.0) for part, name in CV_HISTOGRAMS.items()},
+        },
+        "memory": {
+            "web_peak_rss_mb": _peak_rss_mb(),
+            "worker_peak_rss_mb": sorted(workers.values(), reverse=True),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m services.loadtest", description="Нагрузочный прогон маршрутов")
+    parser.add_argument("--output", required=True, help="JSON-отчёт")
+    parser.add_argument("--flows", type=int, default=40, help="сколько сценариев загрузка→результат")
+    parser.add_argument("--concurrency", type=int, default=4, help="параллельных клиентов")
+    parser.add_argument("--corpus", type=int, default=8, help="различных изображений")
+    parser.add_argument("--megapixels", type=float, default=2)
+    parser.add_argument("--config", default="config.LocalConfig", help="класс настроек (строка импорта)")
+    parser.add_argument("--database", help="URL БД вместо SQLite-файла в рабочем каталоге")
+    parser.add_argument("--job-workers", type=int, help="процессов обработки (JOB_WORKERS)")
+    parser.add_argument("--workdir", help="каталог хранилища и БД прогона (по умолчанию временный)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.job_workers is not None:
+        overrides["JOB_WORKERS"] = args.job_workers
+
+    report = run_load_test(
+        flows=args.flows,
+        concurrency=args.concurrency,
+        corpus_size=args.corpus,
+        megapixels=args.megapixels,
+        config=args.config,
+        database=args.database,
+        seed=args.seed,
+        workdir=args.workdir,
+        log=lambda message: print(message, file=sys.stderr),
+        **overrides,
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    routes = ", ".join(
+        f"{route} p50 {stats['p50_ms']:.0f} мс" for route, stats in report["routes"].items() if stats["count"]
+    )
+    print(f"{report['requests_per_s']:.1f} запр/с, {report['flows_per_s']:.2f} сценариев/с; {routes}", file=sys.stderr)
+    if report["flows_failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from extensions import db
+from models.image_analysis import ImageAnalysis
+from services.analysis_storage import save_analysis
+from services.image_analysis import PROFILES, AnalysisContext, analyze_context, analyze_image, analyzer_version
+
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MetricsCache:
+    """
+    In-process LRU: (content_digest, analyzer_version) -> метрики.
+    Второй уровень — таблица image_analysis, см. get_metrics.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, keep_versions=None):
+        """Сбрасывает всё, либо только записи других версий анализатора"""
+        with self._lock:
+            if keep_versions is None:
+                self._items.clear()
+                return
+            for key in [k for k in self._items if k[1] not in keep_versions]:
+                del self._items[key]
+
+
+metrics_cache = MetricsCache()
+
+# Профиль анализа для запросов приложения (ANALYSIS_PROFILE в конфиге)
+_profile = None
+
+
+def current_versions() -> set:
+    return {analyzer_version(profile) for profile in PROFILES}
+
+
+def init_metrics_cache(app):
+    global _profile
+    _profile = app.config.get("ANALYSIS_PROFILE")
+    metrics_cache.maxsize = app.config.get("METRICS_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+    metrics_cache.invalidate(keep_versions=current_versions())
+
+
+def _cached_metrics(digest: str, image_id: int, profile: str, compute, commit: bool = True) -> dict:
+    version = analyzer_version(profile)
+    key = (digest, version)
+
+    metrics = metrics_cache.get(key)
+    if metrics is None:
+        row = (
+            ImageAnalysis.query
+            .filter_by(content_digest=digest, analyzer_version=version)
+            .order_by(ImageAnalysis.id.desc())
+            .first()
+        )
+        if row is not None:
+            metrics = row.to_metrics()
+        else:
+            metrics = {k: float(v) for k, v in compute().items()}
+            save_analysis(image_id, metrics, content_digest=digest, analyzer_version=version, commit=commit)
+        metrics_cache.put(key, metrics)
+
+    return dict(metrics)
+
+
+def get_metrics(image_path: str, image_id: int, profile: str = None, digest: str = None,
+                commit: bool = True) -> dict:
+    """
+    Метрики файла: сначала LRU, затем image_analysis по digest,
+    и только при промахе — полный analyze_image с сохранением в БД.
+    digest — sha256 файла, если уже известен (объекты хранилища), чтобы не читать файл.
+    commit=False — строка анализа остаётся в текущей транзакции вызывающего.
+    """
+    profile = profile or _profile
+    return _cached_metrics(
+        digest or file_digest(image_path), image_id, profile,
+        lambda: analyze_image(image_path, profile=profile),
+        commit=commit,
+    )
+
+
+def get_metrics_for_bytes(data: bytes, digest: str, image_id: int, profile: str = None,
+                          commit: bool = True, ctx: AnalysisContext = None) -> dict:
+    """
+    То же для загрузки в памяти; ctx — уже декодированный контекст, если есть
+    (иначе буфер декодируется только при промахе кэша).
+    commit=False — строка анализа остаётся в текущей транзакции вызывающего.
+    """
+    profile = profile or _profile
+    return _cached_metrics(
+        digest, image_id, profile,
+        lambda: analyze_context(ctx or AnalysisContext.from_bytes(data), profile=profile),
+        commit=commit,
+    )
+
+
+def purge_stale_analyses() -> int:
+    """Удаляет кэш-записи, посчитанные другой версией анализатора"""
+    deleted = (
+        ImageAnalysis.query
+        .filter(ImageAnalysis.content_digest.isnot(None))
+        .filter(ImageAnalysis.analyzer_version.notin_(current_versions()))
+        .delete(synchronize_session=False)
+    )
+    db.session.commit()
+    metrics_cache.invalidate(keep_versions=current_versions())
+    return deleted
@@ -0,0 +1,216 @@
+"""
+Поиск почти-дубликатов загрузок по перцептивному хешу.
+
+dHash (64 бита) считается при приёме по серому кадру анализа: знаки разностей
+соседних пикселей уменьшенного до 9x8 изображения. Уменьшенная, пережатая или
+слегка обрезанная копия отличается от оригинала на несколько бит.
+
+Индекс — multi-index hashing: хеш делится на 4 куска по 16 бит, каждый лежит
+в отдельном индексированном столбце images.phash_0..3. Если расстояние Хэмминга
+до запроса не больше r, то хотя бы один кусок отличается не больше чем на
+r // 4 бит (принцип Дирихле), поэтому кандидаты — строки, у которых какой-то
+кусок попадает в окрестность куска запроса радиуса r // 4 (при r <= 7 — 17
+значений на кусок). Это 68 точечных поисков по индексам вместо полного
+просмотра; точное расстояние проверяется только для кандидатов.
+
+Куски распределены неравномерно: у плоских, тёмных и пересвеченных кадров
+они 0x0000 или 0xFFFF. Эти значения в поиск не входят; каждый кусок ищется
+отдельно, и кусок, давший больше MAX_CANDIDATES строк, отбрасывается —
+остальные куски ищутся как обычно. Если отброшен хоть один кусок, точные
+копии (все четыре куска равны) дочитываются отдельным запросом.
+
+    python -m services.near_duplicates backfill   — посчитать хеши старых строк
+"""
+from itertools import combinations
+
+import cv2
+import numpy as np
+from sqlalchemy import and_, case, select
+
+from extensions import db
+from models.image import Image
+from models.processing_session import ProcessingSession
+from models.result import Result
+from models.stored_file import StoredFile
+from services.image_analysis import AnalysisContext
+
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_COLUMNS = tuple(getattr(Image, f"phash_{index}") for index in range(CHUNKS))
+
+# До скольких отличающихся бит из 64 изображения считаются одной фотографией
+DEFAULT_MAX_DISTANCE = 6
+
+# Куски однотонных кадров — у огромной доли строк, поиск по ним не сужает
+DEGENERATE_CHUNKS = frozenset({0, (1 << CHUNK_BITS) - 1})
+MAX_CANDIDATES = 1000
+
+
+def dhash(gray) -> int:
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def to_signed(value: int) -> int:
+    """64-битный хеш -> BIGINT (знаковый в PostgreSQL)"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value & ((1 << HASH_BITS) - 1)
+
+
+def hash_chunks(value: int) -> list:
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * (CHUNKS - 1 - index))) & mask for index in range(CHUNKS)]
+
+
+def hamming(a: int, b: int) -> int:
+    return (to_unsigned(a) ^ to_unsigned(b)).bit_count()
+
+
+def _neighborhood(value: int, radius: int) -> list:
+    """Все CHUNK_BITS-битные значения на расстоянии Хэмминга <= radius"""
+    values = [value]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def set_image_hash(image: Image, value: int):
+    image.phash = to_signed(value)
+    for index, chunk in enumerate(hash_chunks(value)):
+        setattr(image, f"phash_{index}", chunk)
+
+
+def hash_for_upload(digest: str, ctx: AnalysisContext = None, data: bytes = None):
+    """Хеш загрузки: по кадру анализа, из строки с тем же содержимым или декодом data"""
+    if ctx is None:
+        known = (
+            db.session.query(Image.phash)
+            .filter(Image.content_digest == digest, Image.phash.isnot(None))
+            .limit(1)
+            .scalar()
+        )
+        if known is not None:
+            return to_unsigned(known)
+        if data is None:
+            return None
+        ctx = AnalysisContext.from_bytes(data)
+    return dhash(ctx.gray)
+
+
+def _candidates(condition, exclude_image_id, limit: int) -> list:
+    stmt = select(Image.id, Image.phash).where(condition, Image.phash.isnot(None)).limit(limit)
+    if exclude_image_id is not None:
+        stmt = stmt.where(Image.id != exclude_image_id)
+    return db.session.execute(stmt).all()
+
+
+def find_near_duplicates(value: int, max_distance: int = DEFAULT_MAX_DISTANCE,
+                         exclude_image_id: int = None, limit: int = 10) -> list:
+    """[(image_id, расстояние)] по возрастанию расстояния"""
+    radius = max_distance // CHUNKS
+    chunks = hash_chunks(value)
+    candidates = {}
+    saturated = False
+    for column, chunk in zip(CHUNK_COLUMNS, chunks):
+        values = [v for v in _neighborhood(chunk, radius) if v not in DEGENERATE_CHUNKS]
+        if not values:
+            saturated = True
+            continue
+        rows = _candidates(column.in_(values), exclude_image_id, MAX_CANDIDATES + 1)
+        if len(rows) > MAX_CANDIDATES:
+            # Слишком частый кусок не сужает поиск — остальные куски ищутся дальше
+            saturated = True
+            continue
+        candidates.update(rows)
+    if saturated:
+        exact = and_(*(column == chunk for column, chunk in zip(CHUNK_COLUMNS, chunks)))
+        candidates.update(_candidates(exact, exclude_image_id, limit))
+
+    matches = []
+    for image_id, phash in candidates.items():
+        distance = hamming(value, phash)
+        if distance <= max_distance:
+            matches.append((image_id, distance))
+    matches.sort(key=lambda match: (match[1], -match[0]))
+    return matches[:limit]
+
+
+def find_reusable_result(image: Image, max_distance: int = DEFAULT_MAX_DISTANCE):
+    """(Result, расстояние) ближайшего почти-дубликата с готовым результатом, либо None"""
+    if image.phash is None:
+        return None
+    matches = find_near_duplicates(to_unsigned(image.phash), max_distance, exclude_image_id=image.id, limit=50)
+    if not matches:
+        return None
+
+    # Ближайший результат выбирает запрос: только производные объекты хранилища
+    # (с derivation_key), одна строка вместо всех результатов найденных изображений
+    distances = dict(matches)
+    row = (
+        Result.query
+        .join(ProcessingSession, Result.session_id == ProcessingSession.id)
+        .join(StoredFile, StoredFile.relpath == Result.processed_filename)
+        .filter(ProcessingSession.image_id.in_(distances), StoredFile.derivation_key.isnot(None))
+        .add_columns(ProcessingSession.image_id)
+        .order_by(case(distances, value=ProcessingSession.image_id), Result.id.desc())
+        .limit(1)
+        .first()
+    )
+    if row is None:
+        return None
+    result, image_id = row
+    return result, distances[image_id]
+
+
+def backfill(root: str, batch_size: int = 500) -> dict:
+    """Хеши строк без phash; пачками по id, каждая пачка — своя транзакция"""
+    from services.ingest import wait_for_file
+    from services.storage import object_path
+
+    stats = {"hashed": 0, "missing": 0}
+    last_id = 0
+    while True:
+        batch = (
+            Image.query
+            .filter(Image.phash.is_(None), Image.id > last_id)
+            .order_by(Image.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            return stats
+        for image in batch:
+            last_id = image.id
+            path = object_path(root, image.stored_name)
+            try:
+                wait_for_file(path, timeout=0)
+                set_image_hash(image, dhash(AnalysisContext.from_path(path).gray))
+                stats["hashed"] += 1
+            except (OSError, ValueError):
+                stats["missing"] += 1
+        db.session.commit()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app import create_app
+
+    parser = argparse.ArgumentParser(prog="python -m services.near_duplicates", description="Индекс почти-дубликатов")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    flask_app = create_app()
+    with flask_app.app_context():
+        print(json.dumps(backfill(flask_app.config["UPLOAD_FOLDER"])))
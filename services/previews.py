@@ -0,0 +1,210 @@
+"""
+Пирамида превью (по умолчанию 256/1024/2048 px, WebP) для объектов хранилища.
+
+Строится один раз — в фоне после загрузки оригинала или записи результата
+обработки — и лежит в UPLOAD_FOLDER/previews/v<версия>/ab/cd/<digest>_<size>.<ext>.
+Превью неизменяемо для пары (digest, размер), поэтому маршрут /preview отдаёт
+его с сильным ETag и годовым Cache-Control: immutable. Если превью нет
+(старые строки, сбой фоновой сборки), оно строится при первом запросе.
+
+    python -m services.previews backfill   — построить пирамиды для всех объектов
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from models.stored_file import StoredFile
+from services.image_analysis import reduced_decode_flag
+from services.instrumentation import record_written, timed
+from services.storage import digest_from_relpath, object_path
+
+
+PREVIEWS_DIR = "previews"
+# Меняйте при изменении размеров, формата или качества: меняются пути и ETag
+PREVIEW_VERSION = "1"
+
+PREVIEW_SIZES = (256, 1024, 2048)
+PREVIEW_FORMAT = "webp"
+PREVIEW_QUALITY = 80
+
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+MIMETYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+_settings = {"sizes": PREVIEW_SIZES, "format": PREVIEW_FORMAT, "quality": PREVIEW_QUALITY}
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="previews")
+_pending = {}
+_lock = threading.Lock()
+
+
+def preview_sizes() -> tuple:
+    return _settings["sizes"]
+
+
+def preview_mimetype() -> str:
+    return MIMETYPES[_settings["format"]]
+
+
+def preview_etag(digest: str, size: int) -> str:
+    return f"{digest}-{size}-v{PREVIEW_VERSION}-{_settings['format']}"
+
+
+def preview_relpath(digest: str, size: int) -> str:
+    return "/".join((
+        PREVIEWS_DIR, f"v{PREVIEW_VERSION}", digest[:2], digest[2:4],
+        f"{digest}_{size}.{_settings['format']}",
+    ))
+
+
+def _encode_params():
+    if _settings["format"] == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, _settings["quality"]]
+    return [cv2.IMWRITE_JPEG_QUALITY, _settings["quality"], cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+
+
+def _fit(image, size: int):
+    height, width = image.shape[:2]
+    if max(height, width) <= size:
+        return image
+    scale = size / max(height, width)
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def _decode(source):
+    """source — путь к файлу или bytes; JPEG сразу декодируется уменьшенным под большее превью"""
+    largest = max(preview_sizes())
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        flag = reduced_decode_flag(io.BytesIO(source), min_side=largest)
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flag)
+    return cv2.imread(source, reduced_decode_flag(source, min_side=largest))
+
+
+def build_pyramid(root: str, digest: str, source, sizes=None) -> list:
+    """
+    Строит недостающие превью; каждый уровень уменьшается из предыдущего (INTER_AREA).
+    Возвращает записанные пути.
+    """
+    sizes = sorted(sizes or preview_sizes(), reverse=True)
+    missing = [size for size in sizes if not os.path.exists(object_path(root, preview_relpath(digest, size)))]
+    if not missing:
+        return []
+
+    with timed("iqa_preview_seconds"):
+        image = _decode(source)
+        if image is None:
+            raise ValueError("Не удалось загрузить изображение")
+
+        written = []
+        for size in sizes:
+            image = _fit(image, size)
+            if size not in missing:
+                continue
+            path = object_path(root, preview_relpath(digest, size))
+            ok, encoded = cv2.imencode("." + _settings["format"], image, _encode_params())
+            if not ok:
+                raise ValueError(f"Не удалось закодировать превью {size}px")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(encoded.tobytes())
+            os.replace(tmp_path, path)
+            record_written("preview", path)
+            written.append(path)
+    return written
+
+
+def schedule_pyramid(root: str, digest: str, source):
+    """Фоновая сборка; повторный вызов для того же digest не дублирует работу"""
+    with _lock:
+        future = _pending.get(digest)
+        if future is not None:
+            return future
+        future = _pending[digest] = _executor.submit(build_pyramid, root, digest, source)
+
+    def _done(_):
+        with _lock:
+            _pending.pop(digest, None)
+
+    future.add_done_callback(_done)
+    return future
+
+
+def ensure_preview(root: str, digest: str, relpath: str, size: int) -> str:
+    """Путь превью; ждёт фоновую сборку или строит синхронно из объекта хранилища"""
+    path = object_path(root, preview_relpath(digest, size))
+    if os.path.exists(path):
+        return path
+
+    with _lock:
+        future = _pending.get(digest)
+    if future is not None:
+        try:
+            future.result()
+        except (OSError, ValueError):
+            pass
+        if os.path.exists(path):
+            return path
+
+    # ingest сам планирует сборку превью, поэтому импорт — здесь
+    from services.ingest import wait_for_file
+
+    source = object_path(root, relpath)
+    wait_for_file(source)
+    build_pyramid(root, digest, source)
+    return path
+
+
+def preview_url(name: str, size: int) -> str:
+    """
+    URL превью для пути относительно UPLOAD_FOLDER; файлы вне хранилища
+    (строки до content-addressed storage) отдаются как есть из static.
+    """
+    from flask import url_for
+
+    digest = digest_from_relpath(name)
+    if digest is None:
+        return url_for("static", filename="uploads/" + name)
+    size = min((s for s in preview_sizes() if s >= size), default=max(preview_sizes()))
+    return url_for("main.preview", digest=digest, size=size)
+
+
+def init_previews(app):
+    _settings["sizes"] = tuple(app.config.get("PREVIEW_SIZES", PREVIEW_SIZES))
+    _settings["format"] = app.config.get("PREVIEW_FORMAT", PREVIEW_FORMAT)
+    _settings["quality"] = app.config.get("PREVIEW_QUALITY", PREVIEW_QUALITY)
+    app.add_template_global(preview_url)
+
+
+def backfill(root: str, batch_size: int = 200) -> dict:
+    stats = {"built": 0, "complete": 0, "missing": 0, "error": 0}
+    for stored in StoredFile.query.order_by(StoredFile.id).yield_per(batch_size):
+        source = object_path(root, stored.relpath)
+        if not os.path.exists(source):
+            stats["missing"] += 1
+            continue
+        try:
+            stats["built" if build_pyramid(root, stored.digest, source) else "complete"] += 1
+        except (OSError, ValueError):
+            stats["error"] += 1
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app import create_app
+
+    parser = argparse.ArgumentParser(prog="python -m services.previews", description="Пирамиды превью")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    flask_app = create_app()
+    with flask_app.app_context():
+        print(json.dumps(backfill(flask_app.config["UPLOAD_FOLDER"])))
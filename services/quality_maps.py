@@ -0,0 +1,227 @@
+"""
+Карты качества: метрики по скользящему окну вместо одного числа на кадр.
+
+Карта — сетка оценок 0..100 для окон window x window с шагом stride на
+кадре разрешения анализа (AnalysisContext, <= 512 px). Суммы и суммы
+квадратов окна берутся из интегральных изображений (cv2.integral2), поэтому
+окно любого размера стоит O(1), а вся карта — несколько проходов по кадру.
+
+    sharpness   формула raw_fast_sharpness (дисперсия Laplacian + Sobel) по окну
+    brightness  средняя яркость окна (без поправки на энтропию гистограммы)
+    contrast    RMS-контраст окна std / mean (без штрафа is_low_contrast)
+    noise       оценка Immerkær по окну
+
+Оверлей — карта в цвете поверх кадра: красный — хуже, синий — лучше.
+Как и превью, он неизменяем для пары (digest, метрика) и лежит в
+UPLOAD_FOLDER/maps/v<версия>/ab/cd/<digest>_<метрика>.webp; сетки всех
+метрик в JSON — там же, <digest>.json.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from services.image_analysis import FAST_CALIBRATION, IMMERKAER_KERNEL, AnalysisContext
+from services.instrumentation import record_written, timed
+from services.storage import digest_from_relpath, object_path
+
+
+MAP_METRICS = ("sharpness", "brightness", "contrast", "noise")
+
+# Окно и шаг в пикселях кадра анализа
+MAP_WINDOW = 32
+MAP_STRIDE = 16
+
+MAPS_DIR = "maps"
+# Меняйте при изменении формул, окна или вида оверлея: меняются пути и ETag
+MAP_VERSION = "1"
+OVERLAY_ALPHA = 0.45
+OVERLAY_QUALITY = 80
+OVERLAY_MIMETYPE = "image/webp"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quality-maps")
+
+
+def _window_origins(size: int, window: int, stride: int):
+    """Начала окон; последнее окно прижато к краю, чтобы покрыть весь кадр"""
+    origins = np.arange(0, size - window + 1, stride)
+    if origins[-1] != size - window:
+        origins = np.append(origins, size - window)
+    return origins
+
+
+def _calibrate(metric: str, scores):
+    """calibrate_fast для массива оценок"""
+    slope, intercept = FAST_CALIBRATION[metric]
+    return np.clip(slope * scores + intercept, 0, 100)
+
+
+class WindowSums:
+    """Суммы по всем окнам сетки из интегрального изображения"""
+
+    def __init__(self, shape, window: int, stride: int):
+        height, width = shape[:2]
+        self.window = min(window, height, width)
+        self.area = float(self.window * self.window)
+        self.y0 = _window_origins(height, self.window, stride)[:, None]
+        self.x0 = _window_origins(width, self.window, stride)[None, :]
+        self.y1 = self.y0 + self.window
+        self.x1 = self.x0 + self.window
+
+    def sums(self, integral):
+        return integral[self.y1, self.x1] - integral[self.y0, self.x1] - integral[self.y1, self.x0] + integral[self.y0, self.x0]
+
+    def mean_var(self, src):
+        total, squares = cv2.integral2(src, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        mean = self.sums(total) / self.area
+        var = np.maximum(self.sums(squares) / self.area - mean ** 2, 0)
+        return mean, var
+
+
+def quality_maps(ctx: AnalysisContext, window: int = MAP_WINDOW, stride: int = MAP_STRIDE) -> dict:
+    """{метрика: float32-массив оценок 0..100}, строки — окна сверху вниз"""
+    gray = ctx.gray
+    with timed("iqa_metric_seconds", metric="quality_maps"):
+        grid = WindowSums(gray.shape, window, stride)
+
+        mean, var = grid.mean_var(gray)
+        std = np.sqrt(var)
+
+        _, lap_var = grid.mean_var(cv2.Laplacian(gray, cv2.CV_32F))
+        grad_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_REFLECT)
+        grad_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_REFLECT)
+        _, sobel_var = grid.mean_var(cv2.magnitude(grad_x, grad_y))
+        sobel_var /= (4 * 255 * np.sqrt(2)) ** 2
+        sharpness = np.minimum(100, np.log1p((lap_var + sobel_var * 100) / 2) * 10)
+
+        response = np.abs(cv2.filter2D(gray, cv2.CV_32F, IMMERKAER_KERNEL))
+        sigma = np.sqrt(np.pi / 2) * grid.sums(cv2.integral(response, sdepth=cv2.CV_64F)) / (6 * grid.area)
+        noise = np.maximum(0, 100 - sigma * 5)
+
+        maps = {
+            "sharpness": _calibrate("sharpness", sharpness),
+            "brightness": mean / 255 * 100,
+            "contrast": np.clip(np.divide(std, mean, out=np.zeros_like(std), where=mean > 0) * 200, 0, 100),
+            "noise": _calibrate("noise", noise),
+        }
+    return {metric: values.astype(np.float32) for metric, values in maps.items()}
+
+
+def render_overlay(bgr, values, alpha: float = OVERLAY_ALPHA):
+    """Карта, растянутая на кадр, в палитре JET поверх него"""
+    height, width = bgr.shape[:2]
+    badness = np.clip(255 - values * 2.55, 0, 255).astype(np.uint8)
+    heat = cv2.applyColorMap(cv2.resize(badness, (width, height), interpolation=cv2.INTER_LINEAR), cv2.COLORMAP_JET)
+    return cv2.addWeighted(bgr, 1 - alpha, heat, alpha, 0)
+
+
+def overlay_relpath(digest: str, metric: str) -> str:
+    return "/".join((MAPS_DIR, f"v{MAP_VERSION}", digest[:2], digest[2:4], f"{digest}_{metric}.webp"))
+
+
+def overlay_etag(digest: str, metric: str) -> str:
+    return f"{digest}-{metric}-map-v{MAP_VERSION}"
+
+
+def maps_relpath(digest: str) -> str:
+    return "/".join((MAPS_DIR, f"v{MAP_VERSION}", digest[:2], digest[2:4], f"{digest}.json"))
+
+
+def maps_etag(digest: str) -> str:
+    return f"{digest}-maps-v{MAP_VERSION}"
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_overlays(root: str, digest: str, ctx: AnalysisContext, maps: dict = None) -> list:
+    """Записывает недостающие оверлеи всех метрик; возвращает записанные пути"""
+    paths = {metric: object_path(root, overlay_relpath(digest, metric)) for metric in MAP_METRICS}
+    missing = [metric for metric, path in paths.items() if not os.path.exists(path)]
+    if not missing:
+        return []
+
+    maps = maps or quality_maps(ctx)
+    written = []
+    for metric in missing:
+        path = paths[metric]
+        with timed("iqa_encode_seconds", format="webp"):
+            ok, encoded = cv2.imencode(
+                ".webp", render_overlay(ctx.bgr, maps[metric]), [cv2.IMWRITE_WEBP_QUALITY, OVERLAY_QUALITY]
+            )
+        if not ok:
+            raise ValueError(f"Не удалось закодировать карту {metric}")
+        _write_atomic(path, encoded.tobytes())
+        record_written("quality_map", path)
+        written.append(path)
+    return written
+
+
+def _build_from(root: str, digest: str, source):
+    ctx = source if isinstance(source, AnalysisContext) else AnalysisContext.from_path(source)
+    return build_overlays(root, digest, ctx)
+
+
+def schedule_overlays(root: str, digest: str, source):
+    """Фоновая сборка оверлеев; source — AnalysisContext загрузки или путь к объекту"""
+    return _executor.submit(_build_from, root, digest, source)
+
+
+def ensure_overlay(root: str, digest: str, relpath: str, metric: str) -> str:
+    """Путь оверлея; при отсутствии строится из объекта хранилища"""
+    path = object_path(root, overlay_relpath(digest, metric))
+    if not os.path.exists(path):
+        # ingest импортирует этот модуль, поэтому импорт — здесь
+        from services.ingest import wait_for_file
+
+        source = object_path(root, relpath)
+        wait_for_file(source)
+        _build_from(root, digest, source)
+    return path
+
+
+def maps_to_json(maps: dict, ctx: AnalysisContext, window: int = MAP_WINDOW, stride: int = MAP_STRIDE) -> dict:
+    height, width = ctx.gray.shape
+    return {
+        "width": width,
+        "height": height,
+        "window": min(window, height, width),
+        "stride": stride,
+        "maps": {metric: np.round(values, 1).tolist() for metric, values in maps.items()},
+    }
+
+
+def ensure_maps_json(root: str, digest: str, relpath: str) -> str:
+    """Путь JSON карт объекта; при отсутствии карты считаются из объекта хранилища один раз"""
+    path = object_path(root, maps_relpath(digest))
+    if not os.path.exists(path):
+        # ingest импортирует этот модуль, поэтому импорт — здесь
+        from services.ingest import wait_for_file
+
+        source = object_path(root, relpath)
+        wait_for_file(source)
+        ctx = AnalysisContext.from_path(source)
+        _write_atomic(path, json.dumps(maps_to_json(quality_maps(ctx), ctx)).encode("utf-8"))
+    return path
+
+
+def quality_map_url(name: str, metric: str):
+    """URL оверлея для пути относительно UPLOAD_FOLDER; None для файлов вне хранилища"""
+    from flask import url_for
+
+    digest = digest_from_relpath(name)
+    if digest is None:
+        return None
+    return url_for("main.quality_map_overlay", digest=digest, metric=metric)
+
+
+def init_quality_maps(app):
+    app.add_template_global(quality_map_url)
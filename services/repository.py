@@ -0,0 +1,111 @@
+"""
+Запись и чтение сессий и результатов для маршрутов.
+
+Функции добавляют строки и делают flush (id доступен сразу), но не коммитят:
+маршрут вызывает commit() один раз в конце, и все строки запроса попадают
+в БД одной транзакцией.
+
+История обработок читается страницами по ключу (created_at, id) по убыванию —
+индекс ix_processing_sessions_image_created, — поэтому страница стоит
+O(размер страницы) при любом числе обработок изображения. Результат
+подгружается тем же запросом (JOIN), а не отдельным запросом на сессию.
+"""
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import contains_eager, joinedload
+
+from extensions import db
+from models.processing_session import ProcessingSession
+from models.result import Result
+from services.instrumentation import timed
+
+
+HISTORY_PAGE_SIZE = 20
+_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+# Столбцы сессии для метрик; шум лежит в blur_score, контраст — в color_balance_score
+SESSION_COLUMNS = {
+    "brightness": "brightness_score",
+    "sharpness": "sharpness_score",
+    "noise": "blur_score",
+    "contrast": "color_balance_score",
+}
+
+
+def add_session(image_id: int, metrics: dict) -> ProcessingSession:
+    session = ProcessingSession(
+        image_id=image_id,
+        **{column: metrics[metric] for metric, column in SESSION_COLUMNS.items()},
+    )
+    db.session.add(session)
+    db.session.flush()
+    return session
+
+
+def session_metrics(session: ProcessingSession) -> dict:
+    """Метрики оригинала, сохранённые в сессии"""
+    return {metric: getattr(session, column) for metric, column in SESSION_COLUMNS.items()}
+
+
+def add_result(session_id: int, processed_filename: str, verdict: str, quality_score: float) -> Result:
+    result = Result(
+        session_id=session_id,
+        processed_filename=processed_filename,
+        quality_score=quality_score,
+        verdict=verdict,
+    )
+    db.session.add(result)
+    db.session.flush()
+    return result
+
+
+def commit(route: str):
+    with timed("iqa_db_commit_seconds", route=route):
+        db.session.commit()
+
+
+def get_result(result_id: int):
+    """Результат вместе с сессией и изображением — один запрос; None, если нет"""
+    return (
+        Result.query
+        .options(joinedload(Result.session).joinedload(ProcessingSession.image))
+        .filter(Result.id == result_id)
+        .first()
+    )
+
+
+def encode_cursor(session: ProcessingSession) -> str:
+    return f"{session.created_at.strftime(_CURSOR_FORMAT)}-{session.id}"
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Курсор страницы -> (created_at, id); ValueError для испорченного"""
+    created_at, _, session_id = cursor.partition("-")
+    return datetime.strptime(created_at, _CURSOR_FORMAT), int(session_id)
+
+
+def history_page(image_id: int, cursor: str = None, limit: int = HISTORY_PAGE_SIZE) -> tuple:
+    """
+    Обработки изображения (сессии с результатом), новые первыми ->
+    (сессии, курсор следующей страницы или None)
+    """
+    query = (
+        ProcessingSession.query
+        .join(ProcessingSession.result)
+        .options(contains_eager(ProcessingSession.result))
+        .filter(ProcessingSession.image_id == image_id)
+    )
+    if cursor:
+        query = query.filter(
+            tuple_(ProcessingSession.created_at, ProcessingSession.id) < tuple_(*decode_cursor(cursor))
+        )
+    sessions = (
+        query
+        .order_by(ProcessingSession.created_at.desc(), ProcessingSession.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    if len(sessions) > limit:
+        return sessions[:limit], encode_cursor(sessions[limit - 1])
+    return sessions, None
@@ -0,0 +1,97 @@
+"""
+Декларативные правила решений по метрикам.
+
+Правило — (действие, метрика, оператор, порог, пояснение). Таблица
+компилируется в массивы (индексы метрик, знаки, пороги), и решения для
+пачки векторов метрик считаются одной операцией NumPy:
+
+    signs * values[:, columns] < signs * thresholds
+
+"<" даёт знак +1, ">" — знак -1. Пустое значение метрики (None/NaN, например
+в старых строках БД) правило не включает; словарь без нужного ключа в
+evaluate_one — KeyError. Результат для строки можно упаковать в битовую маску: бит i —
+i-е правило таблицы.
+"""
+import hashlib
+import json
+from collections import namedtuple
+
+import numpy as np
+
+
+Rule = namedtuple("Rule", "action metric op threshold message")
+
+_SIGNS = {"<": 1.0, ">": -1.0}
+
+# Рекомендации по результатам анализа (recommend_actions)
+RECOMMEND_RULES = (
+    Rule("enhance_brightness", "brightness", "<", 90, "Изображение слишком тёмное"),
+    Rule("sharpen", "sharpness", "<", 100, "Низкая резкость"),
+    Rule("denoise", "noise", ">", 15, "Присутствует шум"),
+)
+
+# Этапы авто-режима обработки (compile_plan с auto_improve)
+AUTO_RULES = (
+    Rule("enhance_brightness", "brightness", "<", 65, "Повышена яркость"),
+    Rule("contrast", "contrast", "<", 65, "Повышен контраст"),
+    Rule("sharpen", "sharpness", "<", 70, "Улучшена резкость"),
+    Rule("denoise", "noise", "<", 70, "Убран шум"),
+)
+
+
+class RuleSet:
+    def __init__(self, rules):
+        for rule in rules:
+            if rule.op not in _SIGNS:
+                raise ValueError(f"Неизвестный оператор правила: {rule.op}")
+        self.rules = tuple(rules)
+        self.actions = tuple(rule.action for rule in self.rules)
+        # Порядок столбцов матрицы метрик
+        self.metrics = tuple(dict.fromkeys(rule.metric for rule in self.rules))
+        self._columns = np.array([self.metrics.index(rule.metric) for rule in self.rules], dtype=np.intp)
+        self._signs = np.array([_SIGNS[rule.op] for rule in self.rules])
+        self._limits = self._signs * np.array([rule.threshold for rule in self.rules], dtype=np.float64)
+        self._bits = np.left_shift(1, np.arange(len(self.rules), dtype=np.int64))
+
+    def thresholds(self) -> dict:
+        return {rule.metric: rule.threshold for rule in self.rules}
+
+    def to_matrix(self, rows) -> np.ndarray:
+        """Список словарей метрик -> float-матрица (строки x self.metrics), пропуски — NaN"""
+        return np.array([[row.get(metric) for metric in self.metrics] for row in rows], dtype=np.float64)
+
+    def evaluate(self, matrix) -> np.ndarray:
+        """bool-матрица (строки x правила) для float-матрицы метрик в порядке self.metrics"""
+        matrix = np.asarray(matrix, dtype=np.float64).reshape(-1, len(self.metrics))
+        # NaN в сравнении даёт False: правило без метрики не срабатывает
+        return self._signs * matrix[:, self._columns] < self._limits
+
+    def masks(self, matrix) -> np.ndarray:
+        return self.evaluate(matrix) @ self._bits
+
+    def evaluate_one(self, metrics: dict) -> dict:
+        """
+        {действие: bool} для одного словаря метрик. Отсутствующий ключ — KeyError:
+        словарь без метрики — ошибка вызывающего, а не «правило не сработало»
+        """
+        missing = [metric for metric in self.metrics if metric not in metrics]
+        if missing:
+            raise KeyError(f"Нет метрик для правил: {', '.join(missing)}")
+        fired = self.evaluate(self.to_matrix([metrics]))[0]
+        return dict(zip(self.actions, fired.tolist()))
+
+    def fired_rules(self, mask: int) -> list:
+        return [rule for index, rule in enumerate(self.rules) if mask >> index & 1]
+
+    def version(self) -> str:
+        payload = json.dumps([list(rule[:4]) for rule in self.rules])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+
+RECOMMEND = RuleSet(RECOMMEND_RULES)
+AUTO = RuleSet(AUTO_RULES)
+
+
+def rules_version() -> str:
+    """Версия обоих наборов: строки БД с другой версией нужно пересчитать"""
+    return hashlib.sha256((RECOMMEND.version() + AUTO.version()).encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,194 @@
+"""
+Content-addressed хранилище загрузок и результатов обработки.
+
+Объект лежит в UPLOAD_FOLDER/objects/ab/cd/<sha256><ext>: одинаковые файлы
+хранятся один раз, а одноимённые загрузки разных пользователей не затирают
+друг друга. Строка stored_files считает ссылки из images/results; результат
+обработки дополнительно находится по derivation_key = (оригинал, план,
+PIPELINE_VERSION, параметры кодирования), поэтому повторный такой же запрос не пересчитывается.
+
+    python -m services.storage purge   — удалить объекты без ссылок
+"""
+import hashlib
+import json
+import os
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models.image import Image
+from models.result import Result
+from models.stored_file import StoredFile
+from services.image_processing import PIPELINE_VERSION
+from services.metrics_cache import file_digest
+
+
+OBJECTS_DIR = "objects"
+TMP_DIR = "tmp"
+DEFAULT_EXTENSION = ".png"
+
+
+def object_relpath(digest: str, ext: str) -> str:
+    return "/".join((OBJECTS_DIR, digest[:2], digest[2:4], digest + ext))
+
+
+def object_path(root: str, relpath: str) -> str:
+    return os.path.join(root, *relpath.split("/"))
+
+
+def tmp_dir(root: str) -> str:
+    """Каталог для недописанных результатов — на том же разделе, что и объекты"""
+    path = os.path.join(root, OBJECTS_DIR, TMP_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def digest_from_relpath(relpath: str):
+    """Digest объекта по его пути; None для файлов вне хранилища"""
+    if not relpath.startswith(OBJECTS_DIR + "/"):
+        return None
+    return os.path.splitext(relpath.rsplit("/", 1)[1])[0]
+
+
+def file_extension(filename: str) -> str:
+    ext = os.path.splitext(filename)[1].lower()
+    return ext or DEFAULT_EXTENSION
+
+
+def derivation_key(original_digest: str, plan: list, ext: str, encoding: dict = None) -> str:
+    """encoding — параметры кодирования, влияющие на байты результата (services.encoding.encoding_key)"""
+    payload = json.dumps(
+        {"original": original_digest, "plan": plan, "pipeline": PIPELINE_VERSION, "ext": ext,
+         "encoding": encoding or {}},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def add_reference(stored: StoredFile):
+    # Выражение, а не +1 в Python: параллельные запросы не теряют инкременты
+    stored.ref_count = StoredFile.ref_count + 1
+
+
+def _insert_or_get(stored: StoredFile) -> tuple:
+    """
+    Вставка строки объекта в точке сохранения -> (строка, вставлена ли).
+    Тот же digest одновременно вставил другой запрос — нарушение уникальности
+    откатывает только точку сохранения, и берётся его строка.
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.add(stored)
+        return stored, True
+    except IntegrityError:
+        existing = StoredFile.query.filter_by(digest=stored.digest).first()
+        if existing is None and stored.derivation_key is not None:
+            # Тот же результат обработки с другими байтами — уникален и derivation_key
+            existing = StoredFile.query.filter_by(derivation_key=stored.derivation_key).one()
+        if existing is None:
+            raise
+        return existing, False
+
+
+def acquire_upload(digest: str, filename: str, size: int):
+    """
+    Ссылка на объект загрузки -> (stored, needs_write). Ничего не коммитит;
+    needs_write — объекта ещё нет, файл нужно записать после коммита.
+    """
+    stored = StoredFile.query.filter_by(digest=digest).first()
+    needs_write = stored is None
+    if stored is None:
+        stored, needs_write = _insert_or_get(StoredFile(
+            digest=digest,
+            relpath=object_relpath(digest, file_extension(filename)),
+            size=size,
+            ref_count=0,
+        ))
+    add_reference(stored)
+    return stored, needs_write
+
+
+def find_derived(root: str, key: str):
+    """Готовый результат обработки по derivation_key, если его файл на месте"""
+    stored = StoredFile.query.filter_by(derivation_key=key).first()
+    if stored is not None and os.path.exists(object_path(root, stored.relpath)):
+        return stored
+    return None
+
+
+def store_derived(root: str, tmp_path: str, key: str) -> StoredFile:
+    """
+    Переносит свежий результат обработки в хранилище и добавляет ссылку.
+    Если такой результат (или такое же содержимое) уже есть — временный файл удаляется.
+    """
+    stored = find_derived(root, key)
+    if stored is None:
+        digest = file_digest(tmp_path)
+        stored = StoredFile.query.filter_by(digest=digest).first()
+        if stored is None:
+            stored, _ = _insert_or_get(StoredFile(
+                digest=digest,
+                relpath=object_relpath(digest, file_extension(tmp_path)),
+                size=os.path.getsize(tmp_path),
+                ref_count=0,
+                derivation_key=key,
+            ))
+        if stored.derivation_key is None:
+            stored.derivation_key = key
+
+    destination = object_path(root, stored.relpath)
+    if os.path.exists(destination):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(tmp_path, destination)
+
+    db.session.flush()
+    add_reference(stored)
+    return stored
+
+
+def _release(connection, condition):
+    connection.execute(
+        StoredFile.__table__.update()
+        .where(condition)
+        .values(ref_count=StoredFile.ref_count - 1)
+    )
+
+
+@event.listens_for(Image, "after_delete")
+def _release_image(mapper, connection, image):
+    if image.content_digest:
+        _release(connection, StoredFile.digest == image.content_digest)
+
+
+@event.listens_for(Result, "after_delete")
+def _release_result(mapper, connection, result):
+    _release(connection, StoredFile.relpath == result.processed_filename)
+
+
+def purge_unreferenced(root: str) -> int:
+    """Удаляет объекты, на которые не осталось ссылок"""
+    orphans = StoredFile.query.filter(StoredFile.ref_count <= 0).all()
+    for stored in orphans:
+        path = object_path(root, stored.relpath)
+        if os.path.exists(path):
+            os.remove(path)
+        db.session.delete(stored)
+    db.session.commit()
+    return len(orphans)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from app import create_app
+
+    parser = argparse.ArgumentParser(prog="python -m services.storage", description="Обслуживание хранилища файлов")
+    parser.add_argument("command", choices=["purge"])
+    args = parser.parse_args()
+
+    flask_app = create_app()
+    with flask_app.app_context():
+        print(json.dumps({"purged": purge_unreferenced(flask_app.config["UPLOAD_FOLDER"])}))
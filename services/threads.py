@@ -0,0 +1,120 @@
+"""
+Бюджет потоков CV на процесс.
+
+CPU_BUDGET ядер делится поровну между процессами развёртывания: веб-воркерами
+(WEB_CONCURRENCY, как у gunicorn) и процессами обработки (JOB_WORKERS).
+Доля процесса задаёт cv2.setNumThreads и размер общего пула потоков, на котором
+parallel_map считает независимые метрики и полосы тяжёлых фильтров.
+
+Дополнительные потоки берутся из доли процесса без ожидания: при низкой нагрузке
+один запрос занимает все ядра доли, при высокой — запросы выполняются
+последовательно в своих потоках, и ядра не переподписываются.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
+
+
+_state = {"threads": 1}
+_tokens = threading.BoundedSemaphore(1)
+_tokens.acquire()
+_executor = None
+_lock = threading.Lock()
+
+
+def cpu_budget(config=None) -> int:
+    budget = (config or {}).get("CPU_BUDGET")
+    return int(budget) if budget else (os.cpu_count() or 1)
+
+
+def process_count(config=None) -> int:
+    """Процессы, делящие бюджет: веб-воркеры + процессы обработки"""
+    config = config or {}
+    web = int(os.environ.get("WEB_CONCURRENCY", config.get("WEB_WORKERS", 1)))
+    return max(1, web) + max(0, int(config.get("JOB_WORKERS", 0)))
+
+
+def threads_per_process(config=None) -> int:
+    return max(1, cpu_budget(config) // process_count(config))
+
+
+def configure_threads(threads: int):
+    """Доля процесса: потоки OpenCV и пул parallel_map (поток вызывающего — один из них)"""
+    global _tokens, _executor
+    threads = max(1, int(threads))
+    cv2.setNumThreads(threads)
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _state["threads"] = threads
+        _tokens = threading.BoundedSemaphore(threads)
+        # Сам вызывающий поток уже занят работой: свободны threads - 1
+        _tokens.acquire()
+
+
+def thread_budget() -> int:
+    return _state["threads"]
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, _state["threads"] - 1), thread_name_prefix="cv")
+        return _executor
+
+
+def _borrow(tokens, wanted: int) -> int:
+    borrowed = 0
+    while borrowed < wanted and tokens.acquire(blocking=False):
+        borrowed += 1
+    return borrowed
+
+
+def parallel_map(func, items) -> list:
+    """
+    [func(item) for item in items] на свободных потоках доли процесса.
+    Если свободных нет, всё считается в вызывающем потоке; порядок результатов сохраняется.
+    func должен отпускать GIL (свёртки OpenCV, операции NumPy над массивами).
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    tokens = _tokens
+    borrowed = _borrow(tokens, len(items) - 1)
+    if not borrowed:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    next_index = iter(range(len(items)))
+    index_lock = threading.Lock()
+
+    def drain():
+        while True:
+            with index_lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            results[index] = func(items[index])
+
+    try:
+        futures = [_get_executor().submit(drain) for _ in range(borrowed)]
+        try:
+            drain()
+        finally:
+            # Даже при ошибке ждём помощников: они ещё пишут в results
+            wait(futures)
+        for future in futures:
+            future.result()
+    finally:
+        for _ in range(borrowed):
+            tokens.release()
+    return results
+
+
+def init_threads(app):
+    configure_threads(threads_per_process(app.config))
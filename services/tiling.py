@@ -0,0 +1,200 @@
+"""
+Полосовое (tiled) выполнение плана обработки для очень больших изображений.
+
+Кадр обрабатывается горизонтальными полосами на всю ширину, на месте.
+Каждой полосе фильтра добавляется гало по радиусу ядра (bilateral d=7 → 3
+строки, Gaussian sigma=2.5 → 8 строк), поэтому результат совпадает с
+полнокадровым execute_plan попиксельно. Глобальные статистики (средняя
+яркость, гистограммы каналов) собираются отдельным потоковым проходом;
+CLAHE строится по полной плоскости L — одному байту на пиксель.
+
+filter_parallel — та же схема с гало для полнокадрового режима: полосы фильтра
+считаются на свободных потоках доли процесса (services/threads.py).
+"""
+import cv2
+import numpy as np
+
+from services.image_processing import (
+    channel_histograms,
+    fuse_brightness_lut,
+    gamma_table,
+    mean_after_lut,
+    sharpen_image,
+    denoise_image,
+)
+from services.instrumentation import timed
+from services.threads import parallel_map, thread_budget
+
+
+# Радиус ядра по вертикали: сколько строк соседней полосы нужно фильтру
+STAGE_HALO = {
+    "denoise": 7 // 2,
+    # cv2.GaussianBlur для uint8: ksize = round(sigma * 3 * 2 + 1) | 1 = 17
+    "sharpen": 17 // 2,
+    "brightness": 0,
+    "contrast": 0,
+}
+
+# Полосовые буферы на строку: вход с гало, выход, размытие/LAB, сохранённое гало
+BAND_BUFFERS = 4
+
+MIN_BAND_ROWS = 32
+
+# Высота полосы filter_parallel: результаты полос в работе — budget * PARALLEL_BAND_ROWS строк
+PARALLEL_BAND_ROWS = 512
+
+
+def _has_contrast(plan) -> bool:
+    return any(stage == "contrast" for stage, _ in plan)
+
+
+def full_frame_footprint(shape, plan) -> int:
+    """
+    Пиковая память execute_plan в байтах: кадр + запасной кадр + серый (+ L, L_clahe)
+    и результаты полос filter_parallel на потоках доли процесса.
+    """
+    height, width = shape[:2]
+    halo = max((STAGE_HALO[stage] for stage, _ in plan), default=0)
+    frame = height * width * 3
+    planes = height * width * (3 if _has_contrast(plan) else 1)
+    bands = thread_budget() * (PARALLEL_BAND_ROWS + 2 * halo) * width * 3 if thread_budget() > 1 else 0
+    return 2 * frame + planes + bands
+
+
+def tiled_footprint(shape, plan, band_rows: int) -> int:
+    height, width = shape[:2]
+    halo = max((STAGE_HALO[stage] for stage, _ in plan), default=0)
+    frame = height * width * 3
+    planes = height * width * 2 if _has_contrast(plan) else 0
+    return frame + planes + BAND_BUFFERS * (band_rows + 2 * halo) * width * 3
+
+
+def band_rows_for_budget(shape, plan, max_memory_bytes: int) -> int:
+    height, width = shape[:2]
+    halo = max((STAGE_HALO[stage] for stage, _ in plan), default=0)
+    fixed = tiled_footprint(shape, plan, 0)
+    rows = (max_memory_bytes - fixed) // (BAND_BUFFERS * width * 3) - 2 * halo
+    if rows < max(MIN_BAND_ROWS, halo):
+        raise ValueError(
+            f"Изображение {width}x{height} не помещается в лимит памяти "
+            f"{max_memory_bytes // (1 << 20)} МБ даже в полосовом режиме"
+        )
+    return int(min(rows, height))
+
+
+def _bands(height: int, band_rows: int):
+    for y0 in range(0, height, band_rows):
+        yield y0, min(y0 + band_rows, height)
+
+
+def _filter_in_bands(image, band_rows: int, halo: int, apply):
+    """
+    apply(src) -> dst той же формы. Полосы пишутся обратно в image; исходные
+    строки, нужные следующей полосе как верхнее гало, сохраняются заранее.
+    """
+    height = image.shape[0]
+    band_rows = max(band_rows, halo)
+    saved_top = None
+    for y0, y1 in _bands(height, band_rows):
+        top = max(0, y0 - halo)
+        bottom = min(height, y1 + halo)
+
+        src = np.empty((bottom - top,) + image.shape[1:], dtype=image.dtype)
+        if saved_top is not None:
+            src[:y0 - top] = saved_top
+        src[y0 - top:] = image[y0:bottom]
+
+        result = apply(src)
+
+        saved_top = image[max(y0, y1 - halo):y1].copy() if halo else None
+        image[y0:y1] = result[y0 - top:y0 - top + (y1 - y0)]
+
+
+def filter_parallel(src, dst, halo: int, apply):
+    """
+    apply(src, dst=None) — фильтр с вертикальным радиусом halo; результат пишется в dst
+    (не должен совпадать с src). Полосы с гало считаются на свободных потоках;
+    при доле в один поток или невысоком кадре — одним вызовом на весь кадр.
+    """
+    height = src.shape[0]
+    band_rows = max(PARALLEL_BAND_ROWS, halo)
+    if thread_budget() < 2 or height <= band_rows:
+        return apply(src, dst=dst)
+
+    def run(band):
+        y0, y1 = band
+        top = max(0, y0 - halo)
+        bottom = min(height, y1 + halo)
+        result = apply(src[top:bottom])
+        dst[y0:y1] = result[y0 - top:y0 - top + (y1 - y0)]
+
+    parallel_map(run, _bands(height, band_rows))
+    return dst
+
+
+def _brightness_in_bands(image, band_rows: int, gamma: float = None):
+    # Первый потоковый проход: средняя яркость и гистограммы каналов
+    gray_sum = 0.0
+    hists = np.zeros((3, 256))
+    for y0, y1 in _bands(image.shape[0], band_rows):
+        band = image[y0:y1]
+        gray_sum += cv2.sumElems(cv2.cvtColor(band, cv2.COLOR_BGR2GRAY))[0]
+        hists += channel_histograms(band)
+
+    current_mean = gray_sum / (image.shape[0] * image.shape[1])
+    gamma_lut = gamma_table(current_mean, gamma)
+    if np.array_equal(gamma_lut, np.arange(256)):
+        current_mean_after = current_mean
+    else:
+        current_mean_after = mean_after_lut(hists, gamma_lut)
+    lut = fuse_brightness_lut(gamma_lut, current_mean_after)
+
+    # Второй проход: одна таблица на месте
+    for y0, y1 in _bands(image.shape[0], band_rows):
+        cv2.LUT(image[y0:y1], lut, dst=image[y0:y1])
+
+
+def _contrast_in_bands(image, band_rows: int, clip_limit: float):
+    height, width = image.shape[:2]
+    l_plane = np.empty((height, width), dtype=np.uint8)
+    for y0, y1 in _bands(height, band_rows):
+        l_plane[y0:y1] = cv2.extractChannel(cv2.cvtColor(image[y0:y1], cv2.COLOR_BGR2LAB), 0)
+
+    # CLAHE считает гистограммы по сетке 8x8 всего кадра, поэтому — по полной плоскости L
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
+    l_clahe = clahe.apply(l_plane)
+
+    for y0, y1 in _bands(height, band_rows):
+        band = image[y0:y1]
+        lab = cv2.cvtColor(band, cv2.COLOR_BGR2LAB)
+        l_mix = cv2.addWeighted(l_plane[y0:y1], 0.7, l_clahe[y0:y1], 0.3, 0)
+        cv2.insertChannel(l_mix, lab, 0)
+        cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=band)
+
+
+def execute_plan_tiled(image, plan: list, band_rows: int, progress=None):
+    """Полосовой аналог execute_plan: изменяет image на месте и возвращает его"""
+    if progress is None:
+        progress = lambda stage, fraction: None  # noqa: E731
+
+    for index, (stage, params) in enumerate(plan):
+        with timed("iqa_process_stage_seconds", stage=stage, mode="tiled"):
+            if stage == "denoise":
+                _filter_in_bands(
+                    image, band_rows, STAGE_HALO[stage],
+                    lambda src: denoise_image(src, strength=params["strength"]),
+                )
+            elif stage == "brightness":
+                _brightness_in_bands(image, band_rows, params.get("gamma"))
+            elif stage == "contrast":
+                _contrast_in_bands(image, band_rows, params["clip_limit"])
+            elif stage == "sharpen":
+                _filter_in_bands(
+                    image, band_rows, STAGE_HALO[stage],
+                    lambda src: sharpen_image(src, strength=params["strength"]),
+                )
+            else:
+                raise ValueError(f"Неизвестный этап обработки: {stage}")
+        progress(stage, 0.1 + 0.6 * (index + 1) / len(plan))
+
+    return image
@@ -0,0 +1,399 @@
+"""
+Оценка качества видеоклипов и последовательностей кадров.
+
+Кадры читаются потоково через cv2.VideoCapture (файл или шаблон
+последовательности вида frames/%04d.png) и оцениваются теми же метриками,
+что и фото (analyze_context по кадру в памяти). В памяти — только текущий
+кадр и агрегаты: среднее, min/max и перцентили по гистограмме 0..100.
+
+Режимы выборки:
+    interval   каждый every-й кадр; пропущенные кадры — grab() без retrieve() и
+               перевода цвета (FFmpeg пакеты при этом всё равно декодирует), а
+               пропуск от SEEK_MIN_GAP кадров — переход по CAP_PROP_POS_FRAMES
+    scene      кадр после смены сцены (разница миниатюр > scene_threshold),
+               но не реже чем раз в every кадров
+    budget     шаг подбирается по ходу так, чтобы равномерно покрыть клип за time_budget_s
+               (пропуски — как в interval)
+
+Во всех режимах анализ останавливается по time_budget_s и max_samples (truncated).
+
+    python -m services.video_analysis clip.mp4 [--mode scene] [--budget 10]
+"""
+import hashlib
+import math
+import os
+import time
+import uuid
+
+import cv2
+import numpy as np
+from werkzeug.utils import secure_filename
+
+from extensions import db
+from models.video_analysis import VideoAnalysis, VideoFrameAnalysis
+from services.image_analysis import AnalysisContext, analyze_context, analyzer_version
+from services.instrumentation import record_image, timed
+from services.storage import tmp_dir
+
+
+METRICS = ("sharpness", "brightness", "contrast", "noise", "color_balance", "overall_quality")
+
+INTERVAL = "interval"
+SCENE = "scene"
+BUDGET = "budget"
+SAMPLING_MODES = (INTERVAL, SCENE, BUDGET)
+
+DEFAULT_EVERY = 30
+DEFAULT_TIME_BUDGET_S = 20.0
+DEFAULT_MAX_SAMPLES = 600
+# Средняя абсолютная разница миниатюр (0..255), после которой кадр считается новой сценой
+DEFAULT_SCENE_THRESHOLD = 30.0
+# В режиме scene миниатюра сравнивается на каждом SCENE_STRIDE-м кадре
+SCENE_STRIDE = 5
+# С какого пропуска переходить к кадру, а не grab() подряд. FFmpeg переходит к
+# ключевому кадру перед целью и декодирует до неё, поэтому переход выгоден,
+# только если пропуск длиннее типичной группы кадров (GOP)
+SEEK_MIN_GAP = 250
+_THUMB_SIZE = (64, 36)
+
+# Гистограмма перцентилей: 0..100 с шагом 0.5
+_HIST_BINS = 200
+PERCENTILES = (10, 50, 90)
+
+# Строки кадров сбрасываются в БД пачками, а не копятся в сессии
+FLUSH_EVERY = 100
+
+_CHUNK_SIZE = 1 << 20
+
+
+class RunningStats:
+    """Агрегаты метрики без хранения значений; перцентили — с точностью до 0.5"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.hist = np.zeros(_HIST_BINS, dtype=np.int64)
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.hist[min(_HIST_BINS - 1, max(0, int(value * _HIST_BINS / 100)))] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * q / 100) or 1
+        index = int(np.searchsorted(np.cumsum(self.hist), rank))
+        # Середина корзины, но не за пределами наблюдённых значений
+        return min(self.max, max(self.min, (index + 0.5) * 100 / _HIST_BINS))
+
+    def to_dict(self) -> dict:
+        summary = {"mean": self.mean, "min": self.min, "max": self.max} if self.count else {}
+        for q in PERCENTILES:
+            summary[f"p{q}"] = self.percentile(q)
+        return summary
+
+
+class ClipAggregates:
+    def __init__(self):
+        self.stats = {metric: RunningStats() for metric in METRICS}
+
+    def add(self, metrics: dict):
+        for metric, stats in self.stats.items():
+            stats.add(float(metrics[metric]))
+
+    def means(self) -> dict:
+        return {metric: stats.mean for metric, stats in self.stats.items()}
+
+    def summary(self) -> dict:
+        return {metric: stats.to_dict() for metric, stats in self.stats.items()}
+
+
+def open_capture(source: str) -> cv2.VideoCapture:
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        capture.release()
+        raise ValueError("Не удалось открыть видео")
+    return capture
+
+
+def _thumbnail(frame):
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, _THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+
+class FrameSampler:
+    """
+    Итератор (index, timestamp_ms, frame, reason) по выбранным кадрам.
+    Время между выдачами включает оценку кадра вызывающим кодом — по нему
+    режим budget подбирает шаг, а лимит времени останавливает чтение.
+    """
+
+    def __init__(self, capture, mode: str = INTERVAL, every: int = DEFAULT_EVERY,
+                 time_budget_s: float = DEFAULT_TIME_BUDGET_S, max_samples: int = DEFAULT_MAX_SAMPLES,
+                 scene_threshold: float = DEFAULT_SCENE_THRESHOLD):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Неизвестный режим выборки кадров: {mode}")
+        if every < 1:
+            raise ValueError("every должен быть не меньше 1")
+        self.capture = capture
+        self.mode = mode
+        self.every = every
+        self.time_budget_s = time_budget_s
+        self.max_samples = max_samples
+        self.scene_threshold = scene_threshold
+        self.frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        # Без числа кадров (поток, часть контейнеров) позиция ненадёжна — только grab()
+        self._seekable = self.frame_count is not None
+        # Кадров пройдено — прочитанных и пропущенных переходом
+        self.frames_read = 0
+        self.samples = 0
+        self.truncated = False
+
+    def _budget_stride(self, index: int, started: float) -> int:
+        """Шаг, при котором оставшиеся кадры покрываются за оставшееся время"""
+        if self.frame_count is None or not self.samples or not self.time_budget_s:
+            return self.every
+        elapsed = time.monotonic() - started
+        remaining = self.time_budget_s - elapsed
+        samples_left = max(1, min(remaining / (elapsed / self.samples), self.max_samples - self.samples))
+        return max(1, math.ceil((self.frame_count - index) / samples_left))
+
+    def _seek(self, target: int) -> bool:
+        with timed("iqa_decode_seconds", source="video_seek"):
+            if self.capture.set(cv2.CAP_PROP_POS_FRAMES, target):
+                return True
+        self._seekable = False
+        return False
+
+    def _read(self, decode: bool):
+        with timed("iqa_decode_seconds", source="video"):
+            if decode:
+                return self.capture.read()
+            return self.capture.grab(), None
+
+    def __iter__(self):
+        started = time.monotonic()
+        deadline = started + self.time_budget_s if self.time_budget_s else None
+        next_pick = 0
+        last_sample = None
+        last_scene = None
+
+        index = -1
+        while True:
+            if self.samples >= self.max_samples or (deadline is not None and time.monotonic() >= deadline):
+                # Лимит, достигнутый на последнем кадре клипа, — не обрезка
+                self.truncated = self.frame_count is None or self.frames_read < self.frame_count
+                return
+
+            index += 1
+            sought = False
+            if self.mode == SCENE:
+                decode = index % SCENE_STRIDE == 0 or index >= next_pick
+            else:
+                if self._seekable and next_pick - index >= SEEK_MIN_GAP and self._seek(next_pick):
+                    index, sought = next_pick, True
+                decode = index >= next_pick
+
+            ok, frame = self._read(decode)
+            if not ok:
+                if sought:
+                    # Переход за последний кадр: пройден весь клип
+                    self.frames_read = self.frame_count
+                return
+            self.frames_read = index + 1
+            if not decode:
+                continue
+
+            reason = self.mode
+            if self.mode == SCENE:
+                thumb = _thumbnail(frame)
+                changed = last_scene is None or (
+                    cv2.norm(thumb, last_scene, cv2.NORM_L1) / thumb.size > self.scene_threshold
+                )
+                if changed:
+                    last_scene = thumb
+                elif last_sample is None or index - last_sample < self.every:
+                    continue
+                else:
+                    reason = INTERVAL
+
+            timestamp_ms = self.capture.get(cv2.CAP_PROP_POS_MSEC)
+            self.samples += 1
+            last_sample = index
+            yield index, timestamp_ms, frame, reason
+
+            if self.mode == BUDGET:
+                next_pick = index + self._budget_stride(index + 1, started)
+            else:
+                next_pick = index + self.every
+
+
+def analyze_clip(source: str, mode: str = INTERVAL, every: int = DEFAULT_EVERY,
+                 time_budget_s: float = DEFAULT_TIME_BUDGET_S, max_samples: int = DEFAULT_MAX_SAMPLES,
+                 scene_threshold: float = DEFAULT_SCENE_THRESHOLD, profile: str = None,
+                 on_frame=None) -> dict:
+    """
+    Потоковая оценка клипа. on_frame(index, timestamp_ms, reason, metrics) вызывается
+    для каждого оценённого кадра. Пустой или нечитаемый клип — ValueError.
+    """
+    started = time.monotonic()
+    capture = open_capture(source)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or None
+        sampler = FrameSampler(capture, mode, every, time_budget_s, max_samples, scene_threshold)
+        aggregates = ClipAggregates()
+        width = height = None
+
+        for index, timestamp_ms, frame, reason in sampler:
+            height, width = frame.shape[:2]
+            record_image("video", frame)
+            metrics = {k: float(v) for k, v in analyze_context(AnalysisContext(frame), profile=profile).items()}
+            aggregates.add(metrics)
+            if on_frame is not None:
+                on_frame(index, timestamp_ms, reason, metrics)
+    finally:
+        capture.release()
+
+    if not sampler.samples:
+        raise ValueError("В видео нет читаемых кадров")
+
+    return {
+        "sampling": mode,
+        "frames_read": sampler.frames_read,
+        "frames_sampled": sampler.samples,
+        "fps": fps,
+        "width": width,
+        "height": height,
+        "duration_s": sampler.frames_read / fps if fps else None,
+        "truncated": sampler.truncated,
+        "elapsed_s": time.monotonic() - started,
+        "means": aggregates.means(),
+        "summary": aggregates.summary(),
+    }
+
+
+def save_clip_analysis(source: str, original_filename: str, content_digest: str = None,
+                       user_id: int = 1, profile: str = None, **sampling) -> VideoAnalysis:
+    """analyze_clip с записью строки клипа и строк кадров; коммитит"""
+    video = VideoAnalysis(
+        user_id=user_id,
+        original_filename=original_filename,
+        content_digest=content_digest,
+        analyzer_version=analyzer_version(profile),
+        sampling=sampling.get("mode", INTERVAL),
+    )
+    db.session.add(video)
+    db.session.flush()  # нужен video.id для строк кадров
+    pending = [0]
+
+    def on_frame(index, timestamp_ms, reason, metrics):
+        db.session.add(VideoFrameAnalysis(
+            video_id=video.id,
+            frame_index=index,
+            timestamp_ms=timestamp_ms,
+            reason=reason,
+            **metrics,
+        ))
+        pending[0] += 1
+        if pending[0] >= FLUSH_EVERY:
+            db.session.flush()
+            pending[0] = 0
+
+    try:
+        clip = analyze_clip(source, profile=profile, on_frame=on_frame, **sampling)
+    except ValueError:
+        db.session.rollback()
+        raise
+
+    for key in ("frames_read", "frames_sampled", "fps", "width", "height", "duration_s", "truncated", "elapsed_s"):
+        setattr(video, key, clip[key])
+    for metric, value in clip["means"].items():
+        setattr(video, metric, value)
+    video.summary = clip["summary"]
+
+    with timed("iqa_db_commit_seconds", route="video"):
+        db.session.commit()
+    return video
+
+
+def ingest_video(file, upload_dir: str, user_id: int = 1, profile: str = None, **sampling) -> VideoAnalysis:
+    """
+    Загрузка клипа: поток копируется во временный файл кусками (VideoCapture
+    нужен путь), оценивается и удаляется. Клип с тем же содержимым, версией
+    анализатора и режимом выборки повторно не оценивается.
+    """
+    filename = secure_filename(file.filename) or "video"
+    tmp_path = os.path.join(tmp_dir(upload_dir), f"video-{uuid.uuid4().hex}{os.path.splitext(filename)[1]}")
+
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        content_digest = digest.hexdigest()
+
+        existing = (
+            VideoAnalysis.query
+            .filter_by(
+                content_digest=content_digest,
+                analyzer_version=analyzer_version(profile),
+                sampling=sampling.get("mode", INTERVAL),
+            )
+            .order_by(VideoAnalysis.id.desc())
+            .first()
+        )
+        if existing is not None:
+            return existing
+
+        return save_clip_analysis(
+            tmp_path, filename, content_digest=content_digest, user_id=user_id, profile=profile, **sampling
+        )
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def sampling_from_config(config, mode: str = None) -> dict:
+    return {
+        "mode": mode or INTERVAL,
+        "every": config.get("VIDEO_SAMPLE_EVERY", DEFAULT_EVERY),
+        "time_budget_s": config.get("VIDEO_TIME_BUDGET_S", DEFAULT_TIME_BUDGET_S),
+        "max_samples": config.get("VIDEO_MAX_SAMPLES", DEFAULT_MAX_SAMPLES),
+        "scene_threshold": config.get("VIDEO_SCENE_THRESHOLD", DEFAULT_SCENE_THRESHOLD),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog="python -m services.video_analysis", description="Оценка качества видео")
+    parser.add_argument("source", help="файл видео или шаблон последовательности (frames/%%04d.png)")
+    parser.add_argument("--mode", choices=SAMPLING_MODES, default=INTERVAL)
+    parser.add_argument("--every", type=int, default=DEFAULT_EVERY)
+    parser.add_argument("--budget", type=float, default=DEFAULT_TIME_BUDGET_S, help="лимит времени, с")
+    parser.add_argument("--max-samples", type=int, default=DEFAULT_MAX_SAMPLES)
+    parser.add_argument("--scene-threshold", type=float, default=DEFAULT_SCENE_THRESHOLD)
+    parser.add_argument("--profile", choices=("precise", "fast"), default=None)
+    parser.add_argument("--frames", action="store_true", help="печатать метрики каждого кадра")
+    args = parser.parse_args()
+
+    def print_frame(index, timestamp_ms, reason, metrics):
+        print(json.dumps({"frame": index, "timestamp_ms": timestamp_ms, "reason": reason, **metrics}))
+
+    result = analyze_clip(
+        args.source, mode=args.mode, every=args.every, time_budget_s=args.budget,
+        max_samples=args.max_samples, scene_threshold=args.scene_threshold, profile=args.profile,
+        on_frame=print_frame if args.frames else None,
+    )
+    print(json.dumps(result, ensure_ascii=False))
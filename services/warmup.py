@@ -0,0 +1,134 @@
+"""
+Прогрев процесса перед обслуживанием запросов.
+
+Импорт приложения не тянет тяжёлые бэкенды метрик (skimage, scipy.stats —
+см. image_analysis.HEAVY_MODULES), поэтому первый анализ в свежем процессе
+платит за их импорт и за первые вызовы OpenCV (выбор SIMD-ветвей, загрузка
+кодеков). warm_up() делает всё это заранее на маленьком синтетическом кадре.
+
+Сервер с fork (gunicorn, preload_app — см. gunicorn.conf.py) вызывает warm_up
+один раз в родителе: воркеры получают загруженные модули копией страниц
+памяти, а gc.freeze() убирает их из обходов сборщика, чтобы страницы не
+копировались при первой же сборке мусора в воркере.
+
+    python -m services.warmup                      — прогрев и время шагов
+    python -m services.warmup --probe photo.jpg [--warm]
+        — замер холодного старта в этом процессе (для python -m services.benchmark --startup)
+
+Модуль импортирует приложение только внутри функций: --probe меряет и сам импорт.
+"""
+import gc
+import json
+import time
+
+
+WARM_UP_SIZE = (320, 240)
+WARM_UP_FORMATS = (".jpg", ".png", ".webp")
+
+
+def _synthetic_frame():
+    import cv2
+    import numpy as np
+
+    width, height = WARM_UP_SIZE
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    cv2.setRNGSeed(0)
+    cv2.randu(frame, 0, 255)
+    return cv2.GaussianBlur(frame, (0, 0), 2)
+
+
+def warm_up(app=None) -> dict:
+    """
+    Импортирует бэкенды и прогоняет анализ, обработку и кодирование на
+    маленьком кадре. Возвращает время шагов в секундах.
+    Работает в один поток: пулы потоков OpenCV и parallel_map не создаются
+    до fork — их потоки не перешли бы в дочерние процессы.
+    """
+    import cv2
+
+    from services import image_analysis
+    from services.encoding import encode_image
+    from services.image_processing import compile_plan, execute_plan
+    from services.quality_maps import quality_maps
+    from services.threads import configure_threads, thread_budget
+
+    timings = {}
+
+    def step(name, func):
+        started = time.perf_counter()
+        result = func()
+        timings[name] = round(time.perf_counter() - started, 4)
+        return result
+
+    threads = thread_budget()
+    configure_threads(1)
+    try:
+        step("imports", image_analysis.load_backends)
+        frame = _synthetic_frame()
+        encoded = step("encode", lambda: [encode_image(frame, ext) for ext in WARM_UP_FORMATS])
+
+        ctx = step("decode", lambda: image_analysis.AnalysisContext.from_bytes(encoded[0]))
+        metrics = step("analysis", lambda: [
+            image_analysis.analyze_context(ctx, profile=profile) for profile in image_analysis.PROFILES
+        ])[0]
+        step("quality_maps", lambda: quality_maps(ctx))
+
+        plan = compile_plan({"enhance_brightness": True, "sharpen": True, "denoise": True}, metrics)
+        plan += compile_plan({"auto_improve": True}, dict.fromkeys(metrics, 0))
+        step("processing", lambda: execute_plan(frame.copy(), plan))
+    finally:
+        configure_threads(threads)
+
+    # Загруженное при импорте и прогреве живёт до конца процесса
+    gc.collect()
+    gc.freeze()
+
+    if app is not None:
+        app.logger.info("Прогрев: %s", timings)
+    timings["opencv_threads"] = cv2.getNumThreads()
+    return timings
+
+
+def probe(image_path: str, warm: bool = False) -> dict:
+    """
+    Холодный старт процесса: импорт и создание приложения, прогрев (warm),
+    первый и второй анализ image_path
+    """
+    started = time.perf_counter()
+    import app  # noqa: F401 — модуль сам вызывает create_app()
+
+    report = {"import_app_s": time.perf_counter() - started, "warm_up_s": 0.0}
+    if warm:
+        begun = time.perf_counter()
+        report["warm_up"] = warm_up()
+        report["warm_up_s"] = time.perf_counter() - begun
+
+    from services.image_analysis import analyze_image
+
+    for name in ("first_analysis_s", "second_analysis_s"):
+        begun = time.perf_counter()
+        analyze_image(image_path)
+        report[name] = time.perf_counter() - begun
+
+    report["ready_s"] = time.perf_counter() - started
+
+    from services.benchmark import _peak_rss_mb
+
+    report["peak_rss_mb"] = _peak_rss_mb()
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m services.warmup", description="Прогрев процесса")
+    parser.add_argument("--probe", metavar="IMAGE", help="замерить холодный старт на этом файле")
+    parser.add_argument("--warm", action="store_true", help="с --probe: прогреть перед первым анализом")
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(probe(args.probe, warm=args.warm)))
+    else:
+        from app import create_app
+
+        print(json.dumps(warm_up(create_app())))